@@ -24,3 +24,16 @@ class EdsiteConfig(AppConfig):
             # threading.Thread(target=EDData().start_live_listener, daemon=True).start()
         else:
             print("Not starting the live listener.")
+
+        from EDSite.tools.ed_data import database_update_job
+        from EDSite.tools.jobs import JobScheduler
+
+        for mode, schedule in [
+            ("all", settings.FULL_UPDATE_SCHEDULE),
+            ("listings", settings.LISTINGS_UPDATE_SCHEDULE),
+        ]:
+            if schedule:
+                print(f"Scheduling the {mode} database update at '{schedule}'.")
+                JobScheduler().schedule(
+                    f"update_database_{mode}", schedule, database_update_job(mode)
+                )
@@ -55,6 +55,40 @@ class CommodityForm(forms.Form):
         ),
         required=False,
     )
+    order_by = forms.ChoiceField(
+        required=False,
+        choices=[("price", "Price"), ("distance", "Distance"), ("score", "Score")],
+    )
+    max_distance = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "Unlimited"},
+        ),
+        required=False,
+    )
+    price_weight = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "1"},
+        ),
+        required=False,
+    )
+    units_weight = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "0.25"},
+        ),
+        required=False,
+    )
+    age_weight = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "0.25"},
+        ),
+        required=False,
+    )
+    distance_weight = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "1"},
+        ),
+        required=False,
+    )
 
 
 class SystemsForm(forms.Form):
@@ -108,6 +142,88 @@ class StationsForm(forms.Form):
     )
 
 
+class TradeRoutesForm(forms.Form):
+    reference_system = ChoiceFieldNoValidation(
+        widget=forms.Select(attrs={"class": "input", "id": "referenceInput"}),
+        required=False,
+    )
+    search_radius = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "30"},
+        ),
+        required=False,
+    )
+    cargo_capacity = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "100"},
+        ),
+        required=False,
+    )
+    budget = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "Unlimited"},
+        ),
+        required=False,
+    )
+    include_odyssey = forms.ChoiceField(
+        required=False,
+        choices=YES_NO_CHOICES,
+    )
+    include_fleet_carriers = forms.ChoiceField(
+        required=False,
+        choices=YES_NO_CHOICES,
+    )
+    include_planetary = forms.ChoiceField(
+        required=False,
+        choices=YES_NO_CHOICES,
+    )
+    landing_pad_size = forms.ChoiceField(
+        required=False,
+        choices=LANDING_PAD_CHOICES,
+    )
+    order_by = forms.ChoiceField(
+        required=False,
+        choices=[("profit", "Profit"), ("profit_per_ly", "Profit per Ly")],
+    )
+    hops = forms.ChoiceField(
+        required=False,
+        choices=[("1", "Single"), ("2", "2"), ("3", "3"), ("4", "4"), ("5", "5")],
+    )
+    max_hop_distance = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "Unlimited"},
+        ),
+        required=False,
+    )
+
+
+class CarrierPlannerForm(forms.Form):
+    start_system = ChoiceFieldNoValidation(
+        widget=forms.Select(attrs={"class": "input", "id": "startInput"}),
+        required=False,
+    )
+    destination_system = ChoiceFieldNoValidation(
+        widget=forms.Select(attrs={"class": "input", "id": "destinationInput"}),
+        required=False,
+    )
+    jump_range = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "500"},
+        ),
+        required=False,
+    )
+    cargo = forms.CharField(
+        widget=forms.TextInput(
+            attrs={"class": "input", "placeholder": "0"},
+        ),
+        required=False,
+    )
+    minimise = forms.ChoiceField(
+        required=False,
+        choices=[("jumps", "Jumps"), ("fuel", "Tritium")],
+    )
+
+
 class CarrierMissionForm(forms.Form):
     carrier_name = forms.CharField(
         widget=forms.TextInput(
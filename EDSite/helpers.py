@@ -205,6 +205,12 @@ def chunks_no_overlap(lst, n):
     return result
 
 
+def is_gzip_file(path) -> bool:
+    """Check the magic number instead of trusting the file extension."""
+    with open(path, "rb") as fh:
+        return fh.read(2) == b"\x1f\x8b"
+
+
 def update_item_dict():
     # We'll use this to get the fdev_id from the 'symbol', AKA commodity['name'].lower()
     db_name = dict()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from EDSite.tools.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run one of the performance benchmarks. Database changes are rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(BENCHMARKS.keys()))
+        parser.add_argument("--size", type=int, default=None)
+
+    def handle(self, *args, **options):
+        func = BENCHMARKS.get(options["name"])
+        if not func:
+            raise CommandError(f"Unknown benchmark {options['name']}")
+        kwargs = {"size": options["size"]} if options["size"] else {}
+        self.stdout.write(f"{options['name']}: {func.__doc__}")
+        self.stdout.write(func(**kwargs))
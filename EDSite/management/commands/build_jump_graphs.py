@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from EDSite.tools.jump_graph import build_jump_graph, graph_path, update_jump_graph
+from EDSite.tools.spatial import SystemIndex
+from EDSiteProject import settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the lists of the systems within jump range of every system, one file per range in "
+        "JUMP_GRAPH_DIR. Database updates add new systems to the files that exist."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ranges", nargs="+", type=float, default=settings.JUMP_GRAPH_RANGES
+        )
+        parser.add_argument(
+            "--update",
+            action="store_true",
+            help="Only add the systems that a graph lacks, rather than building it again.",
+        )
+
+    def handle(self, *args, **options):
+        coordinates = SystemIndex().snapshot()
+        for jump_range in options["ranges"]:
+            path = graph_path(jump_range)
+            t0 = time.time()
+            if options["update"] and path.exists():
+                added = update_jump_graph(jump_range, coordinates=coordinates)
+                result = f"Added {added} systems to {path}"
+            else:
+                systems = build_jump_graph(jump_range, coordinates=coordinates)
+                result = f"Built {path} for {systems} systems"
+            self.stdout.write(
+                f"{result} in {time.time() - t0:.1f} seconds, "
+                f"{path.stat().st_size / 1024 / 1024:.1f} MB."
+            )
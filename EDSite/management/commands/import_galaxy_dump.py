@@ -0,0 +1,47 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from EDSite.tools.galaxy_dump import DUMP_BATCH_SIZE, GalaxyDumpImporter
+from EDSiteProject import settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Import locally downloaded galaxy dumps (gzipped JSON lines) of systems, stations and markets. "
+        "Does not need a network connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--systems", nargs="+", type=Path, default=[])
+        parser.add_argument("--stations", nargs="+", type=Path, default=[])
+        parser.add_argument("--markets", nargs="+", type=Path, default=[])
+        parser.add_argument("--workers", type=int, default=settings.IMPORT_WORKERS)
+        parser.add_argument("--batch-size", type=int, default=DUMP_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        paths = options["systems"] + options["stations"] + options["markets"]
+        if not paths:
+            raise CommandError(
+                "Pass at least one of --systems, --stations or --markets."
+            )
+        for path in paths:
+            if not path.exists():
+                raise CommandError(f"{path} does not exist.")
+        importer = GalaxyDumpImporter(
+            workers=options["workers"], batch_size=options["batch_size"]
+        )
+        # Stations need their systems and markets need their stations, so the order matters.
+        for kind, run in [
+            ("systems", importer.import_systems),
+            ("stations", importer.import_stations),
+            ("markets", importer.import_markets),
+        ]:
+            if not options[kind]:
+                continue
+            t0 = time.time()
+            result = run(options[kind])
+            self.stdout.write(
+                f"Imported {kind} in {time.time() - t0:.1f} seconds. {result}"
+            )
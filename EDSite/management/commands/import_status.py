@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from EDSite.models import ImportRun
+
+
+class Command(BaseCommand):
+    help = "Show the stage, progress and estimated remaining time of the latest database updates."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=1)
+
+    def handle(self, *args, **options):
+        runs = ImportRun.objects.order_by("-started")[: options["runs"]]
+        if not runs:
+            self.stdout.write("No database update has run yet.")
+        for run in runs:
+            self.stdout.write(
+                f"Run {run.id}: {run.status}, started {run.started:%Y-%m-%d %H:%M:%S}, "
+                f"last progress {timezone.now() - run.updated} ago"
+            )
+            if run.stage:
+                line = f"  Stage: {run.stage}"
+                if run.total:
+                    line += f", {run.done}/{run.total} {run.unit} ({run.done / run.total:.0%})"
+                eta = run.eta()
+                if eta is not None:
+                    line += f", about {eta} remaining"
+                self.stdout.write(line)
+            stages = run.checkpoints.filter(chunk="").order_by("created")
+            chunks = run.checkpoints.exclude(chunk="")
+            if stages:
+                self.stdout.write(
+                    "  Finished stages: " + ", ".join(stage.stage for stage in stages)
+                )
+            last_chunk = chunks.order_by("-created").first()
+            if last_chunk:
+                self.stdout.write(
+                    f"  Checkpointed chunks: {chunks.count()}, last {last_chunk} "
+                    f"at {last_chunk.created:%Y-%m-%d %H:%M:%S}"
+                )
+            if run.error:
+                self.stdout.write(f"  Error: {run.error}")
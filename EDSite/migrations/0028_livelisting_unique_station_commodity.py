@@ -0,0 +1,28 @@
+# Generated by Django 4.0.6 on 2026-10-19 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('EDSite', '0027_alter_localfaction_system_alter_state_name'),
+    ]
+
+    operations = [
+        # Keep only the most recent listing of every (station, commodity) pair.
+        migrations.RunSQL(
+            sql="""
+                DELETE FROM "EDSite_livelisting" a
+                USING "EDSite_livelisting" b
+                WHERE a.station_id = b.station_id
+                  AND a.commodity_id = b.commodity_id
+                  AND (a.modified < b.modified OR (a.modified = b.modified AND a.id < b.id))
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='livelisting',
+            constraint=models.UniqueConstraint(fields=('station', 'commodity'), name='unique_station_commodity'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.6 on 2026-10-19 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('EDSite', '0028_livelisting_unique_station_commodity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=32, unique=True)),
+                ('modified', models.DateTimeField(null=True)),
+                ('reconciled', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.6 on 2026-10-19 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('EDSite', '0029_importwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station',
+            name='market_id',
+            field=models.BigIntegerField(null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='system',
+            name='id64',
+            field=models.BigIntegerField(null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='system',
+            name='tradedangerous_id',
+            field=models.IntegerField(db_index=True, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.0.6 on 2026-10-19 13:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('EDSite', '0030_galaxy_dump_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed'), ('abandoned', 'Abandoned')], default='running', max_length=16)),
+                ('options', models.JSONField(default=dict)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('stage', models.CharField(max_length=32, null=True)),
+                ('stage_started', models.DateTimeField(null=True)),
+                ('done', models.BigIntegerField(default=0)),
+                ('total', models.BigIntegerField(null=True)),
+                ('unit', models.CharField(default='chunks', max_length=16)),
+                ('done_at_start', models.BigIntegerField(default=0)),
+                ('error', models.TextField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(max_length=32)),
+                ('chunk', models.CharField(default='', max_length=128)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('result', models.CharField(default='', max_length=256)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='EDSite.importrun')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='importcheckpoint',
+            constraint=models.UniqueConstraint(fields=('run', 'stage', 'chunk'), name='unique_import_checkpoint'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.0.6 on 2026-10-19 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('EDSite', '0031_import_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='system',
+            name='distance_to_sol',
+            field=models.FloatField(db_index=True, null=True),
+        ),
+        migrations.RunSQL(
+            sql="""
+                UPDATE "EDSite_system"
+                SET distance_to_sol = sqrt(pos_x * pos_x + pos_y * pos_y + pos_z * pos_z)
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name='system',
+            name='pos_x',
+            field=models.FloatField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='system',
+            name='pos_y',
+            field=models.FloatField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='system',
+            name='pos_z',
+            field=models.FloatField(db_index=True),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import math
+
 from django.db import models
 from django.db.models import Q
 from EDSite.helpers import (
@@ -262,9 +264,11 @@ class Rare(models.Model):
 
 class System(models.Model):
     name = models.CharField(max_length=100, db_index=True)
-    pos_x = models.FloatField()
-    pos_y = models.FloatField()
-    pos_z = models.FloatField()
+    pos_x = models.FloatField(db_index=True)
+    pos_y = models.FloatField(db_index=True)
+    pos_z = models.FloatField(db_index=True)
+    # Kept up to date by save(). Code that writes the coordinates in bulk sets it as well.
+    distance_to_sol = models.FloatField(null=True, db_index=True)
     population = models.BigIntegerField(null=True)
     government = models.PositiveSmallIntegerField(
         choices=Governments.choices, null=True
@@ -281,23 +285,28 @@ class System(models.Model):
         choices=SystemSecurities.choices, null=True
     )
 
-    tradedangerous_id = models.IntegerField(unique=True, db_index=True)
+    tradedangerous_id = models.IntegerField(unique=True, db_index=True, null=True)
+    # The game's own system address. Used to match the systems of galaxy dumps.
+    id64 = models.BigIntegerField(unique=True, null=True)
 
     class Meta:
         ordering = ["-id"]
 
     def distance_to(self, other: "System"):
-        dX = self.pos_x - other.pos_x
-        dY = self.pos_y - other.pos_y
-        dZ = self.pos_z - other.pos_z
-        return ((dX**2) + (dY**2) + (dZ**2)) ** 0.5
+        # Use SystemIndex().distances() for many systems at once.
+        return math.dist(
+            (self.pos_x, self.pos_y, self.pos_z),
+            (other.pos_x, other.pos_y, other.pos_z),
+        )
 
-    def distance_to_sol(self):
-        # TODO: Save this in DB or a cache so it doesn't need to be recalculated every time.
-        dX = self.pos_x
-        dY = self.pos_y
-        dZ = self.pos_z
-        return ((dX**2) + (dY**2) + (dZ**2)) ** 0.5
+    def save(self, *args, **kwargs):
+        self.distance_to_sol = math.hypot(self.pos_x, self.pos_y, self.pos_z)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"pos_x", "pos_y", "pos_z"} & set(
+            update_fields
+        ):
+            kwargs["update_fields"] = set(update_fields) | {"distance_to_sol"}
+        super().save(*args, **kwargs)
 
     @property
     def get_station_names(self):
@@ -328,6 +337,8 @@ class Station(models.Model):
         System, on_delete=models.CASCADE, related_name="stations"
     )
     tradedangerous_id = models.IntegerField(unique=True, db_index=True, null=True)
+    # The game's market id. Used to match the stations and markets of galaxy dumps.
+    market_id = models.BigIntegerField(unique=True, null=True)
 
     class Meta:
         ordering = ["-id"]
@@ -367,79 +378,9 @@ class Station(models.Model):
         return datetime_to_age_string(self.modified)
 
     def set_listings(self, listings_list: ["LiveListing"]):
-        # with transaction.atomic():
-        exising_listings = {
-            ll.commodity_id: ll
-            for ll in LiveListing.objects.filter(station_id=self.id).all()
-        }
-        # To delete is everything minus updated.
-        updated_listings: {int: LiveListing} = {}
-        new_listings = []
-        new_historic_listings = []
-
-        new_ll: LiveListing
-        for new_ll in listings_list:
-            existing_match: LiveListing = exising_listings.get(new_ll.commodity_id)
-            if existing_match:
-                # Update an existing listing
-                if not self.fleet:
-                    if (
-                        difference_percent(
-                            existing_match.demand_price, new_ll.demand_price
-                        )
-                        > settings.HISTORIC_DIFFERENCE_DELTA
-                        or difference_percent(
-                            existing_match.supply_price, new_ll.supply_price
-                        )
-                        > settings.HISTORIC_DIFFERENCE_DELTA
-                    ):
-                        new_historic_listings.append(
-                            HistoricListing.from_live(existing_match)
-                        )
-
-                existing_match.demand_price = new_ll.demand_price
-                existing_match.demand_units = new_ll.demand_units
-                existing_match.supply_price = new_ll.supply_price
-                existing_match.supply_units = new_ll.supply_units
-                existing_match.modified = new_ll.modified
-                existing_match.from_live = new_ll.from_live
-                updated_listings[existing_match.id] = existing_match
-            else:
-                # It's a new listing.
-                new_listings.append(new_ll)
+        from EDSite.tools.listings_merge import upsert_station_listings
 
-        if updated_listings:
-            with transaction.atomic():
-                to_update = LiveListing.objects.select_for_update().filter(
-                    pk__in=sorted(updated_listings.keys())
-                )
-                for to_update_ll in to_update:
-                    for attribute in [
-                        "demand_price",
-                        "demand_units",
-                        "supply_price",
-                        "supply_units",
-                        "modified",
-                        "from_live",
-                    ]:
-                        to_update_ll.__setattr__(
-                            attribute,
-                            updated_listings[to_update_ll.id].__getattribute__(
-                                attribute
-                            ),
-                        )
-                    to_update_ll.save()
-        if updated_listings:
-            LiveListing.objects.filter(
-                Q(station_id=self.id)
-                & ~Q(pk__in=[ll_id for ll_id, ll in updated_listings.items()])
-            ).delete()
-
-        if new_listings:
-            LiveListing.objects.bulk_create(new_listings)
-
-        if new_historic_listings:
-            HistoricListing.objects.bulk_create(new_historic_listings)
+        upsert_station_listings(self, listings_list)
 
     @property
     def services_lists(self):
@@ -498,6 +439,11 @@ class LiveListing(models.Model):
 
     class Meta:
         ordering = ["-id"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["station", "commodity"], name="unique_station_commodity"
+            ),
+        ]
 
     @property
     def is_recently_modified(self):
@@ -748,8 +694,6 @@ class LocalFaction(models.Model):
     influence = models.FloatField()
     modified = models.DateTimeField(null=True)
 
-
-
     def has_states_changed(
         self, states: [], recovering_states: [], pending_states: []
     ) -> bool:
@@ -792,3 +736,103 @@ class Faction(models.Model):
 
     def __str__(self):
         return f"{self.name}" + "" if not self.is_player else f" (Player) "
+
+
+class ImportWatermark(models.Model):
+    """The most recent modified timestamp that has been imported from a listings source."""
+
+    source = models.CharField(max_length=32, unique=True)
+    modified = models.DateTimeField(null=True)
+    reconciled = models.DateTimeField(null=True)
+
+    @classmethod
+    def for_source(cls, source: str) -> "ImportWatermark":
+        watermark, _ = cls.objects.get_or_create(source=source)
+        return watermark
+
+    def needs_reconciliation(self) -> bool:
+        """A full import is needed to find deleted listings, which an incremental import can not see."""
+        return (
+            not self.modified
+            or not self.reconciled
+            or timezone.now() - self.reconciled
+            > datetime.timedelta(hours=settings.LISTINGS_RECONCILIATION_HOURS)
+        )
+
+    def advance(self, modified: Optional[datetime.datetime], reconciled=False):
+        if modified and (not self.modified or modified > self.modified):
+            self.modified = modified
+        if reconciled:
+            self.reconciled = timezone.now()
+        self.save()
+
+    def __str__(self):
+        return f"{self.source}: {self.modified} (reconciled {self.reconciled})"
+
+
+class ImportRunStatus(models.TextChoices):
+    RUNNING = "running", "Running"
+    FINISHED = "finished", "Finished"
+    FAILED = "failed", "Failed"
+    ABANDONED = "abandoned", "Abandoned"
+
+
+class ImportRun(models.Model):
+    """
+    One run of EDData.update_local_database. The run records which stage it is in and how far that
+    stage got, so an interrupted run can be resumed and followed with the import_status command.
+    """
+
+    status = models.CharField(
+        max_length=16, choices=ImportRunStatus.choices, default=ImportRunStatus.RUNNING
+    )
+    options = models.JSONField(default=dict)
+    started = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True)
+    stage = models.CharField(max_length=32, null=True)
+    stage_started = models.DateTimeField(null=True)
+    # Progress of the current stage, in chunks or bytes (unit).
+    done = models.BigIntegerField(default=0)
+    total = models.BigIntegerField(null=True)
+    unit = models.CharField(max_length=16, default="chunks")
+    # Progress at stage_started. Work that was skipped on a resume does not count towards the rate.
+    done_at_start = models.BigIntegerField(default=0)
+    error = models.TextField(null=True)
+
+    def eta(self) -> Optional[datetime.timedelta]:
+        """Estimate the remaining time of the current stage from its rate so far."""
+        if self.status != ImportRunStatus.RUNNING or not self.total:
+            return None
+        progressed = self.done - self.done_at_start
+        if progressed <= 0 or not self.stage_started:
+            return None
+        elapsed = timezone.now() - self.stage_started
+        return elapsed * ((self.total - self.done) / progressed)
+
+    def __str__(self):
+        return f"Import run {self.id} ({self.status}, stage {self.stage})"
+
+
+class ImportCheckpoint(models.Model):
+    """
+    A stage, or a chunk of a stage, that an import run has committed. An empty chunk marks a whole stage.
+    """
+
+    run = models.ForeignKey(
+        ImportRun, on_delete=models.CASCADE, related_name="checkpoints"
+    )
+    stage = models.CharField(max_length=32)
+    chunk = models.CharField(max_length=128, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    result = models.CharField(max_length=256, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["run", "stage", "chunk"], name="unique_import_checkpoint"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.stage} {self.chunk}".strip()
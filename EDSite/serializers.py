@@ -15,6 +15,8 @@ class SystemSerializer(serializers.HyperlinkedModelSerializer):
     government_name = serializers.CharField(source="get_government_display")
     allegiance_name = serializers.CharField(source="get_allegiance_display")
     security_name = serializers.CharField(source="get_security_display")
+    # Only present when the list was queried with near.
+    distance = serializers.FloatField(read_only=True)
     # station_names = serializers.SerializerMethodField('get_station_names')
 
     class Meta:
@@ -26,6 +28,7 @@ class SystemSerializer(serializers.HyperlinkedModelSerializer):
             "pos_x",
             "pos_y",
             "pos_z",
+            "distance_to_sol",
             "tradedangerous_id",
             "population",
             "government",
@@ -34,6 +37,7 @@ class SystemSerializer(serializers.HyperlinkedModelSerializer):
             "allegiance_name",
             "security",
             "security_name",
+            "distance",
             # "station_names",
         ]
 
@@ -43,6 +47,8 @@ class SystemSerializer(serializers.HyperlinkedModelSerializer):
 
 class StationSerializer(serializers.HyperlinkedModelSerializer):
     system = SystemSerializer()
+    # Only present when the list was queried with near.
+    distance = serializers.FloatField(read_only=True)
 
     class Meta:
         model = Station
@@ -64,12 +70,17 @@ class StationSerializer(serializers.HyperlinkedModelSerializer):
             "odyssey",
             "system",
             "tradedangerous_id",
+            "distance",
         ]
 
 
 class ListingsSerializer(serializers.HyperlinkedModelSerializer):
     commodity = CommoditySerializer()
     station = StationSerializer()
+    # Only present when the list was queried with near.
+    distance = serializers.FloatField(read_only=True)
+    # Only present when the list was queried with order=score.
+    score = serializers.FloatField(read_only=True)
 
     class Meta:
         model = LiveListing
@@ -83,6 +94,8 @@ class ListingsSerializer(serializers.HyperlinkedModelSerializer):
             "supply_units",
             "modified",
             "from_live",
+            "distance",
+            "score",
         ]
 
         read_only_fields = []
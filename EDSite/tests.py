@@ -1,3 +1,1086 @@
-from django.test import TestCase
+import contextlib
+import datetime
+import io
+import math
+import random
+import sqlite3
+import tempfile
+import time
+from array import array
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import psycopg2
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from tradedangerous import tradedb
+
+from EDSite.models import (
+    Commodity,
+    CommodityCategory,
+    HistoricListing,
+    ImportRun,
+    ImportRunStatus,
+    ImportWatermark,
+    LiveListing,
+    Rare,
+    Station,
+    System,
+)
+from EDSite.tools.bulk import RowStream, _csv_value, copy_rows, insert_rows
+from EDSite.tools.ed_data import TD_WATERMARK_SOURCE, EDData
+from EDSite.tools.eddn_spool import SEGMENT_SUFFIX, MessageSpool
+from EDSite.tools.galaxy_dump import DUMP_SYSTEM_TABLE, GalaxyDumpImporter
+from EDSite.tools.import_progress import ImportProgress
+from EDSite.tools.jobs import CronSchedule
+from EDSite.tools.jump_graph import (
+    DISTANCE_STEPS,
+    decode_neighbours,
+    encode_neighbours,
+)
+from EDSite.tools.listing_index import (
+    DEMAND,
+    RANK_HALF_AGE,
+    RANK_HALF_DISTANCE,
+    SUPPLY,
+    CommodityListings,
+    RankWeights,
+    score_listings,
+)
+from EDSite.tools.listings_csv import merge_listings_file, station_chunks
+from EDSite.tools.listings_merge import ListingsStaging, upsert_station_listings
+from EDSite.tools.spatial import (
+    KDTree,
+    SystemCoordinates,
+    SystemIndex,
+    annotate_distance,
+)
+from EDSite.tools.stations_merge import TD_FLEET_TYPE_ID, StationsStaging
+from EDSite.tools.td_session import TradeDBSession, open_td_database
+from EDSite.tools.timestamps import (
+    format_timestamp,
+    parse_timestamp,
+    parse_timestamps,
+)
+
+
+UTC = datetime.timezone.utc
+T0 = datetime.datetime(2022, 9, 1, tzinfo=UTC)
+
+
+def hours(count: int) -> datetime.datetime:
+    return T0 + datetime.timedelta(hours=count)
+
+
+def td_timestamp(count: int) -> str:
+    """hours(count) the way TradeDangerous stores it."""
+    return hours(count).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def create_commodity(tradedangerous_id: int) -> Commodity:
+    category, _ = CommodityCategory.objects.get_or_create(
+        tradedangerous_id=1, defaults={"name": "Metals"}
+    )
+    return Commodity.objects.create(
+        name=f"Commodity {tradedangerous_id}",
+        category=category,
+        average_price=100,
+        game_id=tradedangerous_id,
+        tradedangerous_id=tradedangerous_id,
+    )
+
+
+def create_system(name: str = "Sol", tradedangerous_id: int = None, position=(0, 0, 0)):
+    x, y, z = position
+    return System.objects.create(
+        name=name, pos_x=x, pos_y=y, pos_z=z, tradedangerous_id=tradedangerous_id
+    )
+
+
+def create_station(
+    system: System, tradedangerous_id: int = None, name: str = None, **fields
+) -> Station:
+    values = dict(
+        name=name or f"Station {tradedangerous_id}",
+        ls_from_star=100,
+        pad_size="L",
+        modified=T0,
+        system=system,
+        tradedangerous_id=tradedangerous_id,
+    )
+    for flag in (
+        "market",
+        "black_market",
+        "shipyard",
+        "outfitting",
+        "rearm",
+        "refuel",
+        "repair",
+        "planetary",
+        "fleet",
+        "odyssey",
+    ):
+        values[flag] = False
+    values.update(fields)
+    return Station.objects.create(**values)
+
+
+def create_listing(
+    station: Station, commodity: Commodity, modified: datetime.datetime, price=100
+) -> LiveListing:
+    return LiveListing.objects.create(
+        station=station,
+        station_tradedangerous_id=station.tradedangerous_id,
+        commodity=commodity,
+        commodity_tradedangerous_id=commodity.tradedangerous_id,
+        demand_price=price,
+        demand_units=10,
+        supply_price=price,
+        supply_units=10,
+        modified=modified,
+        from_live=False,
+    )
+
+
+class TimestampTests(SimpleTestCase):
+    moment = datetime.datetime(2022, 9, 1, 12, 34, 56, tzinfo=datetime.timezone.utc)
+
+    def test_parse(self):
+        for value in (
+            "2022-09-01 12:34:56",
+            "2022-09-01T12:34:56Z",
+            "2022-09-01T12:34:56.789+00:00",
+            "2022-09-01 12:34:56+00",
+        ):
+            with self.subTest(value=value):
+                self.assertEqual(parse_timestamp(value), self.moment)
+
+    def test_parse_offset(self):
+        for value in (
+            "2022-09-01 14:34:56+02",
+            "2022-09-01T14:34:56.5+02:00",
+            "2022-09-01T10:04:56-0230",
+        ):
+            with self.subTest(value=value):
+                self.assertEqual(parse_timestamp(value), self.moment)
+
+    def test_parse_invalid(self):
+        for value in ("yesterday", "2022-09-01 12:34:56 UTC", "2022-09-01 12:34:56+2"):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_timestamp(value)
+
+    def test_parse_block(self):
+        self.assertEqual(
+            parse_timestamps(["2022-09-01 12:34:56", None, "", "2022-09-01T12:34:56Z"]),
+            [self.moment, None, None, self.moment],
+        )
+
+    def test_format(self):
+        epoch = int(self.moment.timestamp())
+        self.assertEqual(format_timestamp(epoch), "2022-09-01 12:34:56")
+        self.assertEqual(parse_timestamp(format_timestamp(epoch)), self.moment)
+
+
+class MessageSpoolTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def open(self) -> MessageSpool:
+        spool = MessageSpool(self.directory)
+        self.addCleanup(spool.close)
+        return spool
+
+    def segments(self) -> [str]:
+        return sorted(path.name for path in self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def test_recovery(self):
+        spool = self.open()
+        self.assertEqual([spool.append({"n": n}) for n in range(3)], [0, 1, 2])
+        # Out of order acknowledgements do not move the replay start.
+        spool.ack([1])
+        self.assertEqual(spool.pending(), 2)
+        spool.close()
+        spool = self.open()
+        self.assertEqual(
+            list(spool.unacknowledged()), [(n, {"n": n}) for n in range(3)]
+        )
+        # Only the replay start is persisted, so the acknowledgement of 1 was lost.
+        spool.ack([0])
+        spool.close()
+        spool = self.open()
+        self.assertEqual(list(spool.unacknowledged()), [(1, {"n": 1}), (2, {"n": 2})])
+        spool.ack([1, 2])
+        spool.close()
+        spool = self.open()
+        self.assertEqual(list(spool.unacknowledged()), [])
+        self.assertEqual(spool.pending(), 0)
+        self.assertEqual(spool.append({"n": 3}), 3)
+
+    def test_damaged_tail(self):
+        spool = self.open()
+        spool.append({"n": 0})
+        spool.close()
+        with open(self.directory / self.segments()[0], "ab") as fh:
+            fh.write(b'{"n":')
+        with self.assertLogs("EDSite.tools.eddn_spool", "WARNING"):
+            spool = self.open()
+        self.assertEqual(spool.append({"n": 1}), 1)
+        self.assertEqual(list(spool.unacknowledged()), [(0, {"n": 0}), (1, {"n": 1})])
+
+    def test_acknowledged_segments_are_deleted(self):
+        spool = self.open()
+        with mock.patch("EDSite.tools.eddn_spool.SEGMENT_MAX_BYTES", 1):
+            for n in range(4):
+                spool.append({"n": n})
+        self.assertEqual(len(self.segments()), 4)
+        spool.ack([0, 1, 2])
+        self.assertEqual(self.segments(), [f"{3:020d}{SEGMENT_SUFFIX}"])
+        self.assertEqual(list(spool.unacknowledged()), [(3, {"n": 3})])
+
+
+class CronScheduleTests(SimpleTestCase):
+    def next_after(self, expression: str, moment=T0) -> datetime.datetime:
+        return CronSchedule(expression).next_after(moment)
+
+    def test_step(self):
+        moment = T0 + datetime.timedelta(minutes=7, seconds=30)
+        self.assertEqual(self.next_after("*/15 * * * *", moment), T0.replace(minute=15))
+        # The next run is strictly after the given moment.
+        self.assertEqual(
+            self.next_after("*/15 * * * *", T0.replace(minute=15)),
+            T0.replace(minute=30),
+        )
+
+    def test_daily(self):
+        self.assertEqual(
+            self.next_after("30 4 * * *", T0.replace(hour=5)),
+            datetime.datetime(2022, 9, 2, 4, 30, tzinfo=UTC),
+        )
+
+    def test_day_of_month_or_week(self):
+        # 2022-09-01 is a Thursday.
+        self.assertEqual(self.next_after("0 0 13 * *").day, 13)
+        self.assertEqual(self.next_after("0 0 * * 5").day, 2)
+        # With both restricted, either one matches.
+        runs, moment = [], T0
+        for _ in range(3):
+            moment = self.next_after("0 0 13 * 5", moment)
+            runs.append(moment.day)
+        self.assertEqual(runs, [2, 9, 13])
+
+    def test_sunday(self):
+        for expression in ("0 0 * * 0", "0 0 * * 7"):
+            with self.subTest(expression=expression):
+                self.assertEqual(
+                    self.next_after(expression),
+                    datetime.datetime(2022, 9, 4, tzinfo=UTC),
+                )
+
+    def test_leap_day(self):
+        self.assertEqual(
+            self.next_after("0 12 29 2 *"),
+            datetime.datetime(2024, 2, 29, 12, tzinfo=UTC),
+        )
+
+    def test_never_matches(self):
+        with self.assertRaises(ValueError):
+            self.next_after("0 0 31 2 *")
+
+    def test_invalid(self):
+        for expression in (
+            "* * * *",
+            "60 * * * *",
+            "* * 0 * *",
+            "* * * 13 *",
+            "* * * * 8",
+            "5-1 * * * *",
+            "*/x * * * *",
+        ):
+            with self.subTest(expression=expression), self.assertRaises(ValueError):
+                CronSchedule(expression)
+
+
+class NeighbourBlockTests(SimpleTestCase):
+    jump_range = 15.0
+    neighbours = [(5, 0.0), (7, 1.0), (1000, 14.9999), (1001, 15.0), (1 << 40, 3.3)]
+
+    def test_round_trip(self):
+        block = encode_neighbours(self.neighbours, self.jump_range)
+        system_ids, distances = decode_neighbours(block, self.jump_range)
+        self.assertEqual(
+            list(system_ids), [system_id for system_id, _ in self.neighbours]
+        )
+        step = self.jump_range / DISTANCE_STEPS
+        for (_, distance), decoded in zip(self.neighbours, distances):
+            # Distances are rounded up, so a decoded neighbour is never closer than it is.
+            self.assertGreaterEqual(decoded, distance)
+            self.assertLess(decoded - distance, step)
+        self.assertEqual(distances[0], 0.0)
+        self.assertEqual(distances[3], self.jump_range)
+
+    def test_reencode(self):
+        block = encode_neighbours(self.neighbours, self.jump_range)
+        decoded = list(zip(*decode_neighbours(block, self.jump_range)))
+        self.assertEqual(encode_neighbours(decoded, self.jump_range), block)
+
+    def test_empty(self):
+        self.assertEqual(encode_neighbours([], self.jump_range), b"")
+        self.assertEqual(decode_neighbours(b"", self.jump_range), (array("q"), []))
+
+
+class SystemIndexTests(SimpleTestCase):
+    def setUp(self):
+        generator = random.Random(0)
+        self.points = {
+            system_id: tuple(generator.uniform(-500, 500) for _ in range(3))
+            for system_id in range(1, 3001)
+        }
+        coordinates = SystemCoordinates()
+        for system_id in range(1, 2501):
+            coordinates.insert(system_id, self.points[system_id])
+        # A separate instance rather than the shared one, filled without the database.
+        self.index = SystemIndex.__new__(SystemIndex)
+        self.index.__init__()
+        self.index.coordinates = coordinates
+        self.index.tree = KDTree(coordinates, range(len(coordinates)))
+        self.index.stale = False
+        self.index.built = self.index.refreshed = time.monotonic()
+        # These are searched outside the tree.
+        self.index.add(
+            (system_id, *self.points[system_id]) for system_id in range(2501, 3001)
+        )
+
+    def brute_force(self, origin, max_distance=math.inf) -> [tuple]:
+        return sorted(
+            (distance, system_id)
+            for system_id, distance in (
+                (system_id, math.dist(origin, point))
+                for system_id, point in self.points.items()
+            )
+            if distance <= max_distance
+        )
+
+    def test_nearest(self):
+        for origin in ((0, 0, 0), (480, -490, 10), (2000, 0, 0), self.points[7]):
+            with self.subTest(origin=origin):
+                nearest = self.index.nearest(origin, 50)
+                expected = self.brute_force(origin)[:50]
+                self.assertEqual(
+                    [system_id for _, system_id in nearest],
+                    [system_id for _, system_id in expected],
+                )
+                for (distance, _), (expected_distance, _) in zip(nearest, expected):
+                    self.assertAlmostEqual(distance, expected_distance)
+
+    def test_within(self):
+        origin = (100, 100, -100)
+        self.assertEqual(
+            [system_id for _, system_id in self.index.within(origin, 120)],
+            [system_id for _, system_id in self.brute_force(origin, 120)],
+        )
+
+
+class ScoreListingsTests(SimpleTestCase):
+    def setUp(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        positions = {1: (0, 0, 0), 2: (RANK_HALF_DISTANCE, 0, 0), 3: (0, 0, 0)}
+        self.listings = CommodityListings(
+            [
+                # id, system, supply price and units, demand price and units, pad size,
+                # planetary, fleet carrier, odyssey, modified
+                (10, 1, 100, 1000, 400, 10, "L", 0, 0, 0, now),
+                (11, 2, 200, 10, 800, 1000, "M", 0, 0, 0, now),
+                (
+                    12,
+                    3,
+                    400,
+                    0,
+                    200,
+                    0,
+                    "S",
+                    0,
+                    0,
+                    0,
+                    now - datetime.timedelta(seconds=RANK_HALF_AGE),
+                ),
+                # Without coordinates, so left out.
+                (13, 4, 1, 1, 1, 1, "L", 0, 0, 0, now),
+            ],
+            positions,
+        )
+        self.rows = [0, 1, 2]
+        self.distances = self.listings.distances((0, 0, 0), self.rows)
+
+    def score(self, mode: str, **weights) -> [float]:
+        return score_listings(
+            self.listings,
+            mode,
+            self.rows,
+            self.distances,
+            RankWeights(**{"price": 0, "units": 0, "age": 0, "distance": 0, **weights}),
+        )
+
+    def assertScores(self, scores: [float], expected: [float]):
+        self.assertEqual(len(scores), len(expected))
+        for score, value in zip(scores, expected):
+            self.assertAlmostEqual(score, value, places=3)
+
+    def test_loading(self):
+        self.assertEqual(len(self.listings), 3)
+        self.assertEqual(self.distances, [0.0, RANK_HALF_DISTANCE, 0.0])
+
+    def test_single_terms(self):
+        self.assertScores(self.score(SUPPLY, price=1), [1, 0.5, 0.25])
+        self.assertScores(self.score(DEMAND, price=1), [0.5, 1, 0.25])
+        self.assertScores(
+            self.score(SUPPLY, units=1),
+            [1, math.log1p(10) / math.log1p(1000), 0],
+        )
+        self.assertScores(self.score(SUPPLY, age=1), [1, 1, 0.5])
+        self.assertScores(self.score(SUPPLY, distance=1), [1, 0.5, 1])
+
+    def test_weighted_mean(self):
+        # The weights only count relative to each other.
+        self.assertScores(self.score(SUPPLY, price=3), self.score(SUPPLY, price=1))
+        self.assertScores(
+            self.score(SUPPLY, price=3, distance=1),
+            [
+                (3 * price + distance) / 4
+                for price, distance in ((1, 1), (0.5, 0.5), (0.25, 1))
+            ],
+        )
+        self.assertScores(
+            self.score(DEMAND, price=1, units=1, age=1, distance=1),
+            [
+                (0.5 + math.log1p(10) / math.log1p(1000) + 1 + 1) / 4,
+                (1 + 1 + 1 + 0.5) / 4,
+                (0.25 + 0 + 0.5 + 1) / 4,
+            ],
+        )
+
+    def test_invalid_weights(self):
+        for weights in (
+            {"price": 0, "units": 0, "age": 0, "distance": 0},
+            {"price": -1},
+        ):
+            with self.subTest(weights=weights), self.assertRaises(ValueError):
+                RankWeights(**weights)
+
+
+class StationChunksTests(SimpleTestCase):
+    def blocks(self, station_ids: [int], block_size: int) -> [tuple]:
+        """Blocks of a station id column and a column of row numbers."""
+        rows = list(range(len(station_ids)))
+        return [
+            (station_ids[start : start + block_size], rows[start : start + block_size])
+            for start in range(0, len(station_ids), block_size)
+        ]
+
+    def test_stations_are_not_split(self):
+        generator = random.Random(0)
+        station_ids = sorted(
+            station_id
+            for station_id in range(1, 200)
+            for _ in range(generator.choice((1, 2, 5, 30, 70)))
+        )
+        for block_size, part_size in ((7, 50), (100, 50), (1000, 1), (3, 400)):
+            with self.subTest(block_size=block_size, part_size=part_size):
+                chunks = list(
+                    station_chunks(self.blocks(station_ids, block_size), part_size)
+                )
+                # Nothing is lost or reordered, and the other columns stay aligned.
+                self.assertEqual(
+                    [station_id for chunk in chunks for station_id in chunk[0]],
+                    station_ids,
+                )
+                self.assertEqual(
+                    [row for chunk in chunks for row in chunk[1]],
+                    list(range(len(station_ids))),
+                )
+                for chunk, following in zip(chunks, chunks[1:]):
+                    self.assertLess(chunk[0][-1], following[0][0])
+                    # A chunk is cut before the station that may go on in the next block.
+                    self.assertGreaterEqual(
+                        len(chunk[0]) + following[0].count(following[0][0]), part_size
+                    )
+
+    def test_unsorted(self):
+        for station_ids in ([1, 3, 2, 4], [3, 3, 4, 1]):
+            with self.subTest(station_ids=station_ids), self.assertRaises(ValueError):
+                list(station_chunks(self.blocks(station_ids, 2), 2))
+
+
+class DistanceTests(TestCase):
+    def setUp(self):
+        self.sol = create_system()
+        self.alpha = create_system("Alpha", position=(3, 4, 0))
+        self.beta = create_system("Beta", position=(0, 0, 10))
+        self.gamma = create_system("Gamma", position=(6, 8, 0))
+
+    def names(self, origin, radius=None) -> [str]:
+        queryset = annotate_distance(System.objects.all(), origin, radius)
+        return list(
+            queryset.order_by("distance", "name").values_list("name", flat=True)
+        )
+
+    def test_order(self):
+        self.assertEqual(self.names(self.alpha), ["Alpha", "Gamma", "Sol", "Beta"])
+
+    def test_radius(self):
+        # Systems exactly at the radius are included.
+        self.assertEqual(self.names(self.alpha, 5), ["Alpha", "Gamma", "Sol"])
+        self.assertEqual(self.names(self.alpha, 4.9), ["Alpha"])
+        self.assertEqual(self.names((0, 0, 10), 0), ["Beta"])
+
+    def test_stations(self):
+        create_station(self.alpha, 1)
+        create_station(self.beta, 2)
+        queryset = annotate_distance(
+            Station.objects.all(), self.sol, 5, field="system__"
+        )
+        self.assertEqual(
+            [(station.tradedangerous_id, station.distance) for station in queryset],
+            [(1, 5)],
+        )
+
+    def test_distance_to_sol(self):
+        self.assertEqual(self.alpha.distance_to_sol, 5)
+        self.alpha.pos_z = 12
+        self.alpha.save(update_fields=["pos_z"])
+        self.alpha.refresh_from_db()
+        self.assertEqual(self.alpha.distance_to_sol, 13)
+        # Filtering by radius relies on distance_to_sol being current.
+        self.assertEqual(self.names(self.sol, 13), ["Sol", "Beta", "Gamma", "Alpha"])
+
+
+class MergeSystemsTests(TestCase):
+    def test_link_by_name(self):
+        for name, x, y in [
+            ("Sol", 0, 0),
+            ("Dup", 10, 0),
+            ("Dup", 20, 0),
+            ("Twin", 5, 5),
+            ("Twin", 5, 5),
+        ]:
+            System.objects.create(name=name, pos_x=x, pos_y=y, pos_z=0)
+        importer = GalaxyDumpImporter()
+        importer._create_dump_tables()
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {DUMP_SYSTEM_TABLE} VALUES (%s, %s, %s, %s, 0, NULL)",
+                [
+                    (1, "Sol", 0, 0),
+                    (2, "Dup", 10, 0),
+                    (3, "Dup", 20, 0.01),
+                    (4, "Twin", 5, 5),
+                    (5, "New", 1, 1),
+                ],
+            )
+        result = importer.merge_systems()
+        self.assertEqual((result.created, result.updated, result.ambiguous), (1, 1, 1))
+        self.assertEqual(
+            sorted(System.objects.values_list("name", "pos_x", "id64")),
+            [
+                ("Dup", 10, 2),
+                ("Dup", 20, 3),
+                ("New", 1, 5),
+                ("Sol", 0, 1),
+                ("Twin", 5, None),
+                ("Twin", 5, None),
+            ],
+        )
+
+
+class CsvEncodingTests(SimpleTestCase):
+    def test_values(self):
+        for value, encoded in [
+            (None, ""),
+            ("", '""'),
+            (True, "t"),
+            (False, "f"),
+            (0, "0"),
+            (-12, "-12"),
+            ('say "hi"', '"say ""hi"""'),
+            ("a,b\nc", '"a,b\nc"'),
+            (datetime.datetime(2022, 9, 1, 12, 34, 56), "2022-09-01T12:34:56"),
+        ]:
+            with self.subTest(value=value):
+                self.assertEqual(_csv_value(value), encoded)
+
+    def test_stream(self):
+        rows = [(1, "a", None), (2, 'b"', True)]
+        stream = RowStream(iter(rows))
+        data = b""
+        while chunk := stream.read(3):
+            data += chunk
+        self.assertEqual(data, b'1,"a",\n2,"b""",t\n')
+        self.assertEqual(stream.row_count, 2)
+        self.assertEqual(RowStream(iter(rows)).read(), data)
+
+
+class InsertRowsTests(TestCase):
+    table = "edsite_test_rows"
+    columns = ("number", "text", "flag")
+    rows = [
+        (1, None, None),
+        (2, "", True),
+        (3, 'quoted "name", with a comma', False),
+        (4, "two\nlines\\", None),
+    ]
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {self.table} (number integer, text text, flag boolean)"
+            )
+
+    def select(self) -> [tuple]:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT number, text, flag FROM {self.table} ORDER BY number"
+            )
+            return cursor.fetchall()
+
+    def test_copy(self):
+        self.assertEqual(copy_rows(self.table, self.columns, iter(self.rows)), 4)
+        self.assertEqual(self.select(), self.rows)
+
+    def test_fallback_streams_batches(self):
+        def rows():
+            for index, row in enumerate(self.rows):
+                # Every batch is written before the next one is read.
+                if index % 2 == 0:
+                    self.assertEqual(len(self.select()), index)
+                yield row
+
+        with mock.patch("EDSite.tools.bulk.supports_copy", return_value=False):
+            self.assertEqual(
+                insert_rows(self.table, self.columns, rows(), batch_size=2), 4
+            )
+        self.assertEqual(self.select(), self.rows)
+
+
+class ListingsStagingTests(TestCase):
+    def setUp(self):
+        system = create_system()
+        self.stations = {td_id: create_station(system, td_id) for td_id in (1, 2, 5)}
+        self.commodities = {td_id: create_commodity(td_id) for td_id in (1, 2, 3, 4)}
+        self.listing(1, 1, 0)
+        self.listing(1, 2, 0)
+        # Written by the live listener while the import ran.
+        self.listing(1, 4, 2)
+        self.listing(2, 1, 3)
+        self.listing(2, 2, 0)
+        self.listing(5, 1, 0)
+
+    def listing(self, station: int, commodity: int, modified: int) -> LiveListing:
+        return create_listing(
+            self.stations[station], self.commodities[commodity], hours(modified)
+        )
+
+    def listings(self) -> {tuple: tuple}:
+        return {
+            (station, commodity): (supply_price, modified)
+            for station, commodity, supply_price, modified in LiveListing.objects.values_list(
+                "station__tradedangerous_id",
+                "commodity__tradedangerous_id",
+                "supply_price",
+                "modified",
+            )
+        }
+
+    def merge(self, **options):
+        staging = ListingsStaging()
+        self.addCleanup(staging.drop)
+        rows = [
+            (1, 1, 200, 10, 200, 10, td_timestamp(1), False),
+            (1, 3, 100, 10, 100, 10, td_timestamp(1), False),
+            # Unknown station.
+            (9, 1, 100, 10, 100, 10, td_timestamp(1), False),
+        ]
+        return staging.merge_chunk(rows, 1, 2, **options)
+
+    def test_delete_missing(self):
+        result = self.merge(delete_missing=True)
+        self.assertEqual(
+            (result.staged, result.unknown, result.created, result.updated),
+            (3, 1, 1, 1),
+        )
+        self.assertEqual((result.historic, result.deleted), (1, 2))
+        # The listings of the range that were not staged are gone, unless they are newer than
+        # the staged rows or outside of the range.
+        self.assertEqual(
+            self.listings(),
+            {
+                (1, 1): (200, hours(1)),
+                (1, 3): (100, hours(1)),
+                (1, 4): (100, hours(2)),
+                (2, 1): (100, hours(3)),
+                (5, 1): (100, hours(0)),
+            },
+        )
+        self.assertEqual(
+            list(HistoricListing.objects.values_list("supply_price", "datetime")),
+            [(100, hours(0))],
+        )
+
+    def test_delete_replaced(self):
+        result = self.merge(delete_missing=False, delete_replaced=True)
+        self.assertEqual((result.created, result.updated, result.deleted), (1, 1, 1))
+        # Only the older listings of the staged markets are replaced.
+        self.assertEqual(
+            self.listings(),
+            {
+                (1, 1): (200, hours(1)),
+                (1, 3): (100, hours(1)),
+                (1, 4): (100, hours(2)),
+                (2, 1): (100, hours(3)),
+                (2, 2): (100, hours(0)),
+                (5, 1): (100, hours(0)),
+            },
+        )
+
+    def test_keep_missing(self):
+        result = self.merge(delete_missing=False)
+        self.assertEqual(result.deleted, 0)
+        self.assertEqual(LiveListing.objects.count(), 7)
+
+
+class UpsertStationListingsTests(TestCase):
+    def setUp(self):
+        self.station = create_station(create_system(), 1)
+        self.commodities = {td_id: create_commodity(td_id) for td_id in (1, 2, 3, 4)}
+        create_listing(self.station, self.commodities[1], hours(2))
+        create_listing(self.station, self.commodities[2], hours(0))
+        create_listing(self.station, self.commodities[3], hours(0))
+
+    def message(self, modified: int, prices: {int: int}) -> [LiveListing]:
+        return [
+            LiveListing(
+                commodity_id=self.commodities[td_id].id,
+                commodity_tradedangerous_id=td_id,
+                demand_price=price,
+                demand_units=10,
+                supply_price=price,
+                supply_units=10,
+                modified=hours(modified),
+                from_live=True,
+            )
+            for td_id, price in prices.items()
+        ]
+
+    def prices(self) -> {int: tuple}:
+        return {
+            td_id: (price, modified)
+            for td_id, price, modified in self.station.listings.values_list(
+                "commodity__tradedangerous_id", "supply_price", "modified"
+            )
+        }
+
+    def test_upsert(self):
+        result = upsert_station_listings(
+            self.station, self.message(1, {1: 500, 2: 300, 4: 200})
+        )
+        self.assertEqual(
+            (result.created, result.updated, result.historic, result.deleted),
+            (1, 1, 1, 1),
+        )
+        # The newer listing is kept, and the one the market no longer has is deleted.
+        self.assertEqual(
+            self.prices(),
+            {1: (100, hours(2)), 2: (300, hours(1)), 4: (200, hours(1))},
+        )
+
+    def test_replayed_message(self):
+        message = self.message(1, {2: 300})
+        upsert_station_listings(self.station, message)
+        result = upsert_station_listings(self.station, message)
+        self.assertEqual(
+            (result.created, result.updated, result.historic, result.deleted),
+            (0, 0, 0, 0),
+        )
+        self.assertEqual(HistoricListing.objects.count(), 1)
+
+
+class TradeDangerousListingsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.td_path = Path(directory.name) / "TradeDangerous.db"
+        with contextlib.closing(sqlite3.connect(self.td_path)) as td_db, td_db:
+            td_db.execute(
+                "CREATE TABLE StationItem (station_id, item_id, demand_price, demand_units, "
+                "supply_price, supply_units, modified, from_live)"
+            )
+        self.station = create_station(create_system(), 1)
+        self.commodities = {td_id: create_commodity(td_id) for td_id in (1, 2)}
+        self.watermark = ImportWatermark.for_source(TD_WATERMARK_SOURCE)
+
+    def add_td_listing(self, item_id: int, modified: int, price=100):
+        with contextlib.closing(sqlite3.connect(self.td_path)) as td_db, td_db:
+            td_db.execute(
+                "INSERT INTO StationItem VALUES (1, ?, ?, 10, ?, 10, ?, 0)",
+                [item_id, price, price, td_timestamp(modified)],
+            )
+
+    def update(self, **options):
+        """Run the listings import on the TradeDangerous database of the test, quietly."""
+        td_db = open_td_database(str(self.td_path))
+        session = TradeDBSession()
+        session._tdb = SimpleNamespace(
+            conn=td_db, dbFilename=str(self.td_path), close=td_db.close
+        )
+        # The import does not use the caches that EDData() loads.
+        data = EDData.__new__(EDData)
+        with session, contextlib.redirect_stdout(
+            io.StringIO()
+        ), contextlib.redirect_stderr(io.StringIO()):
+            data.update_local_listings2(session, workers=1, **options)
+        self.watermark.refresh_from_db()
+
+    def test_advance(self):
+        self.add_td_listing(1, 1)
+        self.update()
+        self.assertEqual(self.watermark.modified, hours(1))
+        reconciled = self.watermark.reconciled
+        self.assertIsNotNone(reconciled)
+        self.add_td_listing(2, 2)
+        self.update(full_update=False)
+        self.assertEqual(self.watermark.modified, hours(2))
+        # Only a full import reconciles.
+        self.assertEqual(self.watermark.reconciled, reconciled)
+        self.assertEqual(
+            set(
+                self.station.listings.values_list(
+                    "commodity__tradedangerous_id", flat=True
+                )
+            ),
+            {1, 2},
+        )
+
+    def test_failed_import(self):
+        self.add_td_listing(1, 1)
+        self.update()
+        # Prices may not be NULL, so COPY fails on this listing.
+        self.add_td_listing(2, 2, price=None)
+        with self.assertRaises(psycopg2.IntegrityError):
+            self.update(full_update=False)
+        self.assertEqual(self.watermark.modified, hours(1))
+        self.assertFalse(
+            self.station.listings.filter(commodity__tradedangerous_id=2).exists()
+        )
+
+
+class StationsStagingTests(TestCase):
+    def setUp(self):
+        self.system = create_system(tradedangerous_id=10)
+        self.updated = create_station(self.system, 1, "Alpha")
+        self.stale = create_station(self.system, 2)
+        # Stations of the live listener or a galaxy dump have no TradeDangerous id.
+        self.live = create_station(self.system, None, "Live")
+        self.carrier = create_station(self.system, 3, "ABC-123", fleet=True)
+        create_listing(self.carrier, create_commodity(1), T0)
+
+    def sync(self, rows: [tuple]):
+        staging = StationsStaging()
+        self.addCleanup(staging.drop)
+        return staging.sync(rows)
+
+    @staticmethod
+    def td_station(
+        td_id: int, name: str, system_td_id=10, type_id=0, modified=1
+    ) -> tuple:
+        return (
+            td_id,
+            name,
+            system_td_id,
+            500,
+            "N",
+            "M",
+            "Y",
+            "N",
+            td_timestamp(modified),
+            "Y",
+            "N",
+            "Y",
+            "Y",
+            "N",
+            type_id,
+        )
+
+    def test_sync(self):
+        result = self.sync(
+            [
+                self.td_station(1, "Alpha Port"),
+                # The carrier got a new TradeDangerous id.
+                self.td_station(7, "ABC-123", type_id=TD_FLEET_TYPE_ID),
+                self.td_station(4, "New Port"),
+                self.td_station(5, "Lost Port", system_td_id=99),
+            ]
+        )
+        self.assertEqual((result.staged, result.unknown), (4, 1))
+        self.assertEqual(
+            (result.renamed, result.updated, result.created, result.deleted),
+            (1, 2, 1, 1),
+        )
+        self.assertEqual(
+            sorted(
+                Station.objects.values_list("name", "tradedangerous_id", "pad_size")
+            ),
+            [
+                ("ABC-123", 7, "M"),
+                ("Alpha Port", 1, "M"),
+                ("Live", None, "L"),
+                ("New Port", 4, "M"),
+            ],
+        )
+        self.carrier.refresh_from_db()
+        self.assertEqual(self.carrier.tradedangerous_id, 7)
+        self.assertEqual(self.carrier.modified, hours(1))
+        self.assertEqual(
+            list(
+                self.carrier.listings.values_list(
+                    "station_tradedangerous_id", flat=True
+                )
+            ),
+            [7],
+        )
+
+    def test_older_rows_are_ignored(self):
+        result = self.sync([self.td_station(1, "Alpha Port", modified=-1)])
+        self.assertEqual(result.updated, 0)
+        self.updated.refresh_from_db()
+        self.assertEqual(self.updated.name, "Alpha")
+
+    def test_empty_database(self):
+        result = self.sync([])
+        self.assertEqual(result.deleted, 0)
+        self.assertEqual(Station.objects.count(), 4)
+
+
+class CommoditiesTests(TestCase):
+    def setUp(self):
+        create_commodity(1)
+        metals = tradedb.Category(1, "Metals", [])
+        minerals = tradedb.Category(2, "Minerals", [])
+        items = [
+            tradedb.Item(1, "Gold", metals, "Gold", 150, 1),
+            tradedb.Item(2, "Bauxite", minerals, "Bauxite", 120, 2),
+            # The game id of Gold.
+            tradedb.Item(3, "Silver", metals, "Silver", 4700, 1),
+            tradedb.Item(4, "Painite", minerals, "Painite", None, 4),
+        ]
+        rare = tradedb.RareItem(
+            1, None, "Lavian Brandy", 4000, 12, "N", "N", minerals, "Lavian Brandy"
+        )
+        self.session = SimpleNamespace(
+            tdb=SimpleNamespace(
+                categories=lambda: iter({1: metals, 2: minerals}.items()),
+                items=lambda: iter(items),
+                rareItemByID={1: rare},
+            )
+        )
+
+    def update(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            EDData.__new__(EDData).update_local_commodities(self.session)
+
+    def test_update(self):
+        self.update()
+        self.assertEqual(
+            sorted(CommodityCategory.objects.values_list("tradedangerous_id", "name")),
+            [(1, "Metals"), (2, "Minerals")],
+        )
+        self.assertEqual(
+            sorted(
+                Commodity.objects.values_list(
+                    "tradedangerous_id", "game_id", "category__name", "average_price"
+                )
+            ),
+            [(1, 1, "Metals", 150), (2, 2, "Minerals", 120), (4, 4, "Minerals", -1)],
+        )
+        self.assertEqual(
+            list(Rare.objects.values_list("name", "category__name", "cost")),
+            [("Lavian Brandy", "Minerals", 4000)],
+        )
+
+    def test_unchanged(self):
+        self.update()
+        # One query for each of the categories, the commodities and the rares.
+        with self.assertNumQueries(3):
+            self.update()
+        self.assertEqual(Rare.objects.count(), 1)
+
+
+class ImportProgressTests(TestCase):
+    options = {"full": True}
+
+    def start(self, options=None, **kwargs) -> ImportProgress:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return ImportProgress.start(options or self.options, **kwargs)
+
+    def interrupted(self) -> ImportProgress:
+        progress = self.start()
+        with progress.stage("systems"):
+            pass
+        with self.assertRaises(RuntimeError), progress.stage("listings"):
+            progress.checkpoint("listings", "a")
+            raise RuntimeError("Interrupted")
+        progress.fail(RuntimeError("Interrupted"))
+        return progress
+
+    def test_resume(self):
+        run = self.interrupted().run
+        progress = self.start()
+        self.assertEqual(progress.run.id, run.id)
+        self.assertEqual(progress.run.status, ImportRunStatus.RUNNING)
+        self.assertTrue(progress.is_done("systems"))
+        self.assertTrue(progress.is_done("listings", "a"))
+        self.assertFalse(progress.is_done("listings", "b"))
+        # The failed stage was not checkpointed.
+        self.assertFalse(progress.is_done("listings"))
+
+    def test_new_run(self):
+        for kwargs in ({"options": {"full": False}}, {"resume": False}):
+            with self.subTest(**kwargs):
+                run = self.interrupted().run
+                progress = self.start(**kwargs)
+                self.assertNotEqual(progress.run.id, run.id)
+                self.assertFalse(progress.is_done("systems"))
+                run.refresh_from_db()
+                self.assertEqual(run.status, ImportRunStatus.ABANDONED)
+
+    def test_expired(self):
+        run = self.interrupted().run
+        ImportRun.objects.filter(id=run.id).update(updated=T0)
+        self.assertNotEqual(self.start().run.id, run.id)
+
+    def test_skip_checkpointed_chunks(self):
+        system = create_system()
+        for td_id in (1, 2):
+            create_station(system, td_id)
+        create_commodity(1)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / "listings.csv"
+        collected_at = int(hours(1).timestamp())
+        path.write_text(
+            "id,station_id,commodity_id,supply,supply_bracket,buy_price,sell_price,demand,"
+            "demand_bracket,collected_at\n"
+            f"1,1,1,10,1,100,90,0,0,{collected_at}\n"
+            f"2,2,1,10,1,100,90,0,0,{collected_at}\n"
+        )
+        progress = self.start()
+        progress.checkpoint("listings", "listings.csv:1-1")
+        result, newest = merge_listings_file(path, part_size=1, progress=progress)
+        self.assertEqual((result.staged, result.created, newest), (1, 1, hours(1)))
+        self.assertEqual(
+            list(
+                LiveListing.objects.values_list("station__tradedangerous_id", flat=True)
+            ),
+            [2],
+        )
+        self.assertTrue(progress.is_done("listings", "listings.csv:2-2"))
@@ -0,0 +1,902 @@
+import datetime
+import math
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.forms.models import model_to_dict
+from django.test import Client
+
+from EDSite.helpers import make_timezone_aware, difference_percent, chunks
+from EDSite.models import (
+    Station,
+    Commodity,
+    CommodityCategory,
+    LiveListing,
+    HistoricListing,
+    System,
+)
+from EDSite.tools.bulk import insert_rows
+from EDSite.tools.carrier_routes import (
+    COST_FUEL,
+    COST_JUMPS,
+    MAX_CARRIER_JUMP,
+    plan_carrier_route,
+)
+from EDSite.tools.jump_graph import (
+    JumpGraph,
+    build_jump_graph,
+    graph_path,
+    update_jump_graph,
+)
+from EDSite.tools.listing_index import DEMAND, ListingIndex, RankWeights
+from EDSite.tools.listings_merge import ListingsStaging
+from EDSite.tools.spatial import SystemIndex, annotate_distance
+from EDSite.tools.trade_routes import (
+    ORDER_PROFIT,
+    ORDER_PROFIT_PER_LY,
+    StationMarkets,
+    find_trade_loops,
+    find_trade_routes,
+)
+from EDSite.tools.timestamps import (
+    TD_TIMESTAMP_FORMAT,
+    parse_timestamp,
+    parse_timestamps,
+)
+from EDSiteProject import settings
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+class StatementCounter:
+    """Execute wrapper that counts the SQL statements sent over a connection."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class BenchmarkRollback(Exception):
+    """Raised to undo everything a benchmark wrote to the database."""
+
+
+def measure(func, setup=None) -> (float, int):
+    """
+    Run setup and func inside a transaction that is always rolled back. Only func is measured.
+    :return: The wall time in seconds and the number of SQL statements.
+    """
+    try:
+        with transaction.atomic():
+            if setup:
+                setup()
+            counter = StatementCounter()
+            with connection.execute_wrapper(counter):
+                t0 = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - t0
+            raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    return elapsed, counter.count
+
+
+def synthetic_td_listings(stations: [Station], commodities: [Commodity], seed=0):
+    """Rows in the layout of TradeDangerous' StationItem table."""
+    rng = random.Random(seed)
+    modified = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        (
+            station.tradedangerous_id,
+            commodity.tradedangerous_id,
+            rng.randint(0, 10000),
+            rng.randint(0, 10000),
+            rng.randint(0, 10000),
+            rng.randint(0, 10000),
+            modified,
+            0,
+        )
+        for station in stations
+        for commodity in commodities
+    ]
+
+
+def seed_existing_listings(td_rows, stations, commodities):
+    """Create live listings for every other row, with an older timestamp so that they all need updating."""
+    stations = {station.tradedangerous_id: station for station in stations}
+    commodities = {commodity.tradedangerous_id: commodity for commodity in commodities}
+    modified = make_timezone_aware(
+        datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    )
+    LiveListing.objects.bulk_create(
+        [
+            LiveListing(
+                commodity_id=commodities[item_td_id].id,
+                commodity_tradedangerous_id=item_td_id,
+                station_id=stations[station_td_id].id,
+                station_tradedangerous_id=station_td_id,
+                demand_price=demand_price + 1000,
+                demand_units=demand_units,
+                supply_price=supply_price,
+                supply_units=supply_units,
+                modified=modified,
+                from_live=False,
+            )
+            for station_td_id, item_td_id, demand_price, demand_units, supply_price, supply_units, _, _ in td_rows[
+                ::2
+            ]
+        ]
+    )
+
+
+def legacy_merge(td_rows, min_station_td_id, max_station_td_id):
+    """The per-row merge that update_local_listings2 used before the staging table."""
+    stations = {
+        station.tradedangerous_id: station
+        for station in Station.objects.only("id", "fleet", "tradedangerous_id")
+    }
+    commodities = {
+        commodity.tradedangerous_id: commodity.id
+        for commodity in Commodity.objects.only("id", "tradedangerous_id")
+    }
+    existing_live_listings = {
+        (ll.station_id, ll.commodity_id): ll
+        for ll in LiveListing.objects.filter(
+            Q(station_tradedangerous_id__gte=min_station_td_id)
+            & Q(station_tradedangerous_id__lte=max_station_td_id)
+        )
+    }
+    visited, new_listings, new_historic, updated, deleted = set(), [], [], [], []
+    for (
+        station_td_id,
+        item_td_id,
+        demand_price,
+        demand_units,
+        supply_price,
+        supply_units,
+        modified_str,
+        from_live,
+    ) in td_rows:
+        modified = make_timezone_aware(
+            datetime.datetime.strptime(modified_str, "%Y-%m-%d %H:%M:%S")
+        )
+        station = stations[station_td_id]
+        com_id = commodities[item_td_id]
+        visited.add((station.id, com_id))
+        existing = existing_live_listings.get((station.id, com_id))
+        if existing:
+            if modified != existing.modified:
+                if not station.fleet and (
+                    difference_percent(existing.demand_price, demand_price)
+                    > settings.HISTORIC_DIFFERENCE_DELTA
+                    or difference_percent(existing.supply_price, supply_price)
+                    > settings.HISTORIC_DIFFERENCE_DELTA
+                ):
+                    new_historic.append(HistoricListing.from_live(existing))
+                existing.demand_price = demand_price
+                existing.demand_units = demand_units
+                existing.supply_price = supply_price
+                existing.supply_units = supply_units
+                existing.modified = modified
+                updated.append(existing)
+        else:
+            new_listings.append(
+                LiveListing(
+                    commodity_id=com_id,
+                    commodity_tradedangerous_id=item_td_id,
+                    station_id=station.id,
+                    station_tradedangerous_id=station_td_id,
+                    demand_price=demand_price,
+                    demand_units=demand_units,
+                    supply_price=supply_price,
+                    supply_units=supply_units,
+                    modified=modified,
+                    from_live=from_live,
+                )
+            )
+    for key, existing in existing_live_listings.items():
+        if key not in visited:
+            deleted.append(existing.id)
+    LiveListing.objects.bulk_create(new_listings)
+    HistoricListing.objects.bulk_create(new_historic)
+    for chunk in chunks(updated, 20000):
+        with transaction.atomic():
+            for ll in chunk:
+                LiveListing.objects.filter(id=ll.id).update(**model_to_dict(ll))
+    for chunk in chunks(deleted, 10000):
+        LiveListing.objects.filter(pk__in=chunk).delete()
+
+
+@benchmark("listings_merge")
+def benchmark_listings_merge(size=20000):
+    """Per-row listings merge versus the staging table merge."""
+    commodities = list(Commodity.objects.all())
+    if not commodities:
+        return "The database has no commodities. Import some data first."
+    stations = list(
+        Station.objects.filter(tradedangerous_id__isnull=False).order_by(
+            "tradedangerous_id"
+        )[: max(1, size // len(commodities))]
+    )
+    td_rows = synthetic_td_listings(stations, commodities)
+    min_td_id, max_td_id = stations[0].tradedangerous_id, stations[-1].tradedangerous_id
+
+    def staging_merge():
+        staging = ListingsStaging()
+        staging.merge_chunk(iter(td_rows), min_td_id, max_td_id)
+        staging.drop()
+
+    results = [f"{len(td_rows)} listings, {len(td_rows[::2])} already existing."]
+    # COPY does not go through execute(), so it is added to the statement count by hand.
+    for name, merge, copies in [
+        ("per-row", lambda: legacy_merge(td_rows, min_td_id, max_td_id), 0),
+        ("staging", staging_merge, 1),
+    ]:
+        elapsed, statements = measure(
+            merge, setup=lambda: seed_existing_listings(td_rows, stations, commodities)
+        )
+        results.append(
+            f"{name:>10}: {elapsed:8.3f} s, {statements + copies} statements"
+        )
+    return "\n".join(results)
+
+
+@benchmark("timestamps")
+def benchmark_timestamps(size=1000000):
+    """Per-row strptime versus the memoised and the block timestamp parsers."""
+    # Like StationItem: every market shares one timestamp between its ~40 listings.
+    rng = random.Random(0)
+    start = datetime.datetime(2022, 1, 1)
+    values = []
+    while len(values) < size:
+        modified = start + datetime.timedelta(seconds=rng.randint(0, 3600 * 24 * 365))
+        values.extend([modified.strftime(TD_TIMESTAMP_FORMAT)] * 40)
+    values = values[:size]
+
+    def per_row():
+        return [
+            make_timezone_aware(datetime.datetime.strptime(value, TD_TIMESTAMP_FORMAT))
+            for value in values
+        ]
+
+    def memoised():
+        parse_timestamp.cache_clear()
+        return [parse_timestamp(value) for value in values]
+
+    def block():
+        return parse_timestamps(values)
+
+    results = [f"{size} timestamps, {len(set(values))} distinct."]
+    expected, baseline = None, None
+    for name, parse in [
+        ("strptime", per_row),
+        ("memoised", memoised),
+        ("block", block),
+    ]:
+        t0 = time.perf_counter()
+        parsed = parse()
+        elapsed = time.perf_counter() - t0
+        if expected is None:
+            expected, baseline = parsed, elapsed
+        elif parsed != expected:
+            return f"{name} does not match strptime."
+        results.append(f"{name:>10}: {elapsed:8.3f} s, {baseline / elapsed:6.1f}x")
+    return "\n".join(results)
+
+
+@benchmark("distance_sort")
+def benchmark_distance_sort(size=100000):
+    """Per-pair System.distance_to versus the batched distances of the SystemIndex."""
+    systems = {system.id: system for system in System.objects.all()}
+    if not systems:
+        return "The database has no systems. Import some data first."
+    rng = random.Random(0)
+    system_ids = list(systems)
+    # Stand-ins for stations, spread over the known systems.
+    stations = [
+        SimpleNamespace(id=station_id, system_id=rng.choice(system_ids))
+        for station_id in range(size)
+    ]
+    reference = systems[rng.choice(system_ids)]
+    index = SystemIndex()
+    index.refresh()
+
+    def legacy_distance(system, other):
+        """System.distance_to before it used math.dist."""
+        dX = system.pos_x - other.pos_x
+        dY = system.pos_y - other.pos_y
+        dZ = system.pos_z - other.pos_z
+        return ((dX**2) + (dY**2) + (dZ**2)) ** 0.5
+
+    def per_pair():
+        distances = {
+            station.id: legacy_distance(systems[station.system_id], reference)
+            for station in stations
+        }
+        return sorted(stations, key=lambda station: distances[station.id])
+
+    def batched():
+        return index.sort_by_distance(reference, stations)[0]
+
+    results = [f"{size} stations in {len(systems)} systems."]
+    expected, baseline = None, None
+    for name, sort in [("per-pair", per_pair), ("batched", batched)]:
+        t0 = time.perf_counter()
+        ordered = sort()
+        elapsed = time.perf_counter() - t0
+        system_ids = [station.system_id for station in ordered]
+        if expected is None:
+            expected, baseline = system_ids, elapsed
+        elif system_ids != expected:
+            return f"{name} does not match per-pair."
+        results.append(f"{name:>10}: {elapsed:8.3f} s, {baseline / elapsed:6.1f}x")
+    return "\n".join(results)
+
+
+def seed_systems(count: int, seed=0):
+    """Systems scattered like the populated bubble: dense around Sol, thinning out with distance."""
+    rng = random.Random(seed)
+    rows = []
+    for number in range(count):
+        x, y, z = rng.gauss(0, 2000), rng.gauss(0, 300), rng.gauss(0, 2000)
+        rows.append((f"Benchmark {number}", x, y, z, (x * x + y * y + z * z) ** 0.5))
+    insert_rows(
+        System._meta.db_table,
+        ("name", "pos_x", "pos_y", "pos_z", "distance_to_sol"),
+        rows,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(f"ANALYZE {connection.ops.quote_name(System._meta.db_table)}")
+
+
+def latencies(timings: [float]) -> str:
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return f"p50 {timings[len(timings) // 2] * 1000:8.3f} ms, p95 {p95 * 1000:8.3f} ms"
+
+
+@benchmark("geo_queries")
+def benchmark_geo_queries(size=100000, queries=50):
+    """Latency of the near, radius and order=distance API queries with size systems."""
+    client = Client()
+    results = []
+    try:
+        with transaction.atomic():
+            if System.objects.count() < size:
+                seed_systems(size - System.objects.count())
+            index = SystemIndex()
+            index.invalidate()
+            t0 = time.perf_counter()
+            index.refresh()
+            results.append(
+                f"{len(index)} systems, index built in {time.perf_counter() - t0:.3f} s."
+            )
+            rng = random.Random(0)
+            references = rng.sample(
+                list(System.objects.values_list("id", "pos_x", "pos_y", "pos_z")),
+                queries,
+            )
+
+            def api(url):
+                def query(reference, point):
+                    response = client.get(url.format(reference))
+                    if response.status_code != 200:
+                        raise RuntimeError(f"{url}: {response.status_code}")
+
+                return query
+
+            for name, query in [
+                (
+                    "nearest 50 (index)",
+                    lambda reference, point: index.nearest(point, 50),
+                ),
+                (
+                    "nearest 50 (SQL sort)",
+                    lambda reference, point: list(
+                        annotate_distance(System.objects.all(), point).order_by(
+                            "distance"
+                        )[:50]
+                    ),
+                ),
+                ("systems order=distance", api("/api/systems/?near={}&order=distance")),
+                (
+                    "systems radius=50",
+                    api("/api/systems/?near={}&radius=50&order=distance"),
+                ),
+                (
+                    "stations radius=50",
+                    api("/api/stations/?near={}&radius=50&order=distance"),
+                ),
+                (
+                    "stations order=distance",
+                    api("/api/stations/?near={}&order=distance"),
+                ),
+                (
+                    "listings radius=50",
+                    api("/api/listings/?near={}&radius=50&type=supply"),
+                ),
+            ]:
+                timings = []
+                for reference, *point in references:
+                    t0 = time.perf_counter()
+                    query(reference, point)
+                    timings.append(time.perf_counter() - t0)
+                results.append(f"{name:>24}: {latencies(timings)}")
+            raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    finally:
+        # The index must not keep the systems that were rolled back.
+        SystemIndex().invalidate()
+    return "\n".join(results)
+
+
+def seed_markets(stations: int, commodities=300, listings=60, seed=0) -> [int]:
+    """
+    Systems with one station each, packed like the populated bubble around Sol. Every station lists
+    listings random commodities, either supplying them below their base price or demanding them above.
+    :return: The ids of the seeded systems.
+    """
+    rng = random.Random(seed)
+    category = CommodityCategory.objects.create(
+        name="Benchmark", tradedangerous_id=10**9
+    )
+    base_prices = {
+        commodity.id: commodity.average_price
+        for commodity in Commodity.objects.bulk_create(
+            Commodity(
+                name=f"Benchmark {number}",
+                category=category,
+                average_price=rng.randint(100, 10000),
+                game_id=10**9 + number,
+                tradedangerous_id=10**9 + number,
+            )
+            for number in range(commodities)
+        )
+    }
+    first_system_id = System.objects.order_by("-id").values_list("id", flat=True)[0]
+    system_rows = []
+    for number in range(stations):
+        x, y, z = rng.gauss(0, 100), rng.gauss(0, 30), rng.gauss(0, 100)
+        system_rows.append(
+            (f"Benchmark market {number}", x, y, z, (x * x + y * y + z * z) ** 0.5)
+        )
+    insert_rows(
+        System._meta.db_table,
+        ("name", "pos_x", "pos_y", "pos_z", "distance_to_sol"),
+        system_rows,
+    )
+    system_ids = list(
+        System.objects.filter(id__gt=first_system_id).values_list("id", flat=True)
+    )
+    modified = make_timezone_aware(datetime.datetime.utcnow())
+    insert_rows(
+        Station._meta.db_table,
+        ("name", "ls_from_star", "pad_size", "modified", "market", "black_market")
+        + ("shipyard", "outfitting", "rearm", "refuel", "repair", "planetary")
+        + ("fleet", "odyssey", "system_id"),
+        (
+            (f"Benchmark market {system_id}", rng.randint(10, 5000), "L", modified)
+            + (True,) * 7
+            + (False, False, False, system_id)
+            for system_id in system_ids
+        ),
+    )
+    listing_rows = []
+    for station_id in Station.objects.filter(system_id__in=system_ids).values_list(
+        "id", flat=True
+    ):
+        for commodity_id in rng.sample(list(base_prices), listings):
+            price = base_prices[commodity_id]
+            if rng.random() < 0.5:
+                supply = (int(price * rng.uniform(0.6, 1.0)), rng.randint(1, 20000))
+                demand = (0, 0)
+            else:
+                supply = (0, 0)
+                demand = (int(price * rng.uniform(0.9, 1.4)), rng.randint(1, 20000))
+            listing_rows.append(
+                (commodity_id, 0, station_id, *demand, *supply, modified, False)
+            )
+    insert_rows(
+        LiveListing._meta.db_table,
+        ("commodity_id", "commodity_tradedangerous_id", "station_id")
+        + ("demand_price", "demand_units", "supply_price", "supply_units")
+        + ("modified", "from_live"),
+        listing_rows,
+    )
+    with connection.cursor() as cursor:
+        for model in (System, Station, LiveListing):
+            cursor.execute(f"ANALYZE {connection.ops.quote_name(model._meta.db_table)}")
+    return system_ids
+
+
+@benchmark("trade_routes")
+def benchmark_trade_routes(size=20000, queries=30):
+    """Latency of route and loop searches over size stations with 60 listings each."""
+    results = []
+    try:
+        with transaction.atomic():
+            t0 = time.perf_counter()
+            system_ids = seed_markets(size)
+            results.append(
+                f"{LiveListing.objects.count()} listings, seeded in {time.perf_counter() - t0:.1f} s."
+            )
+            SystemIndex().invalidate()
+            SystemIndex().refresh()
+            markets = StationMarkets()
+            references = random.Random(0).sample(system_ids, queries)
+
+            def routes(radius, order=ORDER_PROFIT):
+                return lambda point: find_trade_routes(
+                    point, radius, capacity=720, budget=50000000, order=order
+                )
+
+            def loops(radius, hops, max_distance, workers=1):
+                return lambda point: find_trade_loops(
+                    point,
+                    radius,
+                    hops,
+                    capacity=720,
+                    max_distance=max_distance,
+                    workers=workers,
+                )
+
+            for name, cached, search in [
+                ("profit, 30 ly, cold", False, routes(30)),
+                ("profit, 30 ly", True, routes(30)),
+                ("profit per ly, 30 ly", True, routes(30, ORDER_PROFIT_PER_LY)),
+                ("profit, 60 ly, cold", False, routes(60)),
+                ("profit, 60 ly", True, routes(60)),
+                ("profit per ly, 60 ly", True, routes(60, ORDER_PROFIT_PER_LY)),
+                ("3 hop loops, 20 ly hops", True, loops(60, 3, 20)),
+                ("5 hop loops, 20 ly hops", True, loops(60, 5, 20)),
+                ("5 hop loops, 40 ly hops", True, loops(60, 5, 40)),
+                (
+                    f"5 hop loops, 40 ly hops, {min(4, os.cpu_count() or 1)} workers",
+                    True,
+                    loops(60, 5, 40, min(4, os.cpu_count() or 1)),
+                ),
+            ]:
+                timings, stations = [], 0
+                for reference in references:
+                    if not cached:
+                        markets.invalidate()
+                    point = SystemIndex().positions([reference])[reference]
+                    t0 = time.perf_counter()
+                    search(point)
+                    timings.append(time.perf_counter() - t0)
+                    stations = max(stations, len(markets))
+                results.append(
+                    f"{name:>24}: {latencies(timings)}, {stations} markets cached"
+                )
+            raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    finally:
+        SystemIndex().invalidate()
+        StationMarkets().invalidate()
+    return "\n".join(results)
+
+
+@benchmark("carrier_routes")
+def benchmark_carrier_routes(size=200000, queries=20):
+    """Latency of fleet carrier routes between random systems of at least size systems."""
+    results = []
+    try:
+        with transaction.atomic():
+            if System.objects.count() < size:
+                seed_systems(size - System.objects.count())
+            SystemIndex().invalidate()
+            t0 = time.perf_counter()
+            plan_carrier_route(*System.objects.all()[:2])
+            results.append(
+                f"{len(SystemIndex())} systems, index and grid built in {time.perf_counter() - t0:.1f} s."
+            )
+            rng = random.Random(0)
+            system_ids = list(System.objects.values_list("id", flat=True))
+            pairs = [
+                System.objects.in_bulk(rng.sample(system_ids, 2)).values()
+                for _ in range(queries)
+            ]
+            for cost in (COST_JUMPS, COST_FUEL):
+                timings, jumps, least_jumps, missing = [], 0, 0, 0
+                for origin, destination in pairs:
+                    t0 = time.perf_counter()
+                    route = plan_carrier_route(origin, destination, cost=cost)
+                    timings.append(time.perf_counter() - t0)
+                    if route is None:
+                        missing += 1
+                        continue
+                    jumps += len(route.jumps)
+                    least_jumps += math.ceil(
+                        origin.distance_to(destination) / MAX_CARRIER_JUMP
+                    )
+                results.append(
+                    f"{cost:>6}: {latencies(timings)}, {jumps} jumps, at least {least_jumps},"
+                    f" {missing} not found"
+                )
+            raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    finally:
+        SystemIndex().invalidate()
+    return "\n".join(results)
+
+
+@benchmark("jump_graphs")
+def benchmark_jump_graphs(size=100000, queries=2000):
+    """Size and build time of jump graphs, and their lookups against the spatial index."""
+    results = []
+    try:
+        with transaction.atomic(), tempfile.TemporaryDirectory() as directory:
+            if System.objects.count() < size:
+                seed_systems(size - System.objects.count())
+            index = SystemIndex()
+            index.invalidate()
+            coordinates = index.snapshot()
+            results.append(f"{len(coordinates)} systems.")
+            rng = random.Random(0)
+            system_ids = rng.sample(list(coordinates.ids), queries)
+            positions = index.positions(system_ids)
+            for jump_range in settings.JUMP_GRAPH_RANGES:
+                path = graph_path(jump_range, directory)
+                t0 = time.perf_counter()
+                build_jump_graph(jump_range, path, coordinates)
+                elapsed = time.perf_counter() - t0
+                graph = JumpGraph(path)
+                edges, timings = 0, []
+                for system_id in system_ids:
+                    t0 = time.perf_counter()
+                    edges += len(graph.neighbours(system_id))
+                    timings.append(time.perf_counter() - t0)
+                index_timings = []
+                for system_id in system_ids:
+                    t0 = time.perf_counter()
+                    index.within(positions[system_id], jump_range)
+                    index_timings.append(time.perf_counter() - t0)
+                graph.close()
+                size_per_edge = path.stat().st_size / (
+                    edges / queries * len(coordinates)
+                )
+                results.append(
+                    f"{jump_range:>5g} ly: built in {elapsed:6.1f} s, "
+                    f"{path.stat().st_size / 1024 / 1024:6.1f} MB, "
+                    f"{edges / queries:6.1f} neighbours, {size_per_edge:4.1f} bytes each\n"
+                    f"{'graph':>12}: {latencies(timings)}\n"
+                    f"{'index':>12}: {latencies(index_timings)}"
+                )
+            seed_systems(1000, seed=1)
+            index.invalidate()
+            coordinates = index.snapshot()
+            for jump_range in settings.JUMP_GRAPH_RANGES:
+                t0 = time.perf_counter()
+                update_jump_graph(
+                    jump_range, graph_path(jump_range, directory), coordinates
+                )
+                results.append(
+                    f"{jump_range:>5g} ly: 1000 systems added in {time.perf_counter() - t0:.1f} s"
+                )
+            raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    finally:
+        SystemIndex().invalidate()
+    return "\n".join(results)
+
+
+@benchmark("nearest_listings")
+def benchmark_nearest_listings(size=20000, queries=50):
+    """Latency of the closest stations that sell or buy a commodity, over size stations."""
+    client = Client()
+    results = []
+    try:
+        with transaction.atomic():
+            t0 = time.perf_counter()
+            system_ids = seed_markets(size)
+            results.append(
+                f"{LiveListing.objects.count()} listings, seeded in {time.perf_counter() - t0:.1f} s."
+            )
+            index = SystemIndex()
+            index.invalidate()
+            index.refresh()
+            listings = ListingIndex()
+            rng = random.Random(0)
+            commodity_ids = list(
+                Commodity.objects.filter(category__name="Benchmark").values_list(
+                    "id", flat=True
+                )
+            )
+            references = [
+                (system_id, rng.choice(commodity_ids))
+                for system_id in rng.sample(system_ids, queries)
+            ]
+            positions = index.positions(system_ids)
+
+            def sql(reference, point, commodity_id):
+                return [
+                    (listing.id, listing.distance)
+                    for listing in annotate_distance(
+                        LiveListing.objects.filter(
+                            commodity_id=commodity_id,
+                            supply_units__gt=0,
+                            supply_price__gt=0,
+                        ),
+                        point,
+                        field="station__system__",
+                    ).order_by("distance", "supply_price")[:40]
+                ]
+
+            def nearest(**kwargs):
+                return lambda reference, point, commodity_id: listings.nearest(
+                    point, commodity_id, **kwargs
+                )
+
+            def api(url):
+                def query(reference, point, commodity_id):
+                    response = client.get(url.format(reference, commodity_id))
+                    if response.status_code != 200:
+                        raise RuntimeError(f"{url}: {response.status_code}")
+
+                return query
+
+            mismatches = 0
+            for reference, commodity_id in references:
+                point = positions[reference]
+                expected = [
+                    round(distance, 6) for _, distance in sql(None, point, commodity_id)
+                ]
+                found = [
+                    round(distance, 6)
+                    for _, distance in listings.nearest(point, commodity_id, limit=40)
+                ]
+                mismatches += expected != found
+            results.append(f"{mismatches} of {queries} differ from the database.")
+
+            for name, cold, query in [
+                ("nearest 40 (SQL sort)", False, sql),
+                ("nearest 40, cold", True, nearest(limit=40)),
+                ("nearest 40", False, nearest(limit=40)),
+                ("nearest 40 demand", False, nearest(mode=DEMAND, limit=40)),
+                ("nearest 10, 15000 units", False, nearest(limit=10, min_units=15000)),
+                ("all within 20 ly", False, nearest(limit=None, max_distance=20)),
+                (
+                    "listings order=distance",
+                    False,
+                    api(
+                        "/api/listings/?near={}&commodity={}&type=supply&order=distance"
+                    ),
+                ),
+            ]:
+                timings = []
+                for reference, commodity_id in references:
+                    if cold:
+                        listings.invalidate()
+                    else:
+                        listings.get(commodity_id)
+                    t0 = time.perf_counter()
+                    query(reference, positions[reference], commodity_id)
+                    timings.append(time.perf_counter() - t0)
+                results.append(f"{name:>24}: {latencies(timings)}")
+            raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    finally:
+        SystemIndex().invalidate()
+        ListingIndex().invalidate()
+    return "\n".join(results)
+
+
+@benchmark("listing_ranking")
+def benchmark_listing_ranking(size=100000, queries=50):
+    """
+    Latency of ranking the listings of a commodity by price, units, age and distance, with every
+    commodity listed at half of size stations, like the most traded ones.
+    """
+    client = Client()
+    results = []
+    try:
+        with transaction.atomic():
+            t0 = time.perf_counter()
+            system_ids = seed_markets(size, commodities=10, listings=5)
+            results.append(
+                f"{LiveListing.objects.count()} listings, seeded in {time.perf_counter() - t0:.1f} s."
+            )
+            index = SystemIndex()
+            index.invalidate()
+            index.refresh()
+            listings = ListingIndex()
+            rng = random.Random(0)
+            commodity_ids = list(
+                Commodity.objects.filter(category__name="Benchmark").values_list(
+                    "id", flat=True
+                )
+            )
+            references = [
+                (system_id, rng.choice(commodity_ids))
+                for system_id in rng.sample(system_ids, queries)
+            ]
+            positions = index.positions(system_ids)
+            t0 = time.perf_counter()
+            for commodity_id in commodity_ids:
+                listings.get(commodity_id)
+            results.append(
+                f"{len(commodity_ids)} commodities loaded in {time.perf_counter() - t0:.1f} s."
+            )
+
+            # Ranked by distance alone, the listings come in the order of nearest().
+            mismatches = 0
+            for reference, commodity_id in references:
+                point = positions[reference]
+                ranked = listings.rank(
+                    point,
+                    commodity_id,
+                    limit=40,
+                    weights=RankWeights(price=0, units=0, age=0),
+                )
+                nearest = listings.nearest(point, commodity_id, limit=40)
+                mismatches += [distance for _, distance, _ in ranked] != [
+                    distance for _, distance in nearest
+                ]
+            results.append(f"{mismatches} of {queries} differ from nearest().")
+
+            def rank(**kwargs):
+                return lambda reference, point, commodity_id: listings.rank(
+                    point, commodity_id, **kwargs
+                )
+
+            def api(url):
+                def query(reference, point, commodity_id):
+                    response = client.get(url.format(reference, commodity_id))
+                    if response.status_code != 200:
+                        raise RuntimeError(f"{url}: {response.status_code}")
+
+                return query
+
+            for name, query in [
+                (
+                    "nearest 40",
+                    lambda reference, point, commodity_id: listings.nearest(
+                        point, commodity_id, limit=40
+                    ),
+                ),
+                ("rank 40", rank(limit=40)),
+                ("rank 40 demand", rank(mode=DEMAND, limit=40)),
+                (
+                    "rank 40, price only",
+                    rank(limit=40, weights=RankWeights(units=0, age=0, distance=0)),
+                ),
+                ("rank 40 within 100 ly", rank(limit=40, max_distance=100)),
+                ("rank all", rank(limit=None)),
+                (
+                    "listings order=score",
+                    api("/api/listings/?near={}&commodity={}&type=supply&order=score"),
+                ),
+            ]:
+                timings = []
+                for reference, commodity_id in references:
+                    t0 = time.perf_counter()
+                    query(reference, positions[reference], commodity_id)
+                    timings.append(time.perf_counter() - t0)
+                results.append(f"{name:>24}: {latencies(timings)}")
+            raise BenchmarkRollback()
+    except BenchmarkRollback:
+        pass
+    finally:
+        SystemIndex().invalidate()
+        ListingIndex().invalidate()
+    return "\n".join(results)
@@ -0,0 +1,103 @@
+import datetime
+from itertools import islice
+from typing import Iterable, Sequence
+
+from django.db import connections
+
+COPY_FALLBACK_BATCH_SIZE = 200000
+
+
+def _csv_value(value) -> str:
+    """Encode a single value for PostgreSQL's CSV COPY format. An unquoted empty field is NULL."""
+    if value is None:
+        return ""
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+class RowStream:
+    """
+    File-like object that lazily encodes an iterable of tuples as CSV.
+    psycopg2 pulls from it with read(), so the rows are never all held in memory as text.
+    """
+
+    def __init__(self, rows: Iterable[Sequence]):
+        self.rows = iter(rows)
+        self.buffer = b""
+        self.row_count = 0
+
+    def _encode_row(self, row: Sequence) -> bytes:
+        return (",".join([_csv_value(value) for value in row]) + "\n").encode()
+
+    def read(self, size=-1) -> bytes:
+        while size is None or size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            self.row_count += 1
+            self.buffer += self._encode_row(row)
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def supports_copy(using: str = "default") -> bool:
+    return connections[using].vendor == "postgresql"
+
+
+def copy_rows(
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    using: str = "default",
+) -> int:
+    """
+    Stream rows into a table with COPY FROM STDIN. Only works on PostgreSQL.
+    :return: The number of rows that were copied.
+    """
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+        quote(table), ", ".join(quote(column) for column in columns)
+    )
+    stream = RowStream(rows)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, stream)
+    return stream.row_count
+
+
+def insert_rows(
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    using: str = "default",
+    batch_size: int = COPY_FALLBACK_BATCH_SIZE,
+) -> int:
+    """
+    Insert tuples into any table. Uses COPY on PostgreSQL and executemany() everywhere else.
+    Either way the rows are streamed, the fallback takes batch_size of them from rows at a time.
+    """
+    if supports_copy(using):
+        return copy_rows(table, columns, rows, using=using)
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+        quote(table),
+        ", ".join(quote(column) for column in columns),
+        ", ".join(["%s"] * len(columns)),
+    )
+    rows, total = iter(rows), 0
+    with connection.cursor() as cursor:
+        while chunk := list(islice(rows, batch_size)):
+            cursor.executemany(sql, chunk)
+            total += len(chunk)
+    return total
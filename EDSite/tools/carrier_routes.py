@@ -0,0 +1,285 @@
+import heapq
+import itertools
+import math
+import threading
+from array import array
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+from EDSite.helpers import SingletonMeta
+from EDSite.models import System
+from EDSite.tools.spatial import Point, SystemCoordinates, SystemIndex
+
+# Longest jump of a fleet carrier, in ly.
+MAX_CARRIER_JUMP = 500
+# Tritium that fits in the tank of a carrier, in t.
+CARRIER_TANK = 1000
+# Mass of a carrier without cargo, in t. The tritium of a jump grows with the mass.
+CARRIER_MASS = 25000
+# Every jump burns this much tritium, plus the distance times the mass over JUMP_FUEL_DIVISOR.
+JUMP_FUEL_BASE = 5
+JUMP_FUEL_DIVISOR = 200000
+# Edge of the cells of the grid that the planner picks the next systems from, in ly.
+GRID_CELL_SIZE = 100
+# Systems of a cell that crosses the edge of the jump range that are tried for one within range.
+GRID_CELL_SCAN = 256
+# The heuristic is weighted by this much. Routes may cost up to this much more than the best one, in
+# exchange for the search heading straight on rather than trying every short jump in sparse regions.
+HEURISTIC_WEIGHT = 1.5
+# A search gives up after expanding this many systems.
+MAX_EXPANDED_SYSTEMS = 20000
+# The open set of a search is cut to its best half when it grows beyond this many systems.
+MAX_OPEN_SYSTEMS = 50000
+
+COST_JUMPS = "jumps"
+COST_FUEL = "fuel"
+
+
+def jump_fuel(distance: float, cargo: int = 0) -> float:
+    """The tritium of a jump over distance with cargo t on board. The game rounds it up."""
+    return JUMP_FUEL_BASE + distance * (CARRIER_MASS + cargo) / JUMP_FUEL_DIVISOR
+
+
+class SystemGrid(metaclass=SingletonMeta):
+    """
+    The rows of the coordinates of SystemIndex by the cube of GRID_CELL_SIZE ly that holds them.
+    Systems that were appended to the coordinates are added on the next use, and the grid is built
+    again when the index replaced its coordinates.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.coordinates: Optional[SystemCoordinates] = None
+        self.size = 0
+        self.cells: {tuple: array} = {}
+
+    def cells_of(self, coordinates: SystemCoordinates) -> {tuple: array}:
+        with self.lock:
+            if coordinates is not self.coordinates:
+                self.coordinates, self.size, self.cells = coordinates, 0, {}
+            cells = self.cells
+            xs, ys, zs = coordinates.xs, coordinates.ys, coordinates.zs
+            for row in range(self.size, len(coordinates)):
+                cell = (
+                    math.floor(xs[row] / GRID_CELL_SIZE),
+                    math.floor(ys[row] / GRID_CELL_SIZE),
+                    math.floor(zs[row] / GRID_CELL_SIZE),
+                )
+                rows = cells.get(cell)
+                if rows is None:
+                    rows = cells[cell] = array("q")
+                rows.append(row)
+            self.size = len(coordinates)
+            return cells
+
+
+@dataclass
+class CarrierJump:
+    system_id: int
+    distance: float
+    fuel: int
+    # Distance from the system to the destination.
+    remaining: float
+
+
+@dataclass
+class CarrierRoute:
+    origin_id: int
+    jumps: [CarrierJump]
+
+    @property
+    def destination_id(self) -> int:
+        return self.jumps[-1].system_id if self.jumps else self.origin_id
+
+    @property
+    def distance(self) -> float:
+        return sum(jump.distance for jump in self.jumps)
+
+    @property
+    def fuel(self) -> int:
+        return sum(jump.fuel for jump in self.jumps)
+
+    @property
+    def refuel(self) -> bool:
+        """Whether the carrier has to refuel from its cargo on the way."""
+        return self.fuel > CARRIER_TANK
+
+
+class CarrierPlanner:
+    """
+    A* search for the cheapest sequence of jumps from one system to another.
+    The next systems of a system come from the cells of SystemGrid within jump range of it: of every
+    cell the system closest to the destination that is in range. That keeps the branching to the
+    number of cells in range, however many systems they hold, at the cost of the systems of a cell
+    that are further from the destination. The heuristic is the straight line to the destination,
+    in jumps of the full range or in the tritium of those jumps, times HEURISTIC_WEIGHT.
+    """
+
+    def __init__(
+        self,
+        coordinates: SystemCoordinates,
+        destination_row: int,
+        jump_range: float,
+        cargo: int,
+        cost: str,
+    ):
+        self.coordinates = coordinates
+        self.cells = SystemGrid().cells_of(coordinates)
+        self.destination_row = destination_row
+        self.destination = coordinates.position(destination_row)
+        self.jump_range = jump_range
+        self.cargo = cargo
+        self.cost = cost
+        # Every jump is at most jump_range long, and a jump of the full range costs the least per ly.
+        self.least_cost_per_ly = self.step_cost(jump_range) / jump_range
+        # The systems of the cells that were looked at, closest to the destination first.
+        self.members: {tuple: list} = {}
+
+    def remaining(self, point: Point) -> float:
+        return math.dist(point, self.destination)
+
+    def step_cost(self, distance: float) -> float:
+        if self.cost == COST_JUMPS:
+            return 1
+        return jump_fuel(distance, self.cargo)
+
+    def heuristic(self, remaining: float) -> float:
+        return remaining * self.least_cost_per_ly * HEURISTIC_WEIGHT
+
+    def cell_members(self, cell: tuple) -> [tuple]:
+        """The systems of cell as (row, position) tuples, closest to the destination first."""
+        members = self.members.get(cell)
+        if members is None:
+            position, destination = self.coordinates.position, self.destination
+            members = self.members[cell] = sorted(
+                ((row, position(row)) for row in self.cells[cell]),
+                key=lambda member: math.dist(member[1], destination),
+            )
+        return members
+
+    def neighbours(self, row: int) -> Iterator[tuple]:
+        """The next systems of the system of row as (row, distance) tuples."""
+        cells, jump_range = self.cells, self.jump_range
+        point = self.coordinates.position(row)
+        x, y, z = point
+        ranges = [
+            range(
+                math.floor((coordinate - jump_range) / GRID_CELL_SIZE),
+                math.floor((coordinate + jump_range) / GRID_CELL_SIZE) + 1,
+            )
+            for coordinate in point
+        ]
+        for ix in ranges[0]:
+            # Distance from the system to the cells along every axis, 0 for the cells around it.
+            gap_x = max(ix * GRID_CELL_SIZE - x, x - (ix + 1) * GRID_CELL_SIZE, 0.0)
+            for iy in ranges[1]:
+                gap_y = max(iy * GRID_CELL_SIZE - y, y - (iy + 1) * GRID_CELL_SIZE, 0.0)
+                if math.hypot(gap_x, gap_y) > jump_range:
+                    continue
+                for iz in ranges[2]:
+                    cell = (ix, iy, iz)
+                    if cell not in cells:
+                        continue
+                    gap_z = max(
+                        iz * GRID_CELL_SIZE - z, z - (iz + 1) * GRID_CELL_SIZE, 0.0
+                    )
+                    if math.hypot(gap_x, gap_y, gap_z) > jump_range:
+                        continue
+                    # In cells that lie within range, the first system is.
+                    for member, member_point in itertools.islice(
+                        self.cell_members(cell), GRID_CELL_SCAN
+                    ):
+                        distance = math.dist(point, member_point)
+                        if distance <= jump_range and member != row:
+                            yield member, distance
+                            break
+
+    def plan(self, origin_row: int) -> Optional[CarrierRoute]:
+        coordinates, destination_row = self.coordinates, self.destination_row
+        remaining = self.remaining(coordinates.position(origin_row))
+        heap = [(self.heuristic(remaining), remaining, 0, origin_row)]
+        costs = {origin_row: 0}
+        # The system each system was reached from and the distance of that jump.
+        parents = {origin_row: (None, 0.0)}
+        closed = set()
+        while heap:
+            _, remaining, cost, row = heapq.heappop(heap)
+            if row in closed:
+                continue
+            if row == destination_row:
+                return self.route(origin_row, parents)
+            closed.add(row)
+            if len(closed) > MAX_EXPANDED_SYSTEMS:
+                return None
+            for neighbour, distance in self.neighbours(row):
+                if neighbour in closed:
+                    continue
+                neighbour_cost = cost + self.step_cost(distance)
+                if neighbour_cost >= costs.get(neighbour, math.inf):
+                    continue
+                costs[neighbour] = neighbour_cost
+                parents[neighbour] = (row, distance)
+                neighbour_remaining = self.remaining(coordinates.position(neighbour))
+                heapq.heappush(
+                    heap,
+                    (
+                        neighbour_cost + self.heuristic(neighbour_remaining),
+                        neighbour_remaining,
+                        neighbour_cost,
+                        neighbour,
+                    ),
+                )
+            if len(heap) > MAX_OPEN_SYSTEMS:
+                # A sorted list is a heap. The systems that were dropped are forgotten, so the
+                # memory of a search stays bounded by its closed set.
+                heap = heapq.nsmallest(MAX_OPEN_SYSTEMS // 2, heap)
+                kept = closed.union(entry[3] for entry in heap)
+                costs = {row: costs[row] for row in kept}
+                parents = {row: parents[row] for row in kept}
+        return None
+
+    def route(self, origin_row: int, parents: {int: tuple}) -> CarrierRoute:
+        coordinates, jumps = self.coordinates, []
+        row = self.destination_row
+        while row != origin_row:
+            parent, distance = parents[row]
+            jumps.append(
+                CarrierJump(
+                    coordinates.ids[row],
+                    distance,
+                    math.ceil(jump_fuel(distance, self.cargo)),
+                    self.remaining(coordinates.position(row)),
+                )
+            )
+            row = parent
+        jumps.reverse()
+        return CarrierRoute(coordinates.ids[origin_row], jumps)
+
+
+def plan_carrier_route(
+    origin: System,
+    destination: System,
+    jump_range: float = MAX_CARRIER_JUMP,
+    cargo: int = 0,
+    cost: str = COST_JUMPS,
+) -> Optional[CarrierRoute]:
+    """
+    The fewest jumps, or the least tritium, that take a fleet carrier from origin to destination.
+    :param jump_range: The longest jump in ly, up to MAX_CARRIER_JUMP.
+    :param cargo: The cargo on board in t, which makes every jump burn more tritium.
+    :param cost: COST_JUMPS or COST_FUEL.
+    :return: None when no route was found within MAX_EXPANDED_SYSTEMS systems.
+    """
+    if cost not in (COST_JUMPS, COST_FUEL):
+        raise ValueError(f"Unknown cost {cost!r}.")
+    if not 0 < jump_range <= MAX_CARRIER_JUMP:
+        raise ValueError(
+            f"A carrier jumps up to {MAX_CARRIER_JUMP} ly, not {jump_range}."
+        )
+    coordinates = SystemIndex().snapshot([origin.id, destination.id])
+    origin_row = coordinates.rows.get(origin.id)
+    destination_row = coordinates.rows.get(destination.id)
+    if origin_row is None or destination_row is None:
+        return None
+    planner = CarrierPlanner(coordinates, destination_row, jump_range, cargo, cost)
+    return planner.plan(origin_row)
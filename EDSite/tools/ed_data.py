@@ -1,10 +1,15 @@
+import contextlib
+import itertools
 import json
+import math
+import multiprocessing
 import os
 import random
 import threading
 import time
 import zlib
 from collections import defaultdict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import datetime
 from pprint import pprint
 from typing import Optional
@@ -50,6 +55,7 @@ try:
         LiveListing,
         HistoricListing,
         CarrierMission,
+        ImportWatermark,
         Faction,
         LocalFaction,
         State,
@@ -68,8 +74,37 @@ except ImproperlyConfigured:
         LiveListing,
         HistoricListing,
         CarrierMission,
+        ImportWatermark,
     )
 from django.core.cache import cache
+from EDSite.tools.listings_csv import (
+    LISTINGS_CSV,
+    LIVE_LISTINGS_CSV,
+    download_listings_file,
+    eddblink_data_path,
+    find_listings_file,
+    merge_listings_file,
+)
+from EDSite.tools.stations_merge import StationsStaging
+from EDSite.tools.td_session import TradeDBSession
+from EDSite.tools.import_progress import ImportProgress
+from EDSite.tools.jobs import Job, JobCancelled
+from EDSite.tools.jump_graph import update_jump_graphs
+from EDSite.tools.listing_index import ListingIndex
+from EDSite.tools.spatial import SystemIndex
+from EDSite.tools.trade_routes import StationMarkets
+from EDSite.tools.timestamps import (
+    TD_TIMESTAMP_FORMAT,
+    parse_timestamp,
+    parse_timestamps,
+)
+from EDSite.tools.listings_merge import (
+    MergeResult,
+    merge_td_listings_range,
+    td_station_ranges,
+)
+
+TD_WATERMARK_SOURCE = "tradedangerous"
 
 
 class EDData(metaclass=SingletonMeta):
@@ -84,17 +119,7 @@ class EDData(metaclass=SingletonMeta):
         )
         self.live_listener = None
 
-        self.commodity_names = {
-            c.name.lower().replace(" ", "").replace("-", ""): c
-            for c in Commodity.objects.only("name").all()
-        }
-        self.system_names = {
-            system.name.lower(): system for system in System.objects.all()
-        }
-        self.station_names_dict = {
-            (station.name.lower(), station.system.name.lower()): station
-            for station in Station.objects.select_related("system").all()
-        }
+        self.load_name_caches()
 
         self.states_dict = {state.id: state for state in State.objects.all()}
 
@@ -114,6 +139,29 @@ class EDData(metaclass=SingletonMeta):
 
         print("Created new EDData object")
 
+    def load_name_caches(self):
+        """(Re)load the lookups by name that the live listener uses."""
+        self.commodity_names = {
+            c.name.lower().replace(" ", "").replace("-", ""): c
+            for c in Commodity.objects.only("name").all()
+        }
+        self.system_names = {
+            system.name.lower(): system for system in System.objects.all()
+        }
+        self.station_names_dict = {
+            (station.name.lower(), station.system.name.lower()): station
+            for station in Station.objects.select_related("system").all()
+        }
+
+    def live_critical_section(self):
+        """
+        Hold the live listener's processing while stations are deleted or relinked.
+        Its messages are spooled in the meantime and replayed afterwards.
+        """
+        if self.live_listener:
+            return self.live_listener.critical_section()
+        return contextlib.nullcontext()
+
     def cache_find_system(self, name: str) -> Optional[System]:
         return self.system_names.get(name.lower())
 
@@ -141,11 +189,15 @@ class EDData(metaclass=SingletonMeta):
         self.live_listener.start_background(daemon=daemon)
 
     @property
-    def tdb(self, *args) -> tradedb.TradeDB:
-        return tradedb.TradeDB(args)
-
-    def check_tradedangerous_db(self):
-        tsc = self.tdb.tradingStationCount
+    def tdb(self) -> tradedb.TradeDB:
+        """A new, fully loaded TradeDB. Use a TradeDBSession to share one between several steps."""
+        return tradedb.TradeDB()
+
+    def check_tradedangerous_db(self, session: TradeDBSession = None):
+        if session is None:
+            with TradeDBSession() as session:
+                return self.check_tradedangerous_db(session)
+        tsc = session.tdb.tradingStationCount
         cmdenv = commands.commandenv
         if tsc == 0:
             raise td_exceptions.NoDataError(
@@ -167,10 +219,13 @@ class EDData(metaclass=SingletonMeta):
             )
         else:
             print(tsc, "trading data found.")
-        self.tdb.close()
         return tsc if tsc > 0 else None
 
-    def update_tradedangerous_database(self):
+    def update_tradedangerous_database(self, listings=True):
+        """
+        Run TradeDangerous' eddblink import.
+        :param listings: Also import the market listings into TradeDangerous' database.
+        """
         # self.live_listener.pause()
         first_time = False
         try:
@@ -179,9 +234,12 @@ class EDData(metaclass=SingletonMeta):
             print("Running for the first time. This might take a while.")
             trade_data = None
             first_time = True
-        self.tdb.close()
         self.td_database_status = EDDatabaseState.UPDATING
-        if trade_data is not None:
+        if trade_data is not None and not listings:
+            print("Updating items and stations...")
+            argv = ["trade.py", "import", "--merge", "-P", "eddblink"]
+            argv += ["-O", "item,station,skipvend"]
+        elif trade_data is not None:
             print("Updating price data...")
             argv = ["trade.py", "import", "--merge", "-P", "eddblink", "-O", "skipvend"]
         else:
@@ -212,16 +270,17 @@ class EDData(metaclass=SingletonMeta):
             if mission.station
         }
 
-    def update_local_systems(self, tdb=None):
-        if not tdb:
-            tdb = self.tdb
+    def update_local_systems(self, session: TradeDBSession = None):
+        if session is None:
+            with TradeDBSession() as session:
+                return self.update_local_systems(session)
         print("Updating systems...")
         new_systems = []
         td_system: TDSystem
         systems = {
             system.tradedangerous_id: system for system in System.objects.iterator()
         }
-        for td_system in tdb.systems():
+        for td_system in session.tdb.systems():
             if td_system.ID not in systems:
                 system = System(
                     tradedangerous_id=td_system.ID,
@@ -229,463 +288,309 @@ class EDData(metaclass=SingletonMeta):
                     pos_x=td_system.posX,
                     pos_y=td_system.posY,
                     pos_z=td_system.posZ,
+                    distance_to_sol=math.hypot(
+                        td_system.posX, td_system.posY, td_system.posZ
+                    ),
                 )
                 new_systems.append(system)
         if new_systems:
             System.objects.bulk_create(new_systems)
+            SystemIndex().add(new_systems)
             print(f"Found {len(new_systems)} new systems.")
+            for jump_range, added in update_jump_graphs().items():
+                print(f"Added {added} systems to the {jump_range:g} ly jump graph.")
 
-    def update_local_stations(self, tdb=None):
-        if not tdb:
-            tdb = self.tdb
+    def update_local_stations(self, session: TradeDBSession = None):
+        if session is None:
+            with TradeDBSession() as session:
+                return self.update_local_stations(session)
         print("Updating stations...")
-        td_station: TDStation
-        new_stations: [Station] = []
-        updated_stations: [Station] = []
-        systems = {system.tradedangerous_id: system for system in System.objects.all()}
-        stations = {
-            station.tradedangerous_id: station for station in Station.objects.all()
-        }
-        stations_names_dict = {
-            station.name: station for station in Station.objects.filter(Q(fleet=True))
-        }
-        fixed_stations_ids_dict: {int: int} = {}  # new id -> original id.
-        deleted_stations_ids = set()
-        carrier_names = {}
-        td_stations_rows = sorted(
-            list(tdb.getDB().cursor().execute("SELECT * FROM Station")),
-            key=lambda r: r[0],
-        )
-        td_stations_ids = set(r[0] for r in td_stations_rows)
-        for row in tqdm(td_stations_rows):
-            (
-                td_station_id,
-                name,
-                td_system_id,
-                ls_from_star,
-                black_market,
-                pad_size,
-                market,
-                shipyard,
-                modified_str,
-                outfitting,
-                rearm,
-                refuel,
-                repair,
-                planetary,
-                type_id,
-            ) = row
-            is_fleet = type_id == 24
-            is_odyssey = type_id == 25
-            modified = make_timezone_aware(
-                datetime.datetime.strptime(modified_str, "%Y-%m-%d %H:%M:%S")
-            )
-            force_update = False
-            try:
-                station: Station = stations[td_station_id]
-            except KeyError:
-                # Station not found. Maybe if it's a carrier the ID just changed.
-                if is_fleet:
-                    try:
-                        match_fleet = stations_names_dict[name]
-                        if (
-                            match_fleet.tradedangerous_id != td_station_id
-                            and match_fleet.modified < modified
-                        ):
-                            original_id = match_fleet.tradedangerous_id
-                            print(
-                                f"Fixed tradedangerous_id for {match_fleet} from {original_id} to {td_station_id}"
-                            )
-                            station = match_fleet
-                            station.tradedangerous_id = td_station_id
-                            fixed_stations_ids_dict[td_station_id] = original_id
-                            force_update = True
-                        else:
-                            # ID was not found but name was. The name was but it was older than the current one.
-                            continue
-                    except KeyError:
-                        # ID was not found and name was not found. Its new.
-                        station = None
-                else:
-                    station = None
-            if not station:
-                station = Station(
-                    tradedangerous_id=td_station_id,
-                    name=name,
-                    ls_from_star=ls_from_star,
-                    pad_size=pad_size,
-                    modified=modified,
-                    market=market == "Y",
-                    black_market=black_market == "Y",
-                    shipyard=shipyard == "Y",
-                    outfitting=outfitting == "Y",
-                    rearm=rearm == "Y",
-                    refuel=refuel == "Y",
-                    repair=repair == "Y",
-                    planetary=planetary == "Y",
-                    fleet=is_fleet,
-                    odyssey=is_odyssey,
-                )
-                station.system_id = systems[td_system_id].id
-                new_stations.append(station)
-                if station.fleet:
-                    if station.name not in carrier_names:
-                        carrier_names[station.name] = [station]
-                    else:
-                        carrier_names[station.name].append(station)
-            else:
-                try:
-                    if (
-                        force_update
-                        or not station.modified
-                        or modified
-                        and modified > station.modified
-                    ):
-                        if not modified or not station.modified:
-                            modified = None
-                        elif modified <= station.modified:
-                            continue
-                        station.modified = modified
-                        station.system_id = systems[td_system_id].id
-                        station.black_market = black_market == "Y"
-                        station.ls_from_star = ls_from_star
-                        station.market = black_market == "Y"
-                        updated_stations.append(station)
-                except TypeError as e:
-                    raise e
-                    # updated_stations.append(station)
-
-        #  TODO: Handle listings where station_tradedangerous_id is None
-
-        # Duplicate carrier check:
-        for duplicate_carrier_name, carriers in {
-            cn: cs for cn, cs in carrier_names.items() if len(cs) > 1
-        }.items():
-            most_recent_carrier = carriers[0]
-            for c in carriers[1:]:
-                if c.modified > most_recent_carrier.modified:
-                    most_recent_carrier = c
-
-            for bad_carrier in carriers:
-                if bad_carrier != most_recent_carrier:
-                    new_stations.remove(bad_carrier)
-
-        fixed_stations_ids_originals = fixed_stations_ids_dict.values()
-        for station_tradedangerous_id, station in stations.items():
-            if (
-                station.tradedangerous_id not in fixed_stations_ids_originals
-                and station_tradedangerous_id not in td_stations_ids
-            ):
-                print(f"Deleting a station: {station}")
-                deleted_stations_ids.add(station.id)
-
-        if new_stations:
-            print(f"Found {len(new_stations)} new stations. Saving...")
-            Station.objects.bulk_create(new_stations)
-
-        if deleted_stations_ids:
-            with transaction.atomic():
-                for station_id in deleted_stations_ids:
-                    Station.objects.filter(pk=station_id).delete()
-
-        to_update_listings = {}
-        if updated_stations:
-            print(f"Trying to update {len(updated_stations)} stations...")
-            with transaction.atomic():
-                for station in updated_stations:
-                    if station.tradedangerous_id in fixed_stations_ids_dict:
-                        # print(f"Need to fix listings for {station}")
-                        to_update_listings[
-                            station.tradedangerous_id
-                        ] = fixed_stations_ids_dict[station.tradedangerous_id]
-                    Station.objects.filter(id=station.id).update(
-                        **model_to_dict(station)
+        staging = StationsStaging()
+        try:
+            # The live listener must not write listings of stations that are being deleted, and
+            # must not keep using them afterwards.
+            with self.live_critical_section():
+                result = staging.sync(
+                    session.execute(
+                        "SELECT station_id, name, system_id, ls_from_star, blackmarket, max_pad_size, market, "
+                        "shipyard, modified, outfitting, rearm, refuel, repair, planetary, type_id FROM Station"
                     )
-            print(f"Updated {len(updated_stations)} stations.")
-
-        if to_update_listings:
-            with transaction.atomic():
-                for station_td_id, old_td_id in to_update_listings.items():
-                    # print(f"Updated listings from {old_td_id} -> {station_td_id}")
-                    LiveListing.objects.filter(
-                        station_tradedangerous_id=old_td_id
-                    ).update(station_tradedangerous_id=station_td_id)
-
-    def update_local_commodities(self, tdb=None):
-        if not tdb:
-            tdb = self.tdb
+                )
+                self.load_name_caches()
+        finally:
+            staging.drop()
+        if result.unknown:
+            print(f"Warning: {result.unknown} stations are in an unknown system.")
+        print(f"Done updating stations. {result}")
+
+    def update_local_commodities(self, session: TradeDBSession = None):
+        if session is None:
+            with TradeDBSession() as session:
+                return self.update_local_commodities(session)
         print("Updating categories...")
+        categories = dict(
+            CommodityCategory.objects.values_list("tradedangerous_id", "id")
+        )
         td_category: TDCategory
-        for _, td_category in tdb.categories():
-            if not CommodityCategory.objects.filter(
-                tradedangerous_id=td_category.ID
-            ).exists():
-                com_category = CommodityCategory(
-                    tradedangerous_id=td_category.ID, name=td_category.dbname
-                )
-                com_category.save()
+        new_categories = [
+            CommodityCategory(tradedangerous_id=td_category.ID, name=td_category.dbname)
+            for _, td_category in session.tdb.categories()
+            if td_category.ID not in categories
+        ]
+        if new_categories:
+            CommodityCategory.objects.bulk_create(new_categories)
+            for com_category in new_categories:
                 print(f"Adding category: {com_category}")
+                categories[com_category.tradedangerous_id] = com_category.id
 
         print("Updating commodities...")
+        commodities = {
+            commodity.tradedangerous_id: commodity
+            for commodity in Commodity.objects.only(
+                "id", "tradedangerous_id", "game_id", "average_price"
+            )
+        }
+        game_ids = {commodity.game_id for commodity in commodities.values()}
+        new_commodities, updated_commodities = [], []
         td_item: TDItem
-        for td_item in tdb.items():
-            if not Commodity.objects.filter(tradedangerous_id=td_item.ID).exists():
-                commodity = Commodity(
-                    tradedangerous_id=td_item.ID,
-                    game_id=td_item.fdevID,
-                    name=td_item.dbname,
-                    category=CommodityCategory.objects.get(
-                        tradedangerous_id=td_item.category.ID
-                    ),
-                    average_price=td_item.avgPrice if td_item.avgPrice else -1,
+        for td_item in session.tdb.items():
+            average_price = td_item.avgPrice if td_item.avgPrice else -1
+            commodity = commodities.get(td_item.ID)
+            if commodity:
+                if commodity.average_price != average_price:
+                    commodity.average_price = average_price
+                    updated_commodities.append(commodity)
+            elif td_item.fdevID in game_ids:
+                print(
+                    f"Could not add commodity: {td_item.dbname} because game_id {td_item.fdevID} is taken"
+                )
+            else:
+                game_ids.add(td_item.fdevID)
+                new_commodities.append(
+                    Commodity(
+                        tradedangerous_id=td_item.ID,
+                        game_id=td_item.fdevID,
+                        name=td_item.dbname,
+                        category_id=categories[td_item.category.ID],
+                        average_price=average_price,
+                    )
                 )
-                try:
-                    commodity.save()
-                    print(f"Adding commodity: {commodity}")
-                except IntegrityError as e:
-                    print(f"Could not add commodity: {commodity} because {e}")
+        if new_commodities:
+            Commodity.objects.bulk_create(new_commodities)
+            for commodity in new_commodities:
+                print(f"Adding commodity: {commodity.name}")
+        if updated_commodities:
+            Commodity.objects.bulk_update(
+                updated_commodities, ["average_price"], batch_size=1000
+            )
+            print(
+                f"Updated the average price of {len(updated_commodities)} commodities."
+            )
 
         print("Updating rares...")
+        rare_names = set(Rare.objects.values_list("name", flat=True))
+        new_rares = []
         td_rare: TDIRareItem
-        for td_rare in tdb.rareItemByID.values():
-            if not Rare.objects.filter(name=td_rare.dbname).exists():
-                rare = Rare(
-                    tradedangerous_id=td_rare.ID,
-                    name=td_rare.dbname,
-                    category=CommodityCategory.objects.get(
-                        tradedangerous_id=td_rare.category.ID
-                    ),
-                    cost=td_rare.costCr,
-                    max_alloc=td_rare.maxAlloc,
-                    illegal=td_rare.illegal == "Y",
-                    suppressed=td_rare.suppressed == "Y",
+        for td_rare in session.tdb.rareItemByID.values():
+            if td_rare.dbname not in rare_names:
+                rare_names.add(td_rare.dbname)
+                new_rares.append(
+                    Rare(
+                        tradedangerous_id=td_rare.ID,
+                        name=td_rare.dbname,
+                        category_id=categories[td_rare.category.ID],
+                        cost=td_rare.costCr,
+                        max_alloc=td_rare.maxAlloc,
+                        illegal=td_rare.illegal == "Y",
+                        suppressed=td_rare.suppressed == "Y",
+                    )
                 )
-                rare.save()
-                print(f"Adding rare: {rare}")
-
-    def update_local_listings2(self, tdb=None, full_update=True):
-        changeable_attributes = [
-            "demand_price",
-            "demand_units",
-            "supply_price",
-            "supply_units",
-            "modified",
-        ]
-        if not tdb:
-            tdb = self.tdb
-        stations: {int: Station} = {
-            station.tradedangerous_id: station
-            for station in Station.objects.only(
-                "id", "pad_size", "fleet", "tradedangerous_id"
+        if new_rares:
+            Rare.objects.bulk_create(new_rares)
+            for rare in new_rares:
+                print(f"Adding rare: {rare.name}")
+
+    def update_local_listings2(
+        self,
+        session: TradeDBSession = None,
+        full_update=None,
+        workers=None,
+        progress: ImportProgress = None,
+    ):
+        """
+        Import the listings from TradeDangerous. Only the listings that changed since the previous import
+        are read, unless full_update is True or a periodic full reconciliation is due.
+        :param progress: Checkpoint every station range, and skip the ranges that are already checkpointed.
+        """
+        if session is None:
+            with TradeDBSession() as session:
+                return self.update_local_listings2(
+                    session, full_update, workers, progress
+                )
+        workers = workers or settings.IMPORT_WORKERS
+        watermark = ImportWatermark.for_source(TD_WATERMARK_SOURCE)
+        if full_update is None:
+            full_update = watermark.needs_reconciliation()
+        # Without a watermark there is nothing to be incremental to.
+        full_update = full_update or not watermark.modified
+        since = (
+            None if full_update else watermark.modified.strftime(TD_TIMESTAMP_FORMAT)
+        )
+        print(
+            "Starting TD query..."
+            + (
+                " (full reconciliation)"
+                if full_update
+                else f" (modified after {since})"
             )
-            .all()
-            .iterator()
-        }
-        commodities_td_to_django_ids: {int: int} = {
-            commodity.tradedangerous_id: commodity.id
-            for commodity in Commodity.objects.only("id", "tradedangerous_id")
-            .all()
-            .iterator()
-        }
-        carriers_of_interest: {int: Station} = self.get_carriers_of_interest()
-        print("Carriers of interest: ", carriers_of_interest)
-        print("Starting TD query...")
-        t0 = time.time()
-        # min_station_id, max_station_id = list(tdb.getDB().cursor().execute('SELECT (min("station_id"), max("station_id")) FROM StationItem'))
-        td_listings_station_ids = sorted(
-            [
-                r[0]
-                for r in tdb.getDB()
-                .cursor()
-                .execute('SELECT "station_id" FROM StationItem')
-            ]
         )
+        # Rows that are written while this import runs are picked up by the next one.
+        (td_max_modified,) = session.execute(
+            "SELECT max(modified) FROM StationItem"
+        ).fetchone()
         TD_PART_SIZE = 200000
-        new_listings = []
-        total_new_listings = 0
-        new_historic_listings = []
-        total_new_historic_listings = 0
-        ignored_historic_listings = 0
-        updated_listings = []
-        total_updated_listings = 0
-        total_updated_carriers = 0
-
-        visited_listings = set()
-        deleted_listings_ids = []
-        # station_ids_part_start = min_station_id
-        for station_ids_chunk in tqdm(
-            chunks_no_overlap(td_listings_station_ids, TD_PART_SIZE)
-        ):
-            min_station_td_id, max_station_td_id = min(station_ids_chunk), max(
-                station_ids_chunk
+        td_ranges = td_station_ranges(session.tdb.conn, TD_PART_SIZE, since=since)
+        if progress:
+            todo = [
+                td_range
+                for td_range in td_ranges
+                if not progress.is_done("listings", "td:{}-{}".format(*td_range))
+            ]
+            progress.set_total(len(td_ranges), done=len(td_ranges) - len(todo))
+            td_ranges = todo
+        total = MergeResult()
+        if workers > 1:
+            print(f"Importing {len(td_ranges)} chunks with {workers} processes.")
+            # Forked workers must not share the connection of this process.
+            db.connections.close_all()
+            pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("fork")
             )
-            t1 = time.time()
-
-            if full_update:
-                # TODO: Maybe parse from csv file instead.
-                td_row_part = list(
-                    tdb.getDB()
-                    .cursor()
-                    .execute(
-                        "SELECT * FROM StationItem WHERE station_id >= ? and station_id <= ? ORDER BY station_id, item_id",
-                        [min_station_td_id, max_station_td_id],
-                    )
+            # Only a few chunks are queued at a time, so a cancelled job stops after those.
+            remaining, pending = iter(td_ranges), {}
+            try:
+                with tqdm(total=len(td_ranges)) as bar:
+                    while True:
+                        for td_range in itertools.islice(
+                            remaining, workers * 2 - len(pending)
+                        ):
+                            pending[
+                                pool.submit(
+                                    merge_td_listings_range,
+                                    session.filename,
+                                    *td_range,
+                                    since,
+                                )
+                            ] = td_range
+                        if not pending:
+                            break
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            td_range = pending.pop(future)
+                            result = future.result()
+                            total += result
+                            bar.update()
+                            if progress:
+                                progress.checkpoint(
+                                    "listings", "td:{}-{}".format(*td_range), result
+                                )
+            except JobCancelled:
+                pool.shutdown(cancel_futures=True)
+                # The chunks that were running have been committed, so a resumed run skips them.
+                for future, td_range in pending.items():
+                    if not future.cancelled() and future.exception() is None:
+                        with contextlib.suppress(JobCancelled):
+                            progress.checkpoint(
+                                "listings",
+                                "td:{}-{}".format(*td_range),
+                                future.result(),
+                            )
+                raise
+            finally:
+                pool.shutdown()
+        else:
+            for min_station_td_id, max_station_td_id in tqdm(td_ranges):
+                result = merge_td_listings_range(
+                    session.filename, min_station_td_id, max_station_td_id, since
                 )
-            else:
-                td_row_part = list(
-                    tdb.getDB()
-                    .cursor()
-                    .execute(
-                        "SELECT * FROM StationItem WHERE from_live = 1 and station_id >= ? and station_id <= ? ORDER BY station_id, item_id",
-                        [min_station_td_id, max_station_td_id],
+                total += result
+                if progress:
+                    progress.checkpoint(
+                        "listings",
+                        f"td:{min_station_td_id}-{max_station_td_id}",
+                        result,
                     )
-                )
-
-            existing_live_listings = {
-                (ll.station_id, ll.commodity_id): ll
-                for ll in LiveListing.objects.filter(
-                    Q(station_tradedangerous_id__gte=min_station_td_id)
-                    & Q(station_tradedangerous_id__lte=max_station_td_id)
-                ).all()
-            }  # Problem
-            db.reset_queries()
-            for td_item_station_row in td_row_part:
-                (
-                    station_td_id,
-                    item_td_id,
-                    demand_price,
-                    demand_units,
-                    _,
-                    supply_price,
-                    supply_units,
-                    _,
-                    modified_str,
-                    from_live,
-                ) = td_item_station_row
-                modified = make_timezone_aware(
-                    datetime.datetime.strptime(modified_str, "%Y-%m-%d %H:%M:%S")
-                )
-                try:
-                    station: Station = stations[station_td_id]
-                except KeyError:
-                    # Station does not exist in db.
-                    # print(f"Station TD id {station_td_id} does not exist in django database.")
-                    station = None
-                if station:
-                    # if station.fleet and station.id not in carriers_of_interest:
-                    #     continue
-                    # if station.fleet:
-                    #     total_updated_carriers += 1
-                    station_id = station.id
-                    com_id = commodities_td_to_django_ids.get(item_td_id, None)
-                    if not com_id:
-                        print(
-                            f"Warning: Did not find commodity with game_id={item_td_id}"
-                        )
-                        continue
-
-                    visited_listings.add((station_id, com_id))
-
-                    try:
-                        existing_live_listing = existing_live_listings[
-                            (station_id, com_id)
-                        ]
-                        visited_listings.add(existing_live_listing.id)
-                        if modified != existing_live_listing.modified:
-                            if not station.fleet:
-                                if (
-                                    difference_percent(
-                                        existing_live_listing.demand_price, demand_price
-                                    )
-                                    > settings.HISTORIC_DIFFERENCE_DELTA
-                                    or difference_percent(
-                                        existing_live_listing.supply_price, supply_price
-                                    )
-                                    > settings.HISTORIC_DIFFERENCE_DELTA
-                                ):
-                                    new_historic_listings.append(
-                                        HistoricListing.from_live(existing_live_listing)
-                                    )
-                                    total_new_historic_listings += 1
-                                else:
-                                    ignored_historic_listings += 1
-                            existing_live_listing.demand_price = demand_price
-                            existing_live_listing.demand_units = demand_units
-                            # existing_live_listing.demand_level = demand_level
-                            existing_live_listing.supply_price = supply_price
-                            existing_live_listing.supply_units = supply_units
-                            # existing_live_listing.supply_level = supply_level
-                            existing_live_listing.modified = modified
-                            updated_listings.append(existing_live_listing)
-                            total_updated_listings += 1
-                    except KeyError as e:
-                        live_listing = LiveListing(
-                            commodity_id=com_id,
-                            commodity_tradedangerous_id=item_td_id,
-                            station_id=station_id,
-                            station_tradedangerous_id=station_td_id,
-                            demand_price=demand_price,
-                            demand_units=demand_units,
-                            supply_price=supply_price,
-                            supply_units=supply_units,
-                            modified=modified,
-                            from_live=from_live,
-                        )
-                        new_listings.append(live_listing)
-                        total_new_listings += 1
-                else:
-                    # Station not found.
-                    ...
-
-            for (
-                existing_listing_key,
-                existing_listing,
-            ) in existing_live_listings.items():
-                if existing_listing_key not in visited_listings:
-                    deleted_listings_ids.append(existing_listing.id)
-
-        print(
-            f"new={len(new_listings)}, up={len(updated_listings)}, del={len(deleted_listings_ids)}, hist={len(new_historic_listings)}, ignored={ignored_historic_listings}"
-        )
-        if new_listings:
-            print("Saving new listings")
-            t0 = time.time()
-            for chunk in tqdm(list(chunks(new_listings, 200000))):
-                LiveListing.objects.bulk_create(list(chunk))
-            print(f"Saving new took {time.time() - t0}")
-        db.reset_queries()
-        del new_listings
-
-        if new_historic_listings:
-            print("Saving new historic listings")
-            for chunk in tqdm(list(chunks(new_historic_listings, 200000))):
-                HistoricListing.objects.bulk_create(list(chunk))
                 db.reset_queries()
-        del new_historic_listings
+        if total.unknown:
+            print(
+                f"Warning: {total.unknown} listings reference an unknown station or commodity."
+            )
+        if td_max_modified:
+            watermark.advance(parse_timestamp(td_max_modified), reconciled=full_update)
+        StationMarkets().invalidate()
+        ListingIndex().invalidate()
+        print(f"Done updating listings. {total}")
 
-        t0 = time.time()
-        if updated_listings:
-            print("Saving updated listings")
-            for chunk in tqdm(list(chunks(updated_listings, 20000))):
-                # LiveListing.objects.bulk_update(list(chunk), changeable_attributes)
-                with transaction.atomic():
-                    ll: LiveListing
-                    for ll in chunk:
-                        # print(model_to_dict(ll))
-                        LiveListing.objects.filter(id=ll.id).update(
-                            **model_to_dict(ll)
-                        )  # https://www.sankalpjonna.com/learn-django/running-a-bulk-update-with-django
-        if deleted_listings_ids:
-            print(f"Deleting {len(deleted_listings_ids)} listings.")
-            for chunk in tqdm(list(chunks(deleted_listings_ids, 10000))):
-                LiveListing.objects.filter(pk__in=chunk).delete()
-
-        db.reset_queries()
-        del updated_listings
-        print(f"Saving updated listings: {time.time() - t0}")
-        print(
-            f"Done updating listings. {total_new_listings} new, {total_updated_listings} updated ({total_updated_carriers} FC listings), {total_new_historic_listings} historic added, {ignored_historic_listings} historic ignored."
-        )
+    def update_local_listings_csv(
+        self,
+        session: TradeDBSession = None,
+        full_update=None,
+        progress: ImportProgress = None,
+    ):
+        """
+        Import the listings straight from eddblink's listings files, without going through
+        TradeDangerous' database. Markets that are not newer than the previous import are skipped,
+        unless full_update is True or a periodic full reconciliation is due.
+        :param progress: Checkpoint every merged chunk, and skip the chunks that are already checkpointed.
+        """
+        if session is None:
+            with TradeDBSession() as session:
+                return self.update_local_listings_csv(session, full_update, progress)
+        data_path = eddblink_data_path(session.tdb)
+        total = MergeResult()
+        paths = []
+        for name, from_live in [(LISTINGS_CSV, False), (LIVE_LISTINGS_CSV, True)]:
+            try:
+                if download_listings_file(data_path, name):
+                    print(f"Downloaded {name}.")
+            except OSError as e:
+                print(f"Failed to download {name}: {e}")
+            path = find_listings_file(data_path, name)
+            if not path:
+                print(f"Warning: {name} not found in {data_path}.")
+                continue
+            paths.append((name, from_live, path))
+        offset = 0
+        if progress:
+            progress.set_total(
+                sum(path.stat().st_size for _, _, path in paths), unit="bytes"
+            )
+        for name, from_live, path in paths:
+            watermark = ImportWatermark.for_source(f"eddblink:{name}")
+            full = full_update
+            if full is None:
+                full = watermark.needs_reconciliation()
+            since = None if full else watermark.modified
+            print(
+                f"Importing {path}" + (f" (collected after {since})" if since else "")
+            )
+            result, newest = merge_listings_file(
+                path,
+                from_live=from_live,
+                since=since,
+                progress=progress,
+                progress_offset=offset,
+            )
+            watermark.advance(newest, reconciled=full)
+            total += result
+            offset += path.stat().st_size
+        if total.unknown:
+            print(
+                f"Warning: {total.unknown} listings reference an unknown station or commodity."
+            )
+        StationMarkets().invalidate()
+        ListingIndex().invalidate()
+        print(f"Done updating listings. {total}")
 
     def update_cache(self):
         commodities = list(Commodity.objects.all())
@@ -740,50 +645,111 @@ class EDData(metaclass=SingletonMeta):
         update_commodities=True,
         update_listings=True,
         update_cache=True,
-        full_listings_update=True,
+        full_listings_update=None,
+        resume=True,
+        job: Job = None,
     ):
-        if self.live_listener:
-            self.live_listener.pause()
+        """
+        Update the local database from TradeDangerous and eddblink, one stage at a time.
+        The live listener keeps running. Both sides only overwrite listings with newer ones, and the
+        listener's messages are spooled during the critical sections.
+        Every finished stage and listings chunk is checkpointed in an ImportRun. A run that was
+        interrupted is resumed from its checkpoints when it is restarted with the same arguments,
+        unless resume is False.
+        :param job: The scheduler job that runs the update. Cancelling it stops the update at its next checkpoint.
+        """
+        progress = ImportProgress.start(
+            {
+                "data": data,
+                "update_systems": update_systems,
+                "update_stations": update_stations,
+                "update_commodities": update_commodities,
+                "update_listings": update_listings,
+                "update_cache": update_cache,
+                "full_listings_update": full_listings_update,
+            },
+            resume=resume,
+            job=job,
+        )
+        if settings.LISTINGS_SOURCE == "csv":
+            update_listings_stage = self.update_local_listings_csv
+        else:
+            update_listings_stage = self.update_local_listings2
+        # TradeDangerous' database is loaded once, after its import, and shared by all stages.
+        session = TradeDBSession()
+        stages = [
+            (
+                "tradedangerous",
+                data,
+                lambda: self.update_tradedangerous_database(
+                    listings=settings.LISTINGS_SOURCE != "csv"
+                ),
+            ),
+            ("systems", update_systems, lambda: self.update_local_systems(session)),
+            ("stations", update_stations, lambda: self.update_local_stations(session)),
+            (
+                "commodities",
+                update_commodities,
+                lambda: self.update_local_commodities(session),
+            ),
+            (
+                "listings",
+                update_listings,
+                lambda: update_listings_stage(
+                    session, full_update=full_listings_update, progress=progress
+                ),
+            ),
+            ("cache", update_cache, self.update_cache),
+        ]
         t0 = time.time()
-        tdb = None
-        if data:
-            t1 = time.time()
-            self.update_tradedangerous_database()
-            print(f"Updating TradeDangerous took {time.time() - t1} seconds")
-        if update_systems:
-            tdb = self.tdb
-            t2 = time.time()
-            self.update_local_systems(tdb)
-            print(f"Updating systems took {time.time() - t2} seconds")
-        if update_stations:
-            tdb = self.tdb
-            t3 = time.time()
-            self.update_local_stations(tdb)
-            print(f"Updating stations took {time.time() - t3} seconds")
-        if update_commodities:
-            tdb = self.tdb
-            t4 = time.time()
-            self.update_local_commodities(tdb)
-            print(f"Updating commodities took {time.time() - t4} seconds")
-        if update_listings:
-            tdb = self.tdb
-            t5 = time.time()
-            self.update_local_listings2(tdb, full_update=full_listings_update)
-            # self.update_local_listings(tdb, full_update=full_listings_update)
-            print(f"Updating listings took {time.time() - t5} seconds")
-        if update_cache:
-            t6 = time.time()
-            self.update_cache()
-            print(f"Updating cache took {time.time() - t6} seconds")
+        try:
+            with session:
+                for name, enabled, update in stages:
+                    if not enabled:
+                        continue
+                    if progress.is_done(name):
+                        print(f"Skipping {name}, it was already updated.")
+                        continue
+                    t1 = time.time()
+                    with progress.stage(name):
+                        update()
+                    print(f"Updating {name} took {time.time() - t1} seconds")
+        except BaseException as e:
+            progress.fail(e)
+            raise
+        progress.finish()
         print(f"Updating entire database took {time.time() - t0} seconds")
-        if self.live_listener:
-            self.live_listener.unpause()
 
     def avg_selling_items(self):
-        return self.tdb.getAverageSelling()
+        with TradeDBSession() as session:
+            return session.tdb.getAverageSelling()
 
     def get_avg_buying_items(self):
-        return self.tdb.getAverageBuying()
+        with TradeDBSession() as session:
+            return session.tdb.getAverageBuying()
+
+
+def database_update_options(mode: str) -> dict:
+    """The arguments of EDData.update_local_database for an update mode: all, quick, listings or cache."""
+    update_all = mode == "all"
+    quick = mode == "quick"
+    listings = mode == "listings"
+    cache = mode == "cache"
+    return dict(
+        data=update_all,
+        update_stations=update_all or quick,
+        update_systems=update_all or quick,
+        update_commodities=update_all or quick,
+        update_listings=update_all or listings,
+        update_cache=update_all or listings or cache,
+        full_listings_update=True if update_all else None,
+    )
+
+
+def database_update_job(mode: str):
+    """A JobScheduler target that updates the database in the given mode."""
+    options = database_update_options(mode)
+    return lambda job: EDData().update_local_database(**options, job=job)
 
 
 if __name__ == "__main__":
@@ -9,10 +9,12 @@ import datetime
 import zmq
 import EDSite.tools.ed_data as ed_data
 from dataclasses import dataclass, field
+from pathlib import Path
 from pprint import pprint
 from urllib import request
 from typing import Optional, Any
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from django.db import transaction
 from django.db.models import Q
 from EDSite.helpers import is_carrier_name, make_timezone_aware, get_alt_commodity_names
@@ -29,13 +31,19 @@ from EDSite.models import (
     LocalFaction,
     FactionHappiness,
 )
+from EDSite.tools.eddn_spool import MessageSpool
 from EDSite.tools.external import edsm
+from EDSite.tools.listings_merge import ListingsLocked
+from EDSite.tools.timestamps import parse_timestamp
+from EDSiteProject import settings
 
 logger = logging.getLogger(__name__)
 
 EDDN_URI = "tcp://eddn.edcd.io:9500"
 EDDN_TIMEOUT = 60000
 EDDN_RECONNECT = 10
+# Seconds before a message whose listings were locked by an import is processed again.
+DEFER_SECONDS = 30
 
 ALT_COMMODITY_NAMES = get_alt_commodity_names()
 
@@ -109,14 +117,25 @@ def determine_station_and_system(
     return system, station
 
 
-def create_listings(new_listings: {Station, list[LiveListing]}):
+def create_listings(
+    new_listings: {Station, list[LiveListing]}
+) -> ([Station], [Station]):
+    """
+    Write the listings of every station.
+    :return: The stations whose modified time changed, and the stations whose listings were locked.
+    """
     stations = []
+    locked = []
     for station, listings in new_listings.items():
         if station.name == "K7Q-BQL":
             logger.info(
                 f"Updating station listing of {station}({station.id})({station.tradedangerous_id}) to {len(listings)}"
             )
-        station.set_listings(listings)
+        try:
+            station.set_listings(listings)
+        except ListingsLocked:
+            locked.append(station)
+            continue
         # print(f"Creating listings: {station}")
         for new_listing in listings:
             cached_buy, cached_sell = new_listing.cache_if_better()
@@ -126,7 +145,7 @@ def create_listings(new_listings: {Station, list[LiveListing]}):
             except IndexError:
                 station.modified = make_timezone_aware(datetime.datetime.now())
             stations.append(station)
-    return stations
+    return stations, locked
 
 
 def create_station(station_name: str, system: System, extra=None) -> Optional[Station]:
@@ -194,10 +213,22 @@ class EDDNSchemaProcessor(ABC):
         self.active = True
         self.message_queue = queue.Queue()
         self.last_batch_time = time.time()
+        # Held while a batch is processed, and by the listener during critical sections of an import.
+        self.process_lock = threading.Lock()
+        # The spool that the messages came from. Processed messages are acknowledged to it.
+        self.spool: Optional[MessageSpool] = None
+        # Spool offsets of the current batch by message, and the messages that are retried later.
+        self.batch_offsets: {int: int} = {}
+        self.deferred: [(float, int, dict)] = []
         threading.Thread(target=self.__processor_thread, daemon=True).start()
 
-    def add_message(self, entry):
-        self.message_queue.put(entry)
+    def add_message(self, entry, offset: Optional[int] = None):
+        self.message_queue.put((offset, entry))
+
+    def defer(self, message):
+        """Process a message of the current batch again later. It stays unacknowledged until then."""
+        offset = self.batch_offsets.pop(id(message), None)
+        self.deferred.append((time.time() + DEFER_SECONDS, offset, message))
 
     def __processor_thread(self):
         """
@@ -205,10 +236,24 @@ class EDDNSchemaProcessor(ABC):
         """
         while self.active:
             time.sleep(self.__processor_thread_timout)
+            if self.deferred and self.deferred[0][0] <= time.time():
+                due = [entry for entry in self.deferred if entry[0] <= time.time()]
+                self.deferred = self.deferred[len(due) :]
+                for _, offset, message in due:
+                    self.add_message(message, offset)
             if (time.time() - self.last_batch_time >= self.max_batch_timeout) or (
                 self.message_queue.qsize() >= self.max_batch_size
             ):
-                self.process()
+                with self.process_lock:
+                    self.process()
+                    # Everything that was not deferred has been committed.
+                    if self.spool is not None:
+                        self.spool.ack(
+                            offset
+                            for offset in self.batch_offsets.values()
+                            if offset is not None
+                        )
+                    self.batch_offsets = {}
                 self.last_batch_time = time.time()
 
     @abstractmethod
@@ -218,19 +263,15 @@ class EDDNSchemaProcessor(ABC):
     def get_message_batch(self):
         messages = []
         while not self.message_queue.empty():
-            messages.append(self.message_queue.get())
+            offset, message = self.message_queue.get()
+            self.batch_offsets[id(message)] = offset
+            messages.append(message)
         return messages
 
     def parse_timestamp(self, timestamp_string: str) -> Optional[datetime.datetime]:
         try:
-            timestamp_string = timestamp_string.replace("T", " ").replace("Z", "")
-            if "." in timestamp_string:
-                timestamp_string = timestamp_string.split(".")[0]
-            modified = make_timezone_aware(
-                datetime.datetime.strptime(timestamp_string, "%Y-%m-%d %H:%M:%S")
-            )
-            return modified
-        except Exception as e:
+            return parse_timestamp(timestamp_string)
+        except (TypeError, ValueError):
             logger.error(f"Could not parse datetime from message: {timestamp_string}")
 
 
@@ -286,6 +327,10 @@ class CommodityProcessor(EDDNSchemaProcessor):
         to_update_stations: {str, Station} = {}
         new_listings: {Station: list} = {}
         new_stations: {(str, str), {str: Any}} = {}
+        # The message and the modified time of the listings of every station in new_listings. The
+        # modified time of a station only advances once its listings have been written.
+        station_messages: {Station: dict} = {}
+        station_modified: {Station: datetime.datetime} = {}
         for message in messages:
             header = message["header"]
             data = message["message"]
@@ -321,22 +366,22 @@ class CommodityProcessor(EDDNSchemaProcessor):
                     f"Moved carrier {station} from {station.system} to {system}"
                 )
                 station.system_id = system.id
-                station.modified = modified
                 to_update_stations[station.id] = station
 
             if station:
-                # logger.warning(f"{station}, {modified - station.modified}")
+                last_modified = station_modified.get(station, station.modified)
+                # logger.warning(f"{station}, {modified - last_modified}")
                 if is_carrier_name(
                     station.name
-                ) or modified - station.modified > datetime.timedelta(minutes=4):
+                ) or modified - last_modified > datetime.timedelta(minutes=4):
                     # Update the listings.
                     if station not in new_listings:
                         new_listings[station] = []
                     new_listings[station] = self.parse_listings(
                         station, modified, commodities
                     )
-                    station.modified = modified
-                    to_update_stations[station.id] = station
+                    station_messages[station] = message
+                    station_modified[station] = modified
 
             if not station:
                 # It's a new station:
@@ -345,7 +390,7 @@ class CommodityProcessor(EDDNSchemaProcessor):
                         "system": system,
                         "station_name": station_name,
                         "modified": modified,
-                        "extra": {"listings": commodities},
+                        "extra": {"listings": commodities, "message": message},
                     }
                 # else:
                 #     logger.warning(f"Station {station_name} was already in retry_stations. It has been skipped.")
@@ -353,11 +398,12 @@ class CommodityProcessor(EDDNSchemaProcessor):
             station_name = new_station_data["station_name"]
             system = new_station_data["system"]
             modified = new_station_data["modified"]
-            listings = new_station_data["extra"]["listings"]
+            extra = new_station_data["extra"]
+            listings = extra["listings"]
             # logger.info(
             #     f"Station not found: {(station_name, system.name)}. Will create a temporary one."
             # )
-            station = create_station(station_name, system, extra={"listings": listings})
+            station = create_station(station_name, system, extra=extra)
             if station:
                 ed_data.EDData().station_names_dict[
                     (station_name.lower(), system.name.lower())
@@ -367,12 +413,13 @@ class CommodityProcessor(EDDNSchemaProcessor):
                 self.retry_stations[(system.name, station_name)] = RetryStation(
                     system=system,
                     station_name=station_name,
-                    extra={"listings": listings},
+                    extra=extra,
                 )
             if station:
                 if station not in new_listings:
                     new_listings[station] = []
                 new_listings[station] = self.parse_listings(station, modified, listings)
+                station_messages[station] = extra["message"]
 
         retry_station: RetryStation
         for retry_station in self.retry_stations.values():
@@ -393,12 +440,21 @@ class CommodityProcessor(EDDNSchemaProcessor):
                             station.modified,
                             retry_station.extra["listings"],
                         )
+                        station_messages[station] = retry_station.extra["message"]
         self.retry_stations = {
             key: rs for key, rs in self.retry_stations.items() if rs.retries > 0
         }
 
         if new_listings:
-            updated_stations = create_listings(new_listings)
+            updated_stations, locked_stations = create_listings(new_listings)
+            for station in locked_stations:
+                # An import holds the listings. The message is retried later, the newest listing wins.
+                # The station keeps its modified time, so the retry passes the freshness check.
+                self.defer(station_messages[station])
+            for station, modified in station_modified.items():
+                if station not in locked_stations:
+                    station.modified = modified
+                    to_update_stations[station.id] = station
             # for s in new_listings.keys():
             #     logger.info(f"Updated listings for {s}")
             new_listings.clear()
@@ -716,18 +772,63 @@ class EDDNListener:
     subscriber = context.socket(zmq.SUB)
     subscriber.setsockopt(zmq.SUBSCRIBE, b"")
 
-    def __init__(self):
-        self.paused = False
+    def __init__(self, spool_dir: Optional[Path] = None):
+        """
+        :param spool_dir: Where the messages are spooled, settings.EDDN_SPOOL_DIR by default. Tests and
+            manual runs pass a temporary directory, so they do not replay or acknowledge live messages.
+        """
         self.active = False
         self.listener_thread = None
+        # Every message is appended to the spool before it is processed, and acknowledged once it has
+        # been committed. Unacknowledged messages are replayed after a restart. Messages that arrive
+        # during a critical section of an import are held in the spool until it ends.
+        self.spool = MessageSpool(spool_dir or settings.EDDN_SPOOL_DIR)
+        self.critical_sections = 0
+        self.critical_lock = threading.Lock()
+        self.held_from: Optional[int] = None
+        # Set once the first pause() of a critical section holds every processor.
+        self.processors_held = threading.Event()
 
         self.schema_processors: {str: EDDNSchemaProcessor} = {
             "https://eddn.edcd.io/schemas/commodity/3": CommodityProcessor(),
             "https://eddn.edcd.io/schemas/journal/1": JournalProcessor(),
         }
+        for processor in self.schema_processors.values():
+            processor.spool = self.spool
+
+    @property
+    def paused(self) -> bool:
+        return self.critical_sections > 0
+
+    def dispatch(self, offset: int, message: dict):
+        processor = self.schema_processors.get(message.get("$schemaRef"))
+        if processor:
+            processor.add_message(message, offset)
+        else:
+            self.spool.ack([offset])
+
+    def receive(self, message: dict):
+        with self.critical_lock:
+            offset = self.spool.append(message)
+            if self.paused:
+                if self.held_from is None:
+                    self.held_from = offset
+                return
+        self.dispatch(offset, message)
+
+    def replay(self, start: int, end: Optional[int] = None):
+        """Hand the spooled messages from offset start up to end to the processors."""
+        count = 0
+        for offset, message in self.spool.read(start, end):
+            self.dispatch(offset, message)
+            count += 1
+        if count:
+            logger.info(f"Replayed {count} spooled EDDN messages.")
 
     def start_listening(self):
         self.active = True
+        # Messages that were not committed before a restart.
+        self.replay(self.spool.acked_until)
         while self.active:
             try:
                 self.subscriber.connect(EDDN_URI)
@@ -735,10 +836,6 @@ class EDDNListener:
                 poller.register(self.subscriber, zmq.POLLIN)
 
                 while self.active:
-                    if self.paused:
-                        time.sleep(1)
-                        continue
-
                     socks = dict(poller.poll(EDDN_TIMEOUT))
                     if socks:
                         if socks.get(self.subscriber) == zmq.POLLIN:
@@ -746,10 +843,7 @@ class EDDNListener:
                             message = zlib.decompress(message)
                             message = message.decode()
                             message = json.loads(message)
-                            schema = message["$schemaRef"]
-                            processor = self.schema_processors.get(schema)
-                            if processor:
-                                processor.add_message(message)
+                            self.receive(message)
                     else:
                         logger.error("Disconnect from EDDN (After timeout)")
                         self.subscriber.disconnect(EDDN_URI)
@@ -774,9 +868,42 @@ class EDDNListener:
         self.listener_thread.start()
 
     def pause(self):
-        logger.info("Pausing the EDDBLink")
-        self.paused = True
+        """
+        Enter a critical section. The batch that is being processed is finished, after which processing
+        is held and new messages are spooled until the matching unpause().
+        """
+        with self.critical_lock:
+            self.critical_sections += 1
+            first = self.critical_sections == 1
+            if first:
+                self.processors_held.clear()
+        # The batches are waited for outside of critical_lock, so receive() keeps spooling meanwhile.
+        if first:
+            logger.info("Pausing the EDDN processors")
+            for processor in self.schema_processors.values():
+                processor.process_lock.acquire()
+            self.processors_held.set()
+        else:
+            self.processors_held.wait()
 
     def unpause(self):
-        logger.info("Un-Pausing the EDDBLink")
-        self.paused = False
+        with self.critical_lock:
+            self.critical_sections -= 1
+            if self.critical_sections:
+                return
+            logger.info("Un-Pausing the EDDN processors")
+            for processor in self.schema_processors.values():
+                processor.process_lock.release()
+            # Messages from here on are dispatched by receive() again.
+            held_from, held_until = self.held_from, self.spool.next_offset
+            self.held_from = None
+        if held_from is not None:
+            self.replay(held_from, held_until)
+
+    @contextmanager
+    def critical_section(self):
+        self.pause()
+        try:
+            yield
+        finally:
+            self.unpause()
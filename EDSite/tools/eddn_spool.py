@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".log"
+ACK_FILE = "acked"
+# A segment is closed and a new one started once it holds this many bytes.
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+# Appends are flushed to the OS right away, which survives a restart of the process. They are only
+# fsync'ed once per interval, which bounds what a crash of the machine can lose.
+FSYNC_INTERVAL = 1.0
+
+
+class MessageSpool:
+    """
+    Append-only log of raw EDDN messages, split into segments on disk.
+    Every message is appended before it is processed and gets an offset. Processors acknowledge the
+    offsets of the messages they committed. Everything from the first unacknowledged offset on is
+    replayed after a restart, and segments that are fully acknowledged are deleted.
+
+    Segments are named after the offset of their first message and hold one JSON message per line.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Offsets after acked_until that have been acknowledged out of order.
+        self.acked = set()
+        self.acked_until = self._read_ack()
+        self.segment = None
+        self.segment_base = None
+        self.segment_bytes = 0
+        self.last_fsync = time.monotonic()
+        self.next_offset = self._recover()
+        self.acked_until = min(self.acked_until, self.next_offset)
+
+    def _segment_path(self, base: int) -> Path:
+        return self.directory / f"{base:020d}{SEGMENT_SUFFIX}"
+
+    def _segment_bases(self) -> [int]:
+        return sorted(
+            int(path.stem) for path in self.directory.glob(f"*{SEGMENT_SUFFIX}")
+        )
+
+    def _read_ack(self) -> int:
+        try:
+            return int((self.directory / ACK_FILE).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_ack(self):
+        path = self.directory / ACK_FILE
+        partial = path.with_suffix(".part")
+        partial.write_text(str(self.acked_until))
+        os.replace(partial, path)
+
+    def _recover(self) -> int:
+        """
+        Find the offset of the next message. A line that was cut off by a crash is truncated, so the
+        offsets of the lines keep matching their position.
+        """
+        bases = self._segment_bases()
+        if not bases:
+            return self.acked_until
+        path = self._segment_path(bases[-1])
+        with open(path, "rb+") as fh:
+            data = fh.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                logger.warning(f"Truncated a damaged message at the end of {path}.")
+                fh.truncate(end)
+        return bases[-1] + data.count(b"\n", 0, end)
+
+    def _open_segment(self, base: int):
+        self.segment_base = base
+        self.segment = open(self._segment_path(base), "ab")
+        self.segment_bytes = self.segment.tell()
+
+    def _sync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.last_fsync = time.monotonic()
+
+    def append(self, message: dict) -> int:
+        """Append a message and return its offset."""
+        line = json.dumps(message, separators=(",", ":")).encode() + b"\n"
+        with self.lock:
+            if self.segment is None:
+                bases = self._segment_bases()
+                self._open_segment(bases[-1] if bases else self.next_offset)
+            elif self.segment_bytes >= SEGMENT_MAX_BYTES:
+                self._sync()
+                self.segment.close()
+                self._open_segment(self.next_offset)
+            self.segment.write(line)
+            self.segment.flush()
+            self.segment_bytes += len(line)
+            offset = self.next_offset
+            self.next_offset += 1
+            if time.monotonic() - self.last_fsync >= FSYNC_INTERVAL:
+                self._sync()
+        return offset
+
+    def read(self, start: int, end: Optional[int] = None) -> Iterator[tuple]:
+        """
+        Read the messages from offset start up to end.
+        :return: (offset, message) tuples.
+        """
+        end = self.next_offset if end is None else end
+        bases = self._segment_bases()
+        for base, next_base in zip(bases, bases[1:] + [None]):
+            if next_base is not None and next_base <= start:
+                continue
+            if base >= end:
+                return
+            with open(self._segment_path(base), "rb") as fh:
+                for offset, line in enumerate(fh, base):
+                    if offset >= end:
+                        return
+                    if offset < start:
+                        continue
+                    try:
+                        yield offset, json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipped damaged message {offset}.")
+
+    def unacknowledged(self) -> Iterator[tuple]:
+        """The messages from the first unacknowledged one on. Some of them may be acknowledged already."""
+        return self.read(self.acked_until)
+
+    def ack(self, offsets: Iterable[int]):
+        """Acknowledge committed messages, and delete the segments that are fully acknowledged."""
+        with self.lock:
+            self.acked.update(
+                offset for offset in offsets if offset >= self.acked_until
+            )
+            acked_until = self.acked_until
+            while acked_until in self.acked:
+                self.acked.remove(acked_until)
+                acked_until += 1
+            if acked_until == self.acked_until:
+                return
+            self.acked_until = acked_until
+            self._write_ack()
+            bases = self._segment_bases()
+            for base, next_base in zip(bases, bases[1:]):
+                if next_base > acked_until or base == self.segment_base:
+                    break
+                self._segment_path(base).unlink()
+
+    def pending(self) -> int:
+        """Number of messages that are not acknowledged yet."""
+        return self.next_offset - self.acked_until - len(self.acked)
+
+    def close(self):
+        with self.lock:
+            if self.segment is not None:
+                self._sync()
+                self.segment.close()
+                self.segment = None
@@ -0,0 +1,531 @@
+import gzip
+import json
+import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+from django import db
+from django.db import connection, transaction
+
+from EDSite.helpers import is_gzip_file
+from EDSite.models import Commodity, Station, System
+from EDSite.tools.bulk import insert_rows
+from EDSite.tools.external.edsm import determine_pad_size
+from EDSite.tools.listings_merge import ListingsStaging, MergeResult
+from EDSite.tools.spatial import SystemIndex
+
+DUMP_SYSTEM_TABLE = "edsite_dump_system"
+DUMP_STATION_TABLE = "edsite_dump_station"
+
+DUMP_SYSTEM_COLUMNS = ("id64", "name", "pos_x", "pos_y", "pos_z", "population")
+DUMP_STATION_COLUMNS = (
+    "market_id",
+    "system_id64",
+    "name",
+    "ls_from_star",
+    "pad_size",
+    "modified",
+    "market",
+    "black_market",
+    "shipyard",
+    "outfitting",
+    "rearm",
+    "refuel",
+    "repair",
+    "planetary",
+    "fleet",
+    "odyssey",
+)
+
+# Number of dump lines that are handed to a worker at once.
+DUMP_BATCH_SIZE = 5000
+# Existing systems whose name is not unique are linked to a dumped system of that name within this many
+# ly on every axis.
+NAME_MATCH_TOLERANCE = 0.05
+CARRIER_TYPES = ("Fleet Carrier", "Drake-Class Carrier")
+
+
+@dataclass
+class DumpResult:
+    parsed: int = 0
+    skipped: int = 0
+    created: int = 0
+    updated: int = 0
+    # Dumped systems that were left out, because existing systems of their name could not be told apart.
+    ambiguous: int = 0
+
+    def __iadd__(self, other: "DumpResult"):
+        self.parsed += other.parsed
+        self.skipped += other.skipped
+        self.created += other.created
+        self.updated += other.updated
+        self.ambiguous += other.ambiguous
+        return self
+
+    def __str__(self):
+        return (
+            f"parsed={self.parsed}, skipped={self.skipped}, new={self.created}, "
+            f"up={self.updated}"
+            + (f", ambiguous={self.ambiguous}" if self.ambiguous else "")
+        )
+
+
+def read_dump_batches(
+    path: Path, batch_size: int = DUMP_BATCH_SIZE
+) -> Iterator[list[bytes]]:
+    """
+    Stream a dump file as batches of raw json lines. The file may be gzipped.
+    Both JSON lines and the one-object-per-line arrays of EDSM and Spansh are understood.
+    """
+    opener = gzip.open if is_gzip_file(path) else open
+    batch = []
+    with opener(path, "rb") as fh:
+        for line in fh:
+            line = line.strip().rstrip(b",")
+            if not line or line in (b"[", b"]"):
+                continue
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def dump_timestamp(value) -> Optional[str]:
+    """
+    Dumps use several timestamp formats. They are all UTC, so they are cut down to a string
+    that PostgreSQL parses as a timestamp without time zone.
+    """
+    if isinstance(value, dict):
+        value = value.get("market") or value.get("information")
+    if not value:
+        return None
+    return value[:19].replace("T", " ")
+
+
+def system_row(data: dict) -> tuple:
+    coords = data["coords"]
+    return (
+        int(data["id64"]),
+        data["name"],
+        float(coords["x"]),
+        float(coords["y"]),
+        float(coords["z"]),
+        data.get("population"),
+    )
+
+
+def station_pad_size(data: dict) -> str:
+    pads = data.get("landingPads")
+    if pads:
+        if pads.get("large"):
+            return "L"
+        return "M" if pads.get("medium") else "S"
+    return determine_pad_size(data)
+
+
+def station_row(data: dict) -> tuple:
+    station_type = data.get("type") or ""
+    services = set(data.get("services") or []) | set(data.get("otherServices") or [])
+    return (
+        int(data.get("marketId") or data["id"]),
+        int(data["systemId64"]),
+        data["name"],
+        int(float(data.get("distanceToArrival") or 0)),
+        station_pad_size(data),
+        dump_timestamp(data.get("updateTime")),
+        bool(data.get("haveMarket") or "Market" in services),
+        "Black Market" in services,
+        bool(data.get("haveShipyard") or "Shipyard" in services),
+        bool(data.get("haveOutfitting") or "Outfitting" in services),
+        "Rearm" in services or "Restock" in services,
+        "Refuel" in services,
+        "Repair" in services,
+        "Planetary" in station_type or "Settlement" in station_type,
+        station_type in CARRIER_TYPES,
+        "Odyssey" in station_type,
+    )
+
+
+def market_rows(data: dict, commodity_keys: {str: int}) -> [tuple]:
+    """
+    Rows in the layout of STAGING_COLUMNS, keyed on the market id and the commodity's game id.
+    Accepts EDDN commodity messages and stations with a nested market.
+    """
+    market = data.get("market") or data
+    market_id = int(data.get("marketId") or data["id"])
+    modified = dump_timestamp(market.get("timestamp") or market.get("updateTime"))
+    if not modified:
+        raise ValueError(f"Market {market_id} has no timestamp.")
+    rows = {}
+    for listing in market.get("commodities") or []:
+        demand_price = listing["sellPrice"]
+        supply_price = listing["buyPrice"]
+        demand_units = listing["demand"]
+        supply_units = listing.get("stock", listing.get("supply", 0))
+        if (demand_price == 0 and supply_price == 0) or (
+            demand_units == 0 and supply_units == 0
+        ):
+            continue
+        game_id = listing.get("commodityId") or commodity_keys.get(
+            (listing.get("symbol") or listing["name"]).lower()
+        )
+        if not game_id:
+            continue
+        rows[game_id] = (
+            market_id,
+            game_id,
+            demand_price,
+            demand_units,
+            supply_price,
+            supply_units,
+            modified,
+            False,
+        )
+    return list(rows.values())
+
+
+def commodity_keys() -> {str: int}:
+    """Lowercase commodity names, with and without spaces, mapped to their game id."""
+    keys = {}
+    for name, game_id in Commodity.objects.values_list("name", "game_id"):
+        keys[name.lower()] = game_id
+        keys[name.lower().replace(" ", "")] = game_id
+    return keys
+
+
+def _parse_rows(lines: [bytes], to_row: Callable) -> ([tuple], int):
+    rows, skipped = [], 0
+    for line in lines:
+        try:
+            rows.append(to_row(json.loads(line)))
+        except (KeyError, TypeError, ValueError):
+            skipped += 1
+    return rows, skipped
+
+
+def stage_systems(lines: [bytes]) -> DumpResult:
+    rows, skipped = _parse_rows(lines, system_row)
+    insert_rows(DUMP_SYSTEM_TABLE, DUMP_SYSTEM_COLUMNS, rows)
+    return DumpResult(parsed=len(rows), skipped=skipped)
+
+
+def stage_stations(lines: [bytes]) -> DumpResult:
+    rows, skipped = _parse_rows(lines, station_row)
+    insert_rows(DUMP_STATION_TABLE, DUMP_STATION_COLUMNS, rows)
+    return DumpResult(parsed=len(rows), skipped=skipped)
+
+
+def merge_markets(lines: [bytes], commodity_keys: {str: int}) -> MergeResult:
+    """Merge a batch of complete markets into LiveListing through the listings staging table."""
+    markets, skipped = _parse_rows(
+        lines, lambda data: market_rows(data, commodity_keys)
+    )
+    # Keep only the newest market of a station, a station can only be upserted once per statement.
+    newest = {}
+    for rows in markets:
+        if rows and (rows[0][0] not in newest or newest[rows[0][0]][0][6] < rows[0][6]):
+            newest[rows[0][0]] = rows
+    staging = ListingsStaging(station_key="market_id", commodity_key="game_id")
+    try:
+        result = staging.merge_chunk(
+            (row for rows in newest.values() for row in rows),
+            0,
+            0,
+            delete_missing=False,
+            delete_replaced=True,
+        )
+    finally:
+        staging.drop()
+    result.unknown += skipped
+    return result
+
+
+def run_batches(
+    pool: Optional[Executor], func: Callable, batches: Iterable, *args, max_pending=0
+) -> Iterator:
+    """
+    Run func on every batch, in the pool if there is one. Only max_pending batches are queued
+    at a time, so the reader never gets far ahead of the workers.
+    """
+    if not pool:
+        for batch in batches:
+            yield func(batch, *args)
+        db.reset_queries()
+        return
+    pending = set()
+    for batch in batches:
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+        pending.add(pool.submit(func, batch, *args))
+    for future in as_completed(pending):
+        yield future.result()
+
+
+class GalaxyDumpImporter:
+    """
+    Imports locally downloaded systems, stations and markets dumps.
+    Systems and stations are parsed by the workers and copied into unlogged tables, then merged
+    with one statement each. Markets are merged by the workers through the listings staging table.
+    """
+
+    def __init__(self, workers: int = 1, batch_size: int = DUMP_BATCH_SIZE):
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def _pool(self) -> Optional[Executor]:
+        if self.workers <= 1:
+            return None
+        # Forked workers must not share the connection of this process.
+        db.connections.close_all()
+        return ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("fork")
+        )
+
+    def _run(self, paths: [Path], func: Callable, total, *args):
+        pool = self._pool()
+        try:
+            for path in paths:
+                for result in run_batches(
+                    pool,
+                    func,
+                    read_dump_batches(path, self.batch_size),
+                    *args,
+                    max_pending=self.workers * 2,
+                ):
+                    total += result
+        finally:
+            if pool:
+                pool.shutdown()
+        return total
+
+    def _create_dump_tables(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                CREATE UNLOGGED TABLE IF NOT EXISTS {DUMP_SYSTEM_TABLE} (
+                    id64 bigint NOT NULL,
+                    name varchar(100) NOT NULL,
+                    pos_x double precision NOT NULL,
+                    pos_y double precision NOT NULL,
+                    pos_z double precision NOT NULL,
+                    population bigint NULL
+                )
+                """
+            )
+            cursor.execute(
+                f"""
+                CREATE UNLOGGED TABLE IF NOT EXISTS {DUMP_STATION_TABLE} (
+                    market_id bigint NOT NULL,
+                    system_id64 bigint NOT NULL,
+                    name varchar(100) NOT NULL,
+                    ls_from_star integer NOT NULL,
+                    pad_size varchar(1) NOT NULL,
+                    modified timestamp NULL,
+                    market boolean NOT NULL,
+                    black_market boolean NOT NULL,
+                    shipyard boolean NOT NULL,
+                    outfitting boolean NOT NULL,
+                    rearm boolean NOT NULL,
+                    refuel boolean NOT NULL,
+                    repair boolean NOT NULL,
+                    planetary boolean NOT NULL,
+                    fleet boolean NOT NULL,
+                    odyssey boolean NOT NULL
+                )
+                """
+            )
+            cursor.execute(f"TRUNCATE {DUMP_SYSTEM_TABLE}, {DUMP_STATION_TABLE}")
+
+    def _drop_dump_tables(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DROP TABLE IF EXISTS {DUMP_SYSTEM_TABLE}, {DUMP_STATION_TABLE}"
+            )
+
+    def merge_systems(self) -> DumpResult:
+        """
+        Link the existing systems to their id64, then upsert all dumped systems.
+        Names are not unique, so only names that both the existing and the dumped systems have once are
+        linked by name. The others are linked by name and coordinates. Dumped systems that still share
+        their name with an unlinked system are left out and counted as ambiguous, rather than added
+        next to it.
+        """
+        system = connection.ops.quote_name(System._meta.db_table)
+        result = DumpResult()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {system} sy SET id64 = d.id64
+                FROM (
+                    SELECT name, min(id64) AS id64 FROM {DUMP_SYSTEM_TABLE}
+                    GROUP BY name HAVING count(DISTINCT id64) = 1
+                ) d
+                WHERE sy.id64 IS NULL AND sy.name = d.name
+                  AND sy.name IN (SELECT name FROM {system} GROUP BY name HAVING count(*) = 1)
+                  AND NOT EXISTS (SELECT 1 FROM {system} o WHERE o.id64 = d.id64)
+                """
+            )
+            # Pairs that are only found once on both sides, so no id64 is given to two systems.
+            cursor.execute(
+                f"""
+                WITH candidates AS (
+                    SELECT sy.id, d.id64,
+                        count(*) OVER (PARTITION BY sy.id) AS systems,
+                        count(*) OVER (PARTITION BY d.id64) AS dumped
+                    FROM {system} sy
+                    JOIN (
+                        SELECT DISTINCT id64, name, pos_x, pos_y, pos_z FROM {DUMP_SYSTEM_TABLE}
+                    ) d ON d.name = sy.name
+                        AND abs(d.pos_x - sy.pos_x) <= %(tolerance)s
+                        AND abs(d.pos_y - sy.pos_y) <= %(tolerance)s
+                        AND abs(d.pos_z - sy.pos_z) <= %(tolerance)s
+                    WHERE sy.id64 IS NULL
+                      AND NOT EXISTS (SELECT 1 FROM {system} o WHERE o.id64 = d.id64)
+                )
+                UPDATE {system} sy SET id64 = c.id64
+                FROM candidates c
+                WHERE sy.id = c.id AND c.systems = 1 AND c.dumped = 1
+                """,
+                {"tolerance": NAME_MATCH_TOLERANCE},
+            )
+            cursor.execute(
+                f"""
+                CREATE TEMPORARY TABLE edsite_dump_ambiguous ON COMMIT DROP AS
+                SELECT DISTINCT d.id64 FROM {DUMP_SYSTEM_TABLE} d
+                WHERE NOT EXISTS (SELECT 1 FROM {system} o WHERE o.id64 = d.id64)
+                  AND EXISTS (
+                    SELECT 1 FROM {system} o WHERE o.id64 IS NULL AND o.name = d.name
+                  )
+                """
+            )
+            result.ambiguous = cursor.rowcount
+            cursor.execute(
+                f"""
+                WITH upserted AS (
+                    INSERT INTO {system} AS sy (
+                        id64, name, pos_x, pos_y, pos_z, distance_to_sol, population
+                    )
+                    SELECT DISTINCT ON (id64) id64, name, pos_x, pos_y, pos_z,
+                        sqrt(pos_x * pos_x + pos_y * pos_y + pos_z * pos_z), population
+                    FROM {DUMP_SYSTEM_TABLE} d
+                    WHERE NOT EXISTS (SELECT 1 FROM edsite_dump_ambiguous a WHERE a.id64 = d.id64)
+                    ORDER BY id64
+                    ON CONFLICT (id64) DO UPDATE SET
+                        name = EXCLUDED.name,
+                        pos_x = EXCLUDED.pos_x,
+                        pos_y = EXCLUDED.pos_y,
+                        pos_z = EXCLUDED.pos_z,
+                        distance_to_sol = EXCLUDED.distance_to_sol,
+                        population = COALESCE(EXCLUDED.population, sy.population)
+                    WHERE (sy.name, sy.pos_x, sy.pos_y, sy.pos_z, sy.population)
+                        IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.pos_x, EXCLUDED.pos_y,
+                                          EXCLUDED.pos_z, COALESCE(EXCLUDED.population, sy.population))
+                    RETURNING (sy.xmax = 0) AS created
+                )
+                SELECT count(*) FILTER (WHERE created), count(*) FILTER (WHERE NOT created)
+                FROM upserted
+                """
+            )
+            result.created, result.updated = cursor.fetchone()
+        # Dumped systems may have moved, so the whole index is reloaded.
+        SystemIndex().invalidate()
+        return result
+
+    def merge_stations(self) -> DumpResult:
+        """
+        Link the existing stations to their market id, then upsert all dumped stations of known systems.
+        Carriers move around, so they are also matched by name in other systems.
+        """
+        quote = connection.ops.quote_name
+        station = quote(Station._meta.db_table)
+        system = quote(System._meta.db_table)
+        columns = [column for column in DUMP_STATION_COLUMNS if column != "system_id64"]
+        updates = ", ".join(
+            f"{column} = EXCLUDED.{column}"
+            for column in columns
+            if column != "market_id"
+        )
+        # The dump's timestamps are UTC without a time zone.
+        selected = [
+            f"d.{column}" if column != "modified" else "d.modified AT TIME ZONE 'UTC'"
+            for column in columns
+        ]
+        result = DumpResult()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {station} st SET market_id = m.market_id
+                FROM (
+                    SELECT DISTINCT ON (d.market_id) d.market_id, st.id AS station_id
+                    FROM {DUMP_STATION_TABLE} d
+                    JOIN {system} sy ON sy.id64 = d.system_id64
+                    JOIN {station} st ON st.market_id IS NULL
+                      AND upper(st.name) = upper(d.name)
+                      AND (st.system_id = sy.id OR (st.fleet AND d.fleet))
+                    WHERE NOT EXISTS (SELECT 1 FROM {station} o WHERE o.market_id = d.market_id)
+                    ORDER BY d.market_id, st.modified DESC NULLS LAST
+                ) m
+                WHERE st.id = m.station_id
+                """
+            )
+            cursor.execute(
+                f"""
+                WITH upserted AS (
+                    INSERT INTO {station} AS st ({", ".join(columns)}, system_id)
+                    SELECT DISTINCT ON (d.market_id)
+                        {", ".join(selected)}, sy.id
+                    FROM {DUMP_STATION_TABLE} d
+                    JOIN {system} sy ON sy.id64 = d.system_id64
+                    ORDER BY d.market_id, d.modified DESC NULLS LAST
+                    ON CONFLICT (market_id) DO UPDATE SET {updates}, system_id = EXCLUDED.system_id
+                    WHERE st.modified IS NULL OR st.modified < EXCLUDED.modified
+                    RETURNING (st.xmax = 0) AS created
+                )
+                SELECT count(*) FILTER (WHERE created), count(*) FILTER (WHERE NOT created)
+                FROM upserted
+                """
+            )
+            result.created, result.updated = cursor.fetchone()
+            cursor.execute(
+                f"""
+                SELECT count(*) FROM {DUMP_STATION_TABLE} d
+                WHERE NOT EXISTS (SELECT 1 FROM {system} sy WHERE sy.id64 = d.system_id64)
+                """
+            )
+            result.skipped = cursor.fetchone()[0]
+        return result
+
+    def import_systems(self, paths: [Path]) -> DumpResult:
+        self._create_dump_tables()
+        try:
+            total = self._run(paths, stage_systems, DumpResult())
+            merged = self.merge_systems()
+        finally:
+            self._drop_dump_tables()
+        merged.parsed, merged.skipped = total.parsed, total.skipped
+        return merged
+
+    def import_stations(self, paths: [Path]) -> DumpResult:
+        self._create_dump_tables()
+        try:
+            total = self._run(paths, stage_stations, DumpResult())
+            merged = self.merge_stations()
+        finally:
+            self._drop_dump_tables()
+        merged.parsed, merged.skipped = total.parsed, total.skipped + merged.skipped
+        return merged
+
+    def import_markets(self, paths: [Path]) -> MergeResult:
+        return self._run(paths, merge_markets, MergeResult(), commodity_keys())
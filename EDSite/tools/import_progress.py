@@ -0,0 +1,114 @@
+import datetime
+from contextlib import contextmanager
+from typing import Optional
+
+from django.utils import timezone
+
+from EDSite.models import ImportCheckpoint, ImportRun, ImportRunStatus
+from EDSite.tools.jobs import Job
+from EDSiteProject import settings
+
+
+class ImportProgress:
+    """
+    Durable progress of an import run. Stages, and the chunks of the listings stage, are recorded as
+    checkpoints once they are committed, and a resumed run skips them.
+    A chunk that was committed but not yet checkpointed when the run died is merged again, which is
+    harmless because the merges only apply listings that are newer than the stored ones.
+    """
+
+    def __init__(self, run: ImportRun, job: Optional[Job] = None):
+        self.run = run
+        self.completed = set(run.checkpoints.values_list("stage", "chunk"))
+        # A scheduled job follows the run, and is stopped at the next checkpoint when it is cancelled.
+        self.job = job
+        if job:
+            job.import_run_id = run.id
+
+    def raise_if_cancelled(self):
+        if self.job:
+            self.job.raise_if_cancelled()
+
+    @classmethod
+    def start(
+        cls, options: dict, resume: bool = True, job: Optional[Job] = None
+    ) -> "ImportProgress":
+        """
+        Resume the most recent unfinished run if it was started with the same options and was active
+        within IMPORT_RESUME_HOURS. Otherwise the unfinished runs are abandoned and a new run starts.
+        """
+        unfinished = ImportRun.objects.filter(
+            status__in=[ImportRunStatus.RUNNING, ImportRunStatus.FAILED]
+        ).order_by("-started")
+        previous = unfinished.first()
+        resumable = (
+            resume
+            and previous is not None
+            and previous.options == options
+            and timezone.now() - previous.updated
+            < datetime.timedelta(hours=settings.IMPORT_RESUME_HOURS)
+        )
+        if resumable:
+            unfinished.exclude(id=previous.id).update(status=ImportRunStatus.ABANDONED)
+            previous.status = ImportRunStatus.RUNNING
+            previous.error = None
+            previous.save()
+            progress = cls(previous, job)
+            print(
+                f"Resuming import run {previous.id} after {len(progress.completed)} checkpoints."
+            )
+            return progress
+        unfinished.update(status=ImportRunStatus.ABANDONED)
+        return cls(ImportRun.objects.create(options=options), job)
+
+    def is_done(self, stage: str, chunk: str = "") -> bool:
+        return (stage, chunk) in self.completed
+
+    @contextmanager
+    def stage(self, name: str):
+        """Track a stage. The stage is checkpointed when the block finishes without an exception."""
+        self.raise_if_cancelled()
+        run = self.run
+        run.stage = name
+        run.stage_started = timezone.now()
+        run.done = run.done_at_start = 0
+        run.total = None
+        run.save()
+        yield self
+        self.checkpoint(name)
+
+    def set_total(self, total: int, done: int = 0, unit: str = "chunks"):
+        """Set the size of the current stage, and how much of it an earlier attempt already did."""
+        run = self.run
+        run.total = total
+        run.done = run.done_at_start = done
+        run.unit = unit
+        run.save(update_fields=["total", "done", "done_at_start", "unit", "updated"])
+
+    def checkpoint(self, stage: str, chunk: str = "", result="", done: int = None):
+        """
+        Record a committed stage or chunk.
+        :param done: The progress of the stage after this chunk. Defaults to one more chunk.
+        """
+        ImportCheckpoint.objects.get_or_create(
+            run=self.run,
+            stage=stage,
+            chunk=chunk,
+            defaults={"result": str(result)[:256]},
+        )
+        self.completed.add((stage, chunk))
+        if chunk:
+            self.run.done = self.run.done + 1 if done is None else done
+            self.run.save(update_fields=["done", "updated"])
+        self.raise_if_cancelled()
+
+    def finish(self):
+        self.run.status = ImportRunStatus.FINISHED
+        self.run.finished = timezone.now()
+        self.run.stage = None
+        self.run.save()
+
+    def fail(self, error: BaseException):
+        self.run.status = ImportRunStatus.FAILED
+        self.run.error = f"{type(error).__name__}: {error}"
+        self.run.save()
@@ -0,0 +1,315 @@
+import datetime
+import itertools
+import logging
+import threading
+import traceback
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Optional
+
+from django import db
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import timezone
+
+from EDSite.helpers import SingletonMeta
+from EDSite.models import ImportRun
+
+logger = logging.getLogger(__name__)
+
+# Key of the PostgreSQL advisory lock that keeps import jobs of different processes apart.
+IMPORT_LOCK_KEY = 0x45445349
+# Number of finished jobs that are kept for the status endpoint.
+JOB_HISTORY = 50
+# A cron expression that matches nothing within this many days is rejected.
+CRON_SEARCH_DAYS = 366 * 5
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    """
+    A unit of work for the JobScheduler. The target is called with the job, so it can report the
+    ImportRun that tracks its progress and stop at the next checkpoint once the job is cancelled.
+    """
+
+    name: str
+    target: Callable[["Job"], Any] = field(repr=False)
+    id: int = field(default_factory=itertools.count(1).__next__)
+    status: JobStatus = JobStatus.QUEUED
+    created: datetime.datetime = field(default_factory=timezone.now)
+    started: Optional[datetime.datetime] = None
+    finished: Optional[datetime.datetime] = None
+    error: Optional[str] = None
+    import_run_id: Optional[int] = None
+    cancel_requested: threading.Event = field(
+        default_factory=threading.Event, repr=False
+    )
+
+    @property
+    def active(self) -> bool:
+        return self.status in (JobStatus.QUEUED, JobStatus.RUNNING)
+
+    def raise_if_cancelled(self):
+        if self.cancel_requested.is_set():
+            raise JobCancelled(f"Job {self.id} ({self.name}) was cancelled.")
+
+    def to_dict(self) -> dict:
+        end = self.finished or timezone.now()
+        data = {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status.value,
+            "created": self.created.isoformat(),
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+            "seconds": (end - self.started).total_seconds() if self.started else None,
+            "cancel_requested": self.cancel_requested.is_set(),
+            "error": self.error,
+            "progress": None,
+        }
+        if self.import_run_id:
+            run = ImportRun.objects.filter(id=self.import_run_id).first()
+            if run:
+                eta = run.eta()
+                data["progress"] = {
+                    "import_run": run.id,
+                    "stage": run.stage,
+                    "done": run.done,
+                    "total": run.total,
+                    "unit": run.unit,
+                    "eta_seconds": eta.total_seconds() if eta else None,
+                    "stages_done": list(
+                        run.checkpoints.filter(chunk="")
+                        .order_by("created")
+                        .values_list("stage", flat=True)
+                    ),
+                }
+        return data
+
+
+class CronSchedule:
+    """
+    A standard five field cron expression (minute hour day-of-month month day-of-week), in UTC.
+    Fields accept *, numbers, ranges (a-b), lists (a,b) and steps (*/n, a-b/n).
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Expected 5 cron fields, got {expression!r}.")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse_field(part, low, high)
+            for part, (low, high) in zip(parts, self.FIELDS)
+        )
+        # Both 0 and 7 are Sunday.
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse_field(part: str, low: int, high: int) -> {int}:
+        values = set()
+        for item in part.split(","):
+            span, _, step = item.partition("/")
+            if span == "*":
+                start, end = low, high
+            elif "-" in span:
+                start, end = map(int, span.split("-"))
+            else:
+                start = end = int(span)
+                if step:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field {part!r} is out of range {low}-{high}.")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, moment: datetime.datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        # Like cron, a restricted day of month and day of week match when either does.
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment: datetime.datetime) -> datetime.datetime:
+        """The first matching minute after moment."""
+        moment = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=CRON_SEARCH_DAYS)
+        while moment < limit:
+            if moment.month not in self.months or not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression {self.expression!r} never matches.")
+
+
+@dataclass
+class PeriodicJob:
+    name: str
+    schedule: CronSchedule
+    target: Callable[[Job], Any]
+    next_run: datetime.datetime
+
+
+@contextmanager
+def import_lock():
+    """
+    Hold a PostgreSQL advisory lock so only one import job runs at a time, also across processes.
+    The lock lives on a connection of its own, because the imports close the Django connections
+    before they fork their workers.
+    :return: Whether the lock was acquired.
+    """
+    if connections[DEFAULT_DB_ALIAS].vendor != "postgresql":
+        yield True
+        return
+    lock_connection = connections.create_connection(DEFAULT_DB_ALIAS)
+    try:
+        with lock_connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [IMPORT_LOCK_KEY])
+            (locked,) = cursor.fetchone()
+        yield locked
+    finally:
+        # Closing the session releases the lock.
+        lock_connection.close()
+
+
+class JobScheduler(metaclass=SingletonMeta):
+    """
+    Runs import and cache jobs one at a time on a background thread.
+    Submitting a job while a job with the same name is queued or running returns that job instead,
+    periodic jobs are queued by their cron schedule, and jobs can be cancelled. A running job stops
+    at its next checkpoint.
+    """
+
+    def __init__(self):
+        self.queue: deque[Job] = deque()
+        self.jobs: OrderedDict[int, Job] = OrderedDict()
+        self.periodic: [PeriodicJob] = []
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="job-scheduler", daemon=True
+                )
+                self.thread.start()
+
+    def submit(self, name: str, target: Callable[[Job], Any]) -> Job:
+        with self.condition:
+            for job in self.jobs.values():
+                if job.name == name and job.active:
+                    return job
+            job = Job(name, target)
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self._trim_history()
+            self.condition.notify()
+        self.start()
+        return job
+
+    def schedule(self, name: str, cron: str, target: Callable[[Job], Any]):
+        schedule = CronSchedule(cron)
+        with self.condition:
+            self.periodic.append(
+                PeriodicJob(name, schedule, target, schedule.next_after(timezone.now()))
+            )
+            self.condition.notify()
+        self.start()
+
+    def cancel(self, job_id: int) -> Optional[Job]:
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or not job.active:
+                return job
+            job.cancel_requested.set()
+            if job.status == JobStatus.QUEUED:
+                self.queue.remove(job)
+                job.status = JobStatus.CANCELLED
+                job.finished = timezone.now()
+            return job
+
+    def get(self, job_id: int) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def list(self) -> [Job]:
+        with self.condition:
+            return list(reversed(self.jobs.values()))
+
+    def _trim_history(self):
+        for job_id in [job.id for job in self.jobs.values() if not job.active][
+            : max(0, len(self.jobs) - JOB_HISTORY)
+        ]:
+            del self.jobs[job_id]
+
+    def _next_job(self) -> Job:
+        """Wait until a job is queued, queueing the periodic jobs that are due on the way."""
+        with self.condition:
+            while True:
+                now = timezone.now()
+                for periodic in self.periodic:
+                    if periodic.next_run <= now:
+                        periodic.next_run = periodic.schedule.next_after(now)
+                        if not any(
+                            job.name == periodic.name and job.active
+                            for job in self.jobs.values()
+                        ):
+                            job = Job(periodic.name, periodic.target)
+                            self.jobs[job.id] = job
+                            self.queue.append(job)
+                if self.queue:
+                    job = self.queue.popleft()
+                    job.status = JobStatus.RUNNING
+                    job.started = timezone.now()
+                    return job
+                timeout = None
+                if self.periodic:
+                    next_run = min(periodic.next_run for periodic in self.periodic)
+                    timeout = max(0.0, (next_run - now).total_seconds())
+                self.condition.wait(timeout)
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            try:
+                with import_lock() as locked:
+                    if not locked:
+                        raise RuntimeError("Another process is running an import.")
+                    job.raise_if_cancelled()
+                    job.target(job)
+                job.status = JobStatus.FINISHED
+            except JobCancelled:
+                job.status = JobStatus.CANCELLED
+            except Exception as e:
+                logger.error(
+                    f"Job {job.id} ({job.name}) failed.\n{traceback.format_exc()}"
+                )
+                job.status = JobStatus.FAILED
+                job.error = f"{type(e).__name__}: {e}"
+            finally:
+                job.finished = timezone.now()
+                db.close_old_connections()
+                with self.condition:
+                    self._trim_history()
@@ -0,0 +1,343 @@
+import bisect
+import itertools
+import math
+import mmap
+import operator
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Optional
+
+from EDSite.helpers import SingletonMeta
+from EDSite.tools.spatial import SystemCoordinates, SystemIndex
+from EDSiteProject import settings
+
+MAGIC = b"EDJG"
+VERSION = 1
+# Magic, version, jump range, number of systems and size of the blocks.
+HEADER = struct.Struct("<4sH2xdqq")
+# Distances are stored in units of the jump range over this, rounded up.
+DISTANCE_STEPS = 65535
+COMPRESSION_LEVEL = 6
+# Blocks are raw deflate streams, without the header and checksum of zlib, which would take up as
+# much as the neighbours of systems in sparse regions.
+DEFLATE_BITS = -15
+# Open graphs check whether their file was replaced after this many seconds.
+GRAPH_REFRESH_SECONDS = 60
+
+
+def graph_path(jump_range: float, directory: Optional[Path] = None) -> Path:
+    directory = Path(settings.JUMP_GRAPH_DIR if directory is None else directory)
+    return directory / f"jump_graph_{jump_range:g}.bin"
+
+
+def encode_neighbours(neighbours: [tuple], jump_range: float) -> bytes:
+    """
+    The block of a system: the ids of its neighbours in ascending order as deltas, followed by their
+    distances in steps of jump_range / DISTANCE_STEPS, compressed. Deltas of close ids are small,
+    so they compress well.
+    :param neighbours: (system id, distance) tuples, ordered by system id.
+    """
+    if not neighbours:
+        return b""
+    system_ids = [system_id for system_id, _ in neighbours]
+    deltas = array("q", map(operator.sub, system_ids, [0] + system_ids[:-1]))
+    step = jump_range / DISTANCE_STEPS
+    # Distances that were decoded from a block come out of the rounding as they were.
+    distances = array(
+        "H",
+        (
+            min(math.ceil(round(distance / step, 6)), DISTANCE_STEPS)
+            for _, distance in neighbours
+        ),
+    )
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, DEFLATE_BITS)
+    return (
+        compressor.compress(deltas.tobytes() + distances.tobytes()) + compressor.flush()
+    )
+
+
+def decode_neighbours(block: bytes, jump_range: float) -> (array, [float]):
+    """The system ids and distances of a block, ordered by system id."""
+    if not block:
+        return array("q"), []
+    data = zlib.decompress(block, DEFLATE_BITS)
+    count = len(data) // 10
+    deltas, steps = array("q"), array("H")
+    deltas.frombytes(data[: count * 8])
+    steps.frombytes(data[count * 8 :])
+    step = jump_range / DISTANCE_STEPS
+    return array("q", itertools.accumulate(deltas)), [value * step for value in steps]
+
+
+def write_graph(path: Path, jump_range: float, blocks: Iterable[tuple]):
+    """
+    Write a graph file from (system id, block) tuples in ascending order of system id. The file is
+    written next to path and then moved over it, so readers see either the old or the new graph.
+    """
+    system_ids, offsets, offset = array("q"), array("q", [0]), 0
+    partial = path.with_suffix(".part")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(partial.with_suffix(".blocks"), "w+b") as blocks_file:
+        for system_id, block in blocks:
+            blocks_file.write(block)
+            offset += len(block)
+            system_ids.append(system_id)
+            offsets.append(offset)
+        blocks_file.seek(0)
+        with open(partial, "wb") as fh:
+            fh.write(HEADER.pack(MAGIC, VERSION, jump_range, len(system_ids), offset))
+            system_ids.tofile(fh)
+            offsets.tofile(fh)
+            while chunk := blocks_file.read(1 << 20):
+                fh.write(chunk)
+            fh.flush()
+            os.fsync(fh.fileno())
+    os.unlink(partial.with_suffix(".blocks"))
+    os.replace(partial, path)
+
+
+class JumpGraph:
+    """
+    The systems within jump_range of every system, in compressed sparse row layout: a sorted array
+    of system ids, an array of offsets into the blocks, and the blocks of encode_neighbours().
+    The file is memory mapped read only, so every process that opens it shares its pages through
+    the page cache, and only the blocks that are read are loaded from disk.
+
+        for distance, system_id in JumpGraph(graph_path(20)).neighbours(system_id, 15):
+            ...
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, "rb") as fh:
+            stat = os.fstat(fh.fileno())
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        magic, version, self.jump_range, size, _ = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError(f"{self.path} is not a jump graph of version {VERSION}.")
+        view = memoryview(self.map)
+        start = HEADER.size
+        self.system_ids = view[start : start + size * 8].cast("q")
+        self.offsets = view[start + size * 8 : start + (size * 2 + 1) * 8].cast("q")
+        self.blocks = view[start + (size * 2 + 1) * 8 :]
+
+    def __len__(self):
+        return len(self.system_ids)
+
+    def __contains__(self, system_id: int):
+        return self._node(system_id) is not None
+
+    def _node(self, system_id: int) -> Optional[int]:
+        node = bisect.bisect_left(self.system_ids, system_id)
+        if node < len(self.system_ids) and self.system_ids[node] == system_id:
+            return node
+        return None
+
+    def block(self, node: int) -> bytes:
+        return bytes(self.blocks[self.offsets[node] : self.offsets[node + 1]])
+
+    def neighbours(
+        self, system_id: int, max_distance: Optional[float] = None
+    ) -> Optional[list]:
+        """
+        The systems within max_distance of system_id, or within the jump range, not counting itself.
+        Distances are rounded up to a step of jump_range / DISTANCE_STEPS ly.
+        :return: (distance, system id) tuples, closest first. None when the graph lacks system_id.
+        """
+        node = self._node(system_id)
+        if node is None:
+            return None
+        system_ids, distances = decode_neighbours(self.block(node), self.jump_range)
+        neighbours = sorted(zip(distances, system_ids))
+        if max_distance is not None:
+            del neighbours[bisect.bisect_right(neighbours, (max_distance, math.inf)) :]
+        return neighbours
+
+    def close(self):
+        self.system_ids.release()
+        self.offsets.release()
+        self.blocks.release()
+        self.map.close()
+
+
+def _cell(point: tuple, size: float) -> tuple:
+    return tuple(math.floor(coordinate / size) for coordinate in point)
+
+
+def _cells(coordinates: SystemCoordinates, size: float) -> {tuple: [int]}:
+    """The rows of coordinates by the cube of edge size that holds them."""
+    cells = defaultdict(list)
+    for row in range(len(coordinates)):
+        cells[_cell(coordinates.position(row), size)].append(row)
+    return cells
+
+
+def _around(cells: {tuple: [int]}, cell: tuple) -> Iterable[int]:
+    """The rows of cell and the 26 cells around it."""
+    cx, cy, cz = cell
+    return itertools.chain.from_iterable(
+        cells.get((cx + dx, cy + dy, cz + dz), ())
+        for dx, dy, dz in itertools.product((-1, 0, 1), repeat=3)
+    )
+
+
+def build_jump_graph(
+    jump_range: float,
+    path: Optional[Path] = None,
+    coordinates: Optional[SystemCoordinates] = None,
+) -> int:
+    """
+    Build the graph of jump_range over every system of the SystemIndex.
+    Systems are bucketed into cubes of jump_range, so the neighbours of a system are among the
+    systems of the 27 cubes around it, and their distances are computed a cube at a time.
+    :return: The number of systems in the graph.
+    """
+    path = graph_path(jump_range) if path is None else path
+    if coordinates is None:
+        coordinates = SystemIndex().snapshot()
+    ids = coordinates.ids
+    cells = _cells(coordinates, jump_range)
+    blocks = {}
+    for cell, cell_rows in cells.items():
+        nearby = SystemCoordinates()
+        for row in sorted(_around(cells, cell), key=ids.__getitem__):
+            nearby.insert(ids[row], coordinates.position(row))
+        for row in cell_rows:
+            system_id = ids[row]
+            blocks[system_id] = encode_neighbours(
+                [
+                    (other_id, distance)
+                    for other_id, distance in zip(
+                        nearby.ids, nearby.distances(coordinates.position(row))
+                    )
+                    if distance <= jump_range and other_id != system_id
+                ],
+                jump_range,
+            )
+    write_graph(path, jump_range, sorted(blocks.items()))
+    return len(blocks)
+
+
+def update_jump_graph(
+    jump_range: float,
+    path: Optional[Path] = None,
+    coordinates: Optional[SystemCoordinates] = None,
+) -> int:
+    """
+    Add the systems of the SystemIndex that the graph of jump_range lacks. The blocks of the new
+    systems and of the systems within range of them are encoded again, every other block is copied
+    as it is. Neighbours are only looked up in coordinates, so every system in a block has a block
+    of its own. Systems that moved or were deleted are only picked up by build_jump_graph().
+    :return: The number of systems that were added.
+    """
+    path = graph_path(jump_range) if path is None else path
+    if coordinates is None:
+        coordinates = SystemIndex().snapshot()
+    graph = JumpGraph(path)
+    try:
+        known = set(graph.system_ids)
+        new_rows = [
+            row
+            for row, system_id in enumerate(coordinates.ids)
+            if system_id not in known
+        ]
+        if not new_rows:
+            return 0
+        ids = coordinates.ids
+        cells = _cells(coordinates, jump_range)
+        new_blocks, added = {}, defaultdict(list)
+        for row in new_rows:
+            system_id, point = ids[row], coordinates.position(row)
+            nearby = list(_around(cells, _cell(point, jump_range)))
+            neighbours = []
+            for other, distance in zip(nearby, coordinates.distances(point, nearby)):
+                other_id = ids[other]
+                if distance > jump_range or other_id == system_id:
+                    continue
+                neighbours.append((other_id, distance))
+                if other_id in known:
+                    added[other_id].append((system_id, distance))
+            new_blocks[system_id] = encode_neighbours(sorted(neighbours), jump_range)
+
+        def blocks():
+            new = iter(sorted(new_blocks.items()))
+            pending = next(new, None)
+            for node, system_id in enumerate(graph.system_ids):
+                while pending is not None and pending[0] < system_id:
+                    yield pending
+                    pending = next(new, None)
+                block = graph.block(node)
+                if system_id in added:
+                    neighbours = dict(zip(*decode_neighbours(block, jump_range)))
+                    neighbours.update(added[system_id])
+                    block = encode_neighbours(sorted(neighbours.items()), jump_range)
+                yield system_id, block
+            if pending is not None:
+                yield pending
+                yield from new
+
+        write_graph(path, jump_range, blocks())
+    finally:
+        graph.close()
+    return len(new_rows)
+
+
+def update_jump_graphs() -> {float: int}:
+    """Add new systems to the graphs of settings.JUMP_GRAPH_RANGES that were built already."""
+    coordinates = SystemIndex().snapshot()
+    added = {}
+    for jump_range in settings.JUMP_GRAPH_RANGES:
+        if graph_path(jump_range).exists():
+            added[jump_range] = update_jump_graph(jump_range, coordinates=coordinates)
+    return added
+
+
+class JumpGraphs(metaclass=SingletonMeta):
+    """
+    The graphs of settings.JUMP_GRAPH_RANGES that were built, opened on first use. A graph file that
+    was replaced by an update or a rebuild is opened again after at most GRAPH_REFRESH_SECONDS.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.graphs: {float: JumpGraph} = {}
+        self.refreshed = None
+
+    def refresh(self):
+        with self.lock:
+            now = time.monotonic()
+            if (
+                self.refreshed is not None
+                and now - self.refreshed < GRAPH_REFRESH_SECONDS
+            ):
+                return
+            self.refreshed = now
+            for jump_range in settings.JUMP_GRAPH_RANGES:
+                path = graph_path(jump_range)
+                graph = self.graphs.get(jump_range)
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    if graph is not None:
+                        del self.graphs[jump_range]
+                    continue
+                if graph is None or graph.identity != (stat.st_ino, stat.st_mtime_ns):
+                    # The old graph is not closed, as another thread may still read it.
+                    self.graphs[jump_range] = JumpGraph(path)
+
+    def covering(self, max_distance: float) -> Optional[JumpGraph]:
+        """The graph of the shortest range of at least max_distance, None when none was built."""
+        self.refresh()
+        with self.lock:
+            ranges = [
+                jump_range for jump_range in self.graphs if jump_range >= max_distance
+            ]
+            return self.graphs[min(ranges)] if ranges else None
@@ -0,0 +1,516 @@
+import functools
+import heapq
+import itertools
+import math
+import operator
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+
+from django.db.models import QuerySet
+
+from EDSite.helpers import SingletonMeta
+from EDSite.models import LiveListing, System
+from EDSite.tools.spatial import (
+    DistanceOrderedRows,
+    Point,
+    SystemCoordinates,
+    SystemIndex,
+    position,
+)
+
+# The listings of a commodity that were loaded longer ago than this are loaded again. Imports
+# invalidate the whole index, updates of single stations by the live listener show up after this.
+LISTING_INDEX_SECONDS = 60
+# Most commodities whose listings are kept in memory. The least recently used ones are dropped first.
+LISTING_INDEX_COMMODITIES = 64
+# A system that the walk through the spatial index visits costs about as much as scanning this many
+# listings. The cheaper of the two is used, and a walk that took this many times its estimate turns
+# into a scan.
+WALK_COST = 5
+WALK_BUDGET = 4
+
+SUPPLY = "supply"
+DEMAND = "demand"
+
+# Stations of an unknown pad size are taken for M, like the filters of the commodity page do.
+PAD_SIZES = {"S": 0, "M": 1, "L": 2}
+UNKNOWN_PAD_SIZE = 1
+
+# The distance and the data age at which their terms of the score of a listing halve, in ly and s.
+RANK_HALF_DISTANCE = 50
+RANK_HALF_AGE = 24 * 60 * 60
+
+
+@dataclass
+class RankWeights:
+    """How much the price, units, data age and distance of a listing count towards its score."""
+
+    price: float = 1
+    units: float = 0.25
+    age: float = 0.25
+    distance: float = 1
+
+    def __post_init__(self):
+        weights = (self.price, self.units, self.age, self.distance)
+        if any(weight < 0 for weight in weights) or not sum(weights):
+            raise ValueError("Weights must not be negative, and not all be 0.")
+
+
+class CommodityListings:
+    """
+    The live listings of one commodity as parallel arrays, with the station attributes that queries
+    filter on, the rows of every system that has some and the coordinates of those systems.
+    Listings of systems without coordinates are left out, as they have no distance.
+    """
+
+    __slots__ = (
+        "loaded",
+        "listing_ids",
+        "system_ids",
+        "supply_prices",
+        "supply_units",
+        "demand_prices",
+        "demand_units",
+        "pad_sizes",
+        "planetary",
+        "fleet",
+        "odyssey",
+        "supply_log_units",
+        "demand_log_units",
+        "age_terms",
+        "system_rows",
+        "coordinates",
+        "coordinate_rows",
+    )
+
+    def __init__(self, rows: Iterable[tuple], positions: {int: Point}):
+        self.loaded = time.monotonic()
+        now = time.time()
+        self.listing_ids = array("q")
+        self.system_ids = array("q")
+        self.supply_prices, self.supply_units = array("l"), array("l")
+        self.demand_prices, self.demand_units = array("l"), array("l")
+        self.pad_sizes = array("b")
+        self.planetary, self.fleet, self.odyssey = array("b"), array("b"), array("b")
+        # The terms of the score that do not depend on the query. Ages are those at loading time,
+        # which is at most LISTING_INDEX_SECONDS off.
+        self.supply_log_units, self.demand_log_units = array("d"), array("d")
+        self.age_terms = array("d")
+        self.system_rows: {int: [int]} = {}
+        self.coordinates = SystemCoordinates()
+        self.coordinate_rows = array("q")
+        row = 0
+        for (
+            listing_id,
+            system_id,
+            supply_price,
+            supply_units,
+            demand_price,
+            demand_units,
+            pad_size,
+            planetary,
+            fleet,
+            odyssey,
+            modified,
+        ) in rows:
+            point = positions.get(system_id)
+            if point is None:
+                continue
+            self.listing_ids.append(listing_id)
+            self.system_ids.append(system_id)
+            self.supply_prices.append(supply_price)
+            self.supply_units.append(supply_units)
+            self.demand_prices.append(demand_price)
+            self.demand_units.append(demand_units)
+            self.pad_sizes.append(PAD_SIZES.get(pad_size, UNKNOWN_PAD_SIZE))
+            self.planetary.append(planetary)
+            self.fleet.append(fleet)
+            self.odyssey.append(odyssey)
+            self.supply_log_units.append(math.log1p(max(supply_units, 0)))
+            self.demand_log_units.append(math.log1p(max(demand_units, 0)))
+            age = max(now - modified.timestamp(), 0)
+            self.age_terms.append(0.5 ** (age / RANK_HALF_AGE))
+            self.system_rows.setdefault(system_id, []).append(row)
+            self.coordinates.insert(system_id, point)
+            self.coordinate_rows.append(self.coordinates.rows[system_id])
+            row += 1
+
+    def __len__(self):
+        return len(self.listing_ids)
+
+    def prices(self, mode: str) -> array:
+        return self.supply_prices if mode == SUPPLY else self.demand_prices
+
+    def units(self, mode: str) -> array:
+        return self.supply_units if mode == SUPPLY else self.demand_units
+
+    def log_units(self, mode: str) -> array:
+        return self.supply_log_units if mode == SUPPLY else self.demand_log_units
+
+    def distances(self, origin: Point, rows: [int]) -> [float]:
+        """The distances from origin to the systems of rows, with every system computed once."""
+        system_distances = self.coordinates.distances(origin)
+        return list(
+            map(
+                system_distances.__getitem__,
+                map(self.coordinate_rows.__getitem__, rows),
+            )
+        )
+
+
+class ListingFilter:
+    """Whether a row of CommodityListings matches the filters of a query."""
+
+    def __init__(
+        self,
+        listings: CommodityListings,
+        mode: str,
+        min_units: int,
+        pad_size: str,
+        include_planetary: bool,
+        include_fleet_carriers: bool,
+        include_odyssey: bool,
+    ):
+        self.prices, self.units = listings.prices(mode), listings.units(mode)
+        self.min_units = max(min_units, 1)
+        self.pad_sizes, self.min_pad_size = listings.pad_sizes, PAD_SIZES[pad_size]
+        # The station flags that rule a row out.
+        self.excluded = [
+            flags
+            for flags, included in (
+                (listings.planetary, include_planetary),
+                (listings.fleet, include_fleet_carriers),
+                (listings.odyssey, include_odyssey),
+            )
+            if not included
+        ]
+
+    def __call__(self, row: int) -> bool:
+        return (
+            self.units[row] >= self.min_units
+            and self.prices[row] > 0
+            and self.pad_sizes[row] >= self.min_pad_size
+            and not any(flags[row] for flags in self.excluded)
+        )
+
+    def rows(self, count: int) -> [int]:
+        """The matching rows of all count rows, filtered a column at a time."""
+        rows = list(
+            itertools.compress(
+                range(count),
+                map(
+                    operator.and_,
+                    map(operator.ge, self.units, itertools.repeat(self.min_units)),
+                    map(operator.gt, self.prices, itertools.repeat(0)),
+                ),
+            )
+        )
+        if self.min_pad_size:
+            rows = [row for row in rows if self.pad_sizes[row] >= self.min_pad_size]
+        for flags in self.excluded:
+            rows = [row for row in rows if not flags[row]]
+        return rows
+
+
+def score_listings(
+    listings: CommodityListings,
+    mode: str,
+    rows: [int],
+    distances: [float],
+    weights: RankWeights,
+) -> [float]:
+    """
+    The scores of rows at distances, a column at a time. Every term runs from 0 to 1, with 1 for
+    the best price and the most units among rows, for fresh data, and for the origin itself, and
+    the score is their weighted mean.
+    """
+    total = weights.price + weights.units + weights.age + weights.distance
+    terms = []
+    if weights.price:
+        # Every term is multiplied by its weight over the total along the way.
+        prices = list(map(listings.prices(mode).__getitem__, rows))
+        if mode == SUPPLY:
+            best = min(prices) * weights.price / total
+            terms.append(map(operator.truediv, itertools.repeat(best), prices))
+        else:
+            best = max(prices) * total / weights.price
+            terms.append(map(operator.truediv, prices, itertools.repeat(best)))
+    if weights.units:
+        units = list(map(listings.log_units(mode).__getitem__, rows))
+        most = max(units) * total / weights.units
+        terms.append(map(operator.truediv, units, itertools.repeat(most)))
+    if weights.age:
+        terms.append(
+            map(
+                operator.mul,
+                map(listings.age_terms.__getitem__, rows),
+                itertools.repeat(weights.age / total),
+            )
+        )
+    if weights.distance:
+        # 0.5 ** (distance / RANK_HALF_DISTANCE), with the weight folded into the exponent.
+        terms.append(
+            map(
+                operator.pow,
+                itertools.repeat(0.5 ** (1 / RANK_HALF_DISTANCE)),
+                map(
+                    operator.sub,
+                    distances,
+                    itertools.repeat(
+                        RANK_HALF_DISTANCE * math.log2(weights.distance / total)
+                    ),
+                ),
+            )
+        )
+    # The terms are summed in one pass, without a list for each of them.
+    return list(functools.reduce(lambda a, b: map(operator.add, a, b), terms))
+
+
+class RankedRows(DistanceOrderedRows):
+    """The rows of queryset in the order of ListingIndex.rank(), with their score set on them too."""
+
+    def __init__(self, queryset: QuerySet, ranked: [tuple]):
+        super().__init__(queryset, [(pk, distance) for pk, distance, _ in ranked])
+        self.scores = {pk: score for pk, _, score in ranked}
+
+    def pairs(self, distances: Optional[list] = None) -> [tuple]:
+        pairs = super().pairs(distances)
+        for row, _ in pairs:
+            row.score = self.scores[row.pk]
+        return pairs
+
+
+class ListingIndex(metaclass=SingletonMeta):
+    """
+    The live listings of the most recently queried commodities, for the closest stations that buy or
+    sell a commodity. Combined with the SystemIndex, a query either walks the systems outwards from
+    the origin and looks up their listings, or computes the distance of every system with a
+    matching listing, whichever is cheaper for the commodity. rank() scores every matching listing.
+
+        for listing_id, distance in ListingIndex().nearest(reference_system, commodity_id, SUPPLY):
+            ...
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commodities: OrderedDict[int, CommodityListings] = OrderedDict()
+
+    def __len__(self):
+        return len(self.commodities)
+
+    def get(self, commodity_id: int) -> CommodityListings:
+        with self.lock:
+            listings = self.commodities.get(commodity_id)
+            if listings is not None:
+                if time.monotonic() - listings.loaded < LISTING_INDEX_SECONDS:
+                    self.commodities.move_to_end(commodity_id)
+                    return listings
+                del self.commodities[commodity_id]
+        rows = list(
+            LiveListing.objects.filter(commodity_id=commodity_id)
+            .order_by()
+            .values_list(
+                "id",
+                "station__system_id",
+                "supply_price",
+                "supply_units",
+                "demand_price",
+                "demand_units",
+                "station__pad_size",
+                "station__planetary",
+                "station__fleet",
+                "station__odyssey",
+                "modified",
+            )
+            .iterator()
+        )
+        listings = CommodityListings(
+            rows, SystemIndex().positions({row[1] for row in rows})
+        )
+        with self.lock:
+            self.commodities[commodity_id] = listings
+            while len(self.commodities) > LISTING_INDEX_COMMODITIES:
+                self.commodities.popitem(last=False)
+        return listings
+
+    def invalidate(self, commodity_ids: Optional[Iterable[int]] = None):
+        """Drop the listings of commodity_ids, or of all commodities."""
+        with self.lock:
+            if commodity_ids is None:
+                self.commodities.clear()
+            else:
+                for commodity_id in commodity_ids:
+                    self.commodities.pop(commodity_id, None)
+
+    def nearest(
+        self,
+        origin: Union[System, Point],
+        commodity_id: int,
+        mode: str = SUPPLY,
+        limit: Optional[int] = 20,
+        min_units: int = 1,
+        pad_size: str = "S",
+        max_distance: Optional[float] = None,
+        include_planetary: bool = True,
+        include_fleet_carriers: bool = True,
+        include_odyssey: bool = True,
+    ) -> [tuple]:
+        """
+        The limit listings closest to origin that supply or demand at least min_units of the
+        commodity, at stations with a landing pad of at least pad_size, within max_distance.
+        Listings at the same distance come with the best price first.
+        :param mode: SUPPLY for the stations that sell the commodity, DEMAND for those that buy it.
+        :param limit: The number of listings, or None for all of them within max_distance.
+        :return: (listing id, distance) tuples, closest first.
+        """
+        if mode not in (SUPPLY, DEMAND):
+            raise ValueError(f"Unknown mode {mode!r}.")
+        if pad_size not in PAD_SIZES:
+            raise ValueError(f"Unknown pad size {pad_size!r}.")
+        listings = self.get(commodity_id)
+        matches = ListingFilter(
+            listings,
+            mode,
+            min_units,
+            pad_size,
+            include_planetary,
+            include_fleet_carriers,
+            include_odyssey,
+        )
+        index = SystemIndex()
+        found = None
+        if limit is not None and listings.system_rows:
+            # Systems with listings are spread like systems, so about this many are visited.
+            estimate = limit * len(index) / len(listings.system_rows)
+            if estimate * WALK_COST < len(listings):
+                found = self._walk(
+                    index, origin, listings, matches, limit, max_distance, estimate
+                )
+        if found is None:
+            found = self._scan(origin, listings, matches, limit, max_distance)
+        prices = listings.prices(mode)
+        sign = 1 if mode == SUPPLY else -1
+        found.sort(key=lambda pair: (pair[0], sign * prices[pair[1]], pair[1]))
+        if limit is not None:
+            del found[limit:]
+        return [(listings.listing_ids[row], distance) for distance, row in found]
+
+    def rank(
+        self,
+        origin: Union[System, Point],
+        commodity_id: int,
+        mode: str = SUPPLY,
+        limit: Optional[int] = 20,
+        weights: Optional[RankWeights] = None,
+        min_units: int = 1,
+        pad_size: str = "S",
+        max_distance: Optional[float] = None,
+        include_planetary: bool = True,
+        include_fleet_carriers: bool = True,
+        include_odyssey: bool = True,
+    ) -> [tuple]:
+        """
+        The limit listings with the best blend of price, units, data age and distance from origin,
+        of all listings that match the filters of nearest().
+        Listings with the same score come closest first.
+        :param weights: The blend, RankWeights() by default.
+        :return: (listing id, distance, score) tuples, best first.
+        """
+        if mode not in (SUPPLY, DEMAND):
+            raise ValueError(f"Unknown mode {mode!r}.")
+        if pad_size not in PAD_SIZES:
+            raise ValueError(f"Unknown pad size {pad_size!r}.")
+        weights = RankWeights() if weights is None else weights
+        listings = self.get(commodity_id)
+        matches = ListingFilter(
+            listings,
+            mode,
+            min_units,
+            pad_size,
+            include_planetary,
+            include_fleet_carriers,
+            include_odyssey,
+        )
+        rows, distances = self._candidates(origin, listings, matches, max_distance)
+        if not rows:
+            return []
+        scores = score_listings(listings, mode, rows, distances, weights)
+        ranked = zip(map(operator.neg, scores), distances, rows)
+        ranked = sorted(ranked) if limit is None else heapq.nsmallest(limit, ranked)
+        return [
+            (listings.listing_ids[row], distance, -score)
+            for score, distance, row in ranked
+        ]
+
+    def _walk(
+        self,
+        index: SystemIndex,
+        origin: Union[System, Point],
+        listings: CommodityListings,
+        matches: ListingFilter,
+        limit: int,
+        max_distance: Optional[float],
+        estimate: float,
+    ) -> Optional[list]:
+        """
+        Walk the systems outwards from origin until limit listings match. Every listing of the last
+        system is kept, so ties are broken by price.
+        :return: (distance, row) tuples, None when the walk went over its budget.
+        """
+        found, system_rows = [], listings.system_rows
+        budget = max(int(estimate * WALK_BUDGET), 1)
+        for visited, (distance, system_id) in enumerate(
+            index.iter_nearest(origin, max_distance)
+        ):
+            if len(found) >= limit:
+                if distance > found[-1][0]:
+                    break
+            elif visited >= budget:
+                return None
+            for row in system_rows.get(system_id, ()):
+                if matches(row):
+                    found.append((distance, row))
+        return found
+
+    def _candidates(
+        self,
+        origin: Union[System, Point],
+        listings: CommodityListings,
+        matches: ListingFilter,
+        max_distance: Optional[float],
+    ) -> ([int], [float]):
+        """
+        The matching rows within max_distance and their distances, as two lists. A list of pairs
+        would hold an object per listing, which makes the garbage collector go through the heap.
+        """
+        rows = matches.rows(len(listings))
+        distances = listings.distances(position(origin), rows)
+        if max_distance is not None:
+            within = list(map(operator.le, distances, itertools.repeat(max_distance)))
+            rows = list(itertools.compress(rows, within))
+            distances = list(itertools.compress(distances, within))
+        return rows, distances
+
+    def _scan(
+        self,
+        origin: Union[System, Point],
+        listings: CommodityListings,
+        matches: ListingFilter,
+        limit: Optional[int],
+        max_distance: Optional[float],
+    ) -> list:
+        """The distances of all matching listings, cut to the closest limit and max_distance."""
+        rows, distances = self._candidates(origin, listings, matches, max_distance)
+        if limit is not None and len(rows) > limit:
+            # Every listing at the distance of the last one is kept, so ties are broken by price.
+            cutoff = heapq.nsmallest(limit, distances)[-1]
+            return [
+                (distance, row)
+                for distance, row in zip(distances, rows)
+                if distance <= cutoff
+            ]
+        return list(zip(distances, rows))
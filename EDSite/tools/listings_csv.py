@@ -0,0 +1,210 @@
+import csv
+import datetime
+import gzip
+import io
+import os
+import shutil
+from email.utils import parsedate_to_datetime
+from itertools import islice, repeat
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
+from urllib import request
+
+from EDSite.helpers import is_gzip_file
+from EDSite.tools.import_progress import ImportProgress
+from EDSite.tools.listings_merge import ListingsStaging, MergeResult
+from EDSite.tools.timestamps import format_timestamp
+
+LISTINGS_CSV = "listings.csv"
+LIVE_LISTINGS_CSV = "listings-live.csv"
+EDDBLINK_URL = os.environ.get("TD_SERVER") or "https://elite.tromador.com/files/"
+
+# Number of csv lines that are converted at once.
+LISTINGS_BLOCK_SIZE = 50000
+# Number of listings that are merged in one transaction.
+LISTINGS_PART_SIZE = 200000
+
+# Columns of the eddblink listings files that are imported, in the order of STAGING_COLUMNS.
+# eddblink's buy_price is the price the station sells for, so it is our supply price.
+LISTINGS_CSV_COLUMNS = (
+    "station_id",
+    "commodity_id",
+    "sell_price",
+    "demand",
+    "buy_price",
+    "supply",
+    "collected_at",
+)
+
+
+def eddblink_data_path(tdb) -> Path:
+    """The folder in which TradeDangerous' eddblink plugin keeps its downloads."""
+    if os.environ.get("TD_EDDB"):
+        return Path(os.environ["TD_EDDB"])
+    return Path(tdb.dataPath) / "eddb"
+
+
+def find_listings_file(data_path: Path, name: str) -> Optional[Path]:
+    """Return the gzipped version of a listings file if there is one, or the plain file."""
+    for path in (data_path / f"{name}.gz", data_path / name):
+        if path.exists():
+            return path
+    return None
+
+
+def download_listings_file(data_path: Path, name: str) -> bool:
+    """
+    Download a listings file from the eddblink server if it is newer than the local copy.
+    :return: True if a new file was downloaded.
+    """
+    path = data_path / name
+    response = request.urlopen(
+        request.Request(EDDBLINK_URL + name, headers={"User-Agent": "Trade-Dangerous"})
+    )
+    last_modified = response.getheader("Last-Modified")
+    if path.exists() and last_modified:
+        if path.stat().st_mtime >= parsedate_to_datetime(last_modified).timestamp():
+            response.close()
+            return False
+    data_path.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix(path.suffix + ".part")
+    with response, open(partial, "wb") as fh:
+        shutil.copyfileobj(response, fh, 1024 * 1024)
+    partial.replace(path)
+    return True
+
+
+def open_listings_file(path: Path) -> TextIO:
+    """Open a listings file for reading, decompressing it on the fly when it is gzipped."""
+    if is_gzip_file(path):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", errors="ignore", newline="")
+
+
+def read_position(fh: TextIO) -> int:
+    """How far a listings file has been read, in bytes of the file on disk."""
+    buffer = fh.buffer
+    # A gzipped file is measured on the compressed file underneath.
+    return getattr(buffer, "fileobj", buffer).tell()
+
+
+def read_listing_blocks(
+    fh: TextIO, block_size: int = LISTINGS_BLOCK_SIZE
+) -> Iterator[tuple]:
+    """
+    Parse a listings file in blocks of block_size lines.
+    Every block is converted column by column instead of row by row.
+    :return: Tuples of integer columns, in the order of LISTINGS_CSV_COLUMNS.
+    """
+    reader = csv.reader(fh)
+    header = next(reader)
+    indices = [header.index(column) for column in LISTINGS_CSV_COLUMNS]
+    while True:
+        lines = list(islice(reader, block_size))
+        if not lines:
+            return
+        columns = list(zip(*lines))
+        yield tuple(list(map(int, columns[index])) for index in indices)
+
+
+def station_chunks(
+    blocks: Iterator[tuple], part_size: int = LISTINGS_PART_SIZE
+) -> Iterator[tuple]:
+    """
+    Regroup column blocks into chunks of about part_size listings that never split a station,
+    because the merge deletes the listings that are missing from a station's market.
+    The listings files are sorted by station. Once part_size listings are pending, they are cut
+    before the last station, which may go on in the next block.
+    """
+    pending = None
+    last_station_id = None
+    for block in blocks:
+        station_ids = block[0]
+        if last_station_id is not None and station_ids[0] < last_station_id:
+            raise ValueError("The listings file is not sorted by station_id.")
+        if any(a > b for a, b in zip(station_ids, islice(station_ids, 1, None))):
+            raise ValueError("The listings file is not sorted by station_id.")
+        last_station_id = station_ids[-1]
+        pending = (
+            block
+            if pending is None
+            else tuple(old + new for old, new in zip(pending, block))
+        )
+        if len(pending[0]) < part_size:
+            continue
+        # Everything before the first listing of the last station is complete.
+        split = len(pending[0]) - 1
+        while split > 0 and pending[0][split - 1] == last_station_id:
+            split -= 1
+        if split == 0:
+            continue
+        yield tuple(column[:split] for column in pending)
+        pending = tuple(column[split:] for column in pending)
+    if pending is not None and pending[0]:
+        yield pending
+
+
+def staging_rows(chunk: tuple, from_live: bool, since: Optional[int] = None):
+    """
+    Turn a column chunk into rows in the layout of STAGING_COLUMNS.
+    :param since: Skip the stations whose market is not newer than this epoch.
+    """
+    if since is not None:
+        updated = {}
+        for station_id, collected_at in zip(chunk[0], chunk[6]):
+            if collected_at > updated.get(station_id, 0):
+                updated[station_id] = collected_at
+        keep = [updated[station_id] > since for station_id in chunk[0]]
+        chunk = tuple(
+            [value for value, kept in zip(column, keep) if kept] for column in chunk
+        )
+    return zip(*chunk[:6], map(format_timestamp, chunk[6]), repeat(from_live))
+
+
+def merge_listings_file(
+    path: Path,
+    from_live: bool = False,
+    since: Optional[datetime.datetime] = None,
+    part_size: int = LISTINGS_PART_SIZE,
+    progress: Optional[ImportProgress] = None,
+    progress_offset: int = 0,
+) -> (MergeResult, Optional[datetime.datetime]):
+    """
+    Stream an eddblink listings file straight into LiveListing.
+    The file holds complete markets, so listings that are missing from a newer market are deleted.
+    :param since: Only import the markets that were collected after this time.
+    :param progress: Checkpoint every merged chunk, and skip the chunks that are already checkpointed.
+    :param progress_offset: Bytes of the listings stage that come before this file.
+    :return: The merge counts and the newest collected_at timestamp in the file.
+    """
+    since_epoch = int(since.timestamp()) if since else None
+    newest = None
+    total = MergeResult()
+    staging = ListingsStaging()
+    try:
+        with open_listings_file(path) as fh:
+            for chunk in station_chunks(read_listing_blocks(fh), part_size):
+                newest = max(newest or 0, max(chunk[6]))
+                key = f"{path.name}:{chunk[0][0]}-{chunk[0][-1]}"
+                if progress and progress.is_done("listings", key):
+                    continue
+                result = staging.merge_chunk(
+                    staging_rows(chunk, from_live, since=since_epoch),
+                    chunk[0][0],
+                    chunk[0][-1],
+                    delete_missing=False,
+                    delete_replaced=True,
+                )
+                total += result
+                if progress:
+                    progress.checkpoint(
+                        "listings",
+                        key,
+                        result,
+                        done=progress_offset + read_position(fh),
+                    )
+    finally:
+        staging.drop()
+    if newest is None:
+        return total, None
+    return total, datetime.datetime.fromtimestamp(newest, tz=datetime.timezone.utc)
@@ -0,0 +1,435 @@
+import sqlite3
+from dataclasses import dataclass
+from typing import Iterable, Optional, Sequence
+
+from django.db import OperationalError, connection, transaction
+
+from EDSite.models import LiveListing, HistoricListing, Station, Commodity
+from EDSite.tools.bulk import insert_rows
+from EDSite.tools.td_session import open_td_database
+from EDSite.tools.trade_routes import StationMarkets
+from EDSiteProject import settings
+
+STAGING_TABLE = "edsite_listing_staging"
+# How long a live market message waits for listings that an import has locked. This is shorter than
+# PostgreSQL's deadlock_timeout, so a live message gives way before it could abort an import chunk.
+LIVE_LOCK_TIMEOUT = "500ms"
+LOCK_NOT_AVAILABLE = "55P03"
+
+# Columns of the rows that are fed to ListingsStaging.load(). Same order as TradeDangerous' StationItem.
+# The keys are matched against ListingsStaging.station_key and commodity_key.
+STAGING_COLUMNS = (
+    "station_key",
+    "commodity_key",
+    "demand_price",
+    "demand_units",
+    "supply_price",
+    "supply_units",
+    "modified",
+    "from_live",
+)
+
+
+class ListingsLocked(Exception):
+    """The listings of a station are locked by an import. The message should be retried later."""
+
+
+@dataclass
+class MergeResult:
+    staged: int = 0
+    unknown: int = 0
+    historic: int = 0
+    updated: int = 0
+    created: int = 0
+    deleted: int = 0
+
+    def __iadd__(self, other: "MergeResult"):
+        self.staged += other.staged
+        self.unknown += other.unknown
+        self.historic += other.historic
+        self.updated += other.updated
+        self.created += other.created
+        self.deleted += other.deleted
+        return self
+
+    def __str__(self):
+        return (
+            f"staged={self.staged}, unknown={self.unknown}, new={self.created}, up={self.updated}, "
+            f"del={self.deleted}, hist={self.historic}"
+        )
+
+
+LIVE_COLUMNS = (
+    "commodity_id",
+    "commodity_tradedangerous_id",
+    "station_id",
+    "station_tradedangerous_id",
+    "demand_price",
+    "demand_units",
+    "supply_price",
+    "supply_units",
+    "modified",
+    "from_live",
+)
+LIVE_COLUMN_TYPES = (
+    "bigint",
+    "integer",
+    "bigint",
+    "integer",
+    "integer",
+    "integer",
+    "integer",
+    "integer",
+    "timestamp with time zone",
+    "boolean",
+)
+UPDATABLE_COLUMNS = (
+    "demand_price",
+    "demand_units",
+    "supply_price",
+    "supply_units",
+    "modified",
+    "from_live",
+)
+
+
+def _table(model) -> str:
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def _price_changed_sql(column: str) -> str:
+    """SQL version of helpers.difference_percent(old, new) > HISTORIC_DIFFERENCE_DELTA."""
+    delta = float(settings.HISTORIC_DIFFERENCE_DELTA)
+    return (
+        f"(CASE WHEN l.{column} = s.{column} THEN 0 "
+        f"WHEN l.{column} = 0 OR s.{column} = 0 THEN 100.0 "
+        f"ELSE abs(l.{column} - s.{column}) * 100.0 / s.{column} END) > {delta}"
+    )
+
+
+def history_sql(source: str) -> str:
+    """
+    Archive the live listings that are about to be replaced by a newer row of source.
+    Source must be a query that returns LIVE_COLUMNS and a fleet column.
+    """
+    return f"""
+        INSERT INTO {_table(HistoricListing)}
+            (commodity_id, station_id, demand_price, demand_units, supply_price, supply_units, datetime)
+        SELECT l.commodity_id, l.station_id, l.demand_price, l.demand_units,
+               l.supply_price, l.supply_units, l.modified
+        FROM {_table(LiveListing)} l
+        JOIN ({source}) s ON l.station_id = s.station_id AND l.commodity_id = s.commodity_id
+        WHERE NOT s.fleet
+          AND l.modified < s.modified
+          AND ({_price_changed_sql("demand_price")} OR {_price_changed_sql("supply_price")})
+    """
+
+
+def upsert_sql(source: str) -> str:
+    """
+    Insert the rows of source into LiveListing. Existing listings are only overwritten by newer rows.
+    Returns one row per inserted or updated listing, with a boolean that is true for inserts.
+    """
+    columns = ", ".join(LIVE_COLUMNS)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in UPDATABLE_COLUMNS)
+    return f"""
+        INSERT INTO {_table(LiveListing)} AS l ({columns})
+        SELECT {columns} FROM ({source}) s
+        ON CONFLICT (station_id, commodity_id) DO UPDATE SET {updates}
+        WHERE l.modified < EXCLUDED.modified
+        RETURNING (l.xmax = 0) AS created
+    """
+
+
+def counted_upsert_sql(source: str, history_source: str = None) -> str:
+    """
+    Upsert the rows of source and select the number of created, updated and archived listings.
+    All parts of the statement see the same snapshot, so the history is taken from the old rows.
+    """
+    if history_source:
+        history = f"history AS ({history_sql(history_source)} RETURNING 1),"
+        historic_count = "(SELECT count(*) FROM history)"
+    else:
+        history = ""
+        historic_count = "0"
+    return f"""
+        WITH {history} upserted AS ({upsert_sql(source)})
+        SELECT count(*) FILTER (WHERE created), count(*) FILTER (WHERE NOT created), {historic_count}
+        FROM upserted
+    """
+
+
+def upsert_station_listings(station, listings: ["LiveListing"]) -> MergeResult:
+    """
+    Write the listings of one market message with a single upsert and remove the commodities the station
+    no longer trades. Listings that are already newer in the database are left alone, so the live listener
+    and the TradeDangerous importer can write the same station concurrently.
+    :raises ListingsLocked: When an import holds the station's listings for longer than LIVE_LOCK_TIMEOUT.
+    """
+    result = MergeResult()
+    # A commodity can only be upserted once per statement. Rows are locked in commodity order.
+    by_commodity = {
+        ll.commodity_id: ll for ll in sorted(listings, key=lambda ll: ll.commodity_id)
+    }
+    if not by_commodity:
+        return result
+    placeholders = "(" + ", ".join(f"%s::{t}" for t in LIVE_COLUMN_TYPES) + ")"
+    params = []
+    for ll in by_commodity.values():
+        params.extend(
+            [
+                ll.commodity_id,
+                ll.commodity_tradedangerous_id,
+                station.id,
+                station.tradedangerous_id,
+                ll.demand_price,
+                ll.demand_units,
+                ll.supply_price,
+                ll.supply_units,
+                ll.modified,
+                bool(ll.from_live),
+            ]
+        )
+    fleet = "true" if station.fleet else "false"
+    source = (
+        f"SELECT *, {fleet} AS fleet FROM (VALUES {', '.join([placeholders] * len(by_commodity))}) "
+        f"AS v ({', '.join(LIVE_COLUMNS)})"
+    )
+    modified = max(ll.modified for ll in by_commodity.values())
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(f"SET LOCAL lock_timeout = '{LIVE_LOCK_TIMEOUT}'")
+            cursor.execute(
+                counted_upsert_sql(source, history_source=source), params * 2
+            )
+            result.created, result.updated, result.historic = cursor.fetchone()
+            cursor.execute(
+                f"""
+                DELETE FROM {_table(LiveListing)}
+                WHERE station_id = %s AND modified < %s AND NOT (commodity_id = ANY(%s))
+                """,
+                [station.id, modified, list(by_commodity.keys())],
+            )
+            result.deleted = cursor.rowcount
+    except OperationalError as e:
+        if getattr(e.__cause__, "pgcode", None) == LOCK_NOT_AVAILABLE:
+            raise ListingsLocked(f"The listings of {station} are locked.") from e
+        raise
+    StationMarkets().invalidate([station.id])
+    return result
+
+
+class ListingsStaging:
+    """
+    Merges TradeDangerous listings into LiveListing with a handful of set-based statements per chunk.
+    Every chunk is copied into a temporary staging table. The station and commodity ids are resolved
+    in the database, after which history is appended, LiveListing is upserted and vanished rows are deleted.
+    :param station_key: The Station column that identifies the stations of the staged rows.
+    :param commodity_key: The Commodity column that identifies the commodities of the staged rows.
+    """
+
+    def __init__(
+        self, station_key="tradedangerous_id", commodity_key="tradedangerous_id"
+    ):
+        quote = connection.ops.quote_name
+        self.station_key = quote(station_key)
+        self.commodity_key = quote(commodity_key)
+        self.staging = quote(STAGING_TABLE)
+        self.live = _table(LiveListing)
+        self.station = _table(Station)
+        self.commodity = _table(Commodity)
+        self.created = False
+
+    def create(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                CREATE TEMPORARY TABLE IF NOT EXISTS {self.staging} (
+                    station_key bigint NOT NULL,
+                    commodity_key bigint NOT NULL,
+                    demand_price integer NOT NULL,
+                    demand_units integer NOT NULL,
+                    supply_price integer NOT NULL,
+                    supply_units integer NOT NULL,
+                    modified timestamp NOT NULL,
+                    from_live boolean NOT NULL,
+                    station_id bigint NULL,
+                    station_tradedangerous_id integer NULL,
+                    commodity_tradedangerous_id integer NULL,
+                    commodity_id bigint NULL,
+                    fleet boolean NULL
+                )
+                """
+            )
+        self.created = True
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.staging}")
+        self.created = False
+
+    def load(self, rows: Iterable[Sequence]) -> MergeResult:
+        """Replace the content of the staging table with rows and resolve the django ids."""
+        if not self.created:
+            self.create()
+        result = MergeResult()
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.staging}")
+        result.staged = insert_rows(STAGING_TABLE, STAGING_COLUMNS, rows)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {self.staging} s
+                SET station_id = st.id, station_tradedangerous_id = st.tradedangerous_id, fleet = st.fleet,
+                    commodity_id = c.id, commodity_tradedangerous_id = c.tradedangerous_id
+                FROM {self.station} st, {self.commodity} c
+                WHERE st.{self.station_key} = s.station_key
+                  AND c.{self.commodity_key} = s.commodity_key
+                """
+            )
+            result.unknown = result.staged - cursor.rowcount
+            if connection.vendor == "postgresql":
+                cursor.execute(f"ANALYZE {self.staging}")
+        return result
+
+    def merge(
+        self,
+        min_station_td_id: int,
+        max_station_td_id: int,
+        delete_missing=True,
+        delete_replaced=False,
+    ) -> MergeResult:
+        """
+        Merge the staged rows into LiveListing.
+        :param delete_missing: Delete the live listings in the station range that were not staged. Listings
+        that are newer than the newest staged listing were written by the live listener during the import,
+        so they are kept.
+        :param delete_replaced: Delete the live listings of the staged stations that are missing from
+        the staged market, unless they are newer than it.
+        """
+        result = MergeResult()
+        source = f"""
+            SELECT {", ".join(column for column in LIVE_COLUMNS if column != "modified")},
+                   modified AT TIME ZONE 'UTC' AS modified, fleet
+            FROM {self.staging}
+            WHERE station_id IS NOT NULL AND commodity_id IS NOT NULL
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(history_sql(source))
+            result.historic = cursor.rowcount
+            cursor.execute(counted_upsert_sql(source))
+            result.created, result.updated, _ = cursor.fetchone()
+            if delete_missing:
+                cursor.execute(
+                    f"""
+                    DELETE FROM {self.live} l
+                    WHERE l.station_tradedangerous_id BETWEEN %s AND %s
+                      AND l.modified <= (SELECT max(modified) AT TIME ZONE 'UTC' FROM {self.staging})
+                      AND NOT EXISTS (
+                        SELECT 1 FROM {self.staging} s
+                        WHERE l.station_id = s.station_id AND l.commodity_id = s.commodity_id
+                      )
+                    """,
+                    [min_station_td_id, max_station_td_id],
+                )
+                result.deleted = cursor.rowcount
+            elif delete_replaced:
+                cursor.execute(
+                    f"""
+                    DELETE FROM {self.live} l
+                    USING (
+                        SELECT station_id, max(modified) AT TIME ZONE 'UTC' AS modified
+                        FROM {self.staging}
+                        WHERE station_id IS NOT NULL
+                        GROUP BY station_id
+                    ) m
+                    WHERE l.station_id = m.station_id
+                      AND l.modified < m.modified
+                      AND NOT EXISTS (
+                        SELECT 1 FROM {self.staging} s
+                        WHERE l.station_id = s.station_id AND l.commodity_id = s.commodity_id
+                      )
+                    """
+                )
+                result.deleted = cursor.rowcount
+        return result
+
+    def merge_chunk(
+        self,
+        rows: Iterable[Sequence],
+        min_station_td_id: int,
+        max_station_td_id: int,
+        delete_missing=True,
+        delete_replaced=False,
+    ) -> MergeResult:
+        """Stage and merge one chunk of listings in a single transaction."""
+        with transaction.atomic():
+            result = self.load(rows)
+            result += self.merge(
+                min_station_td_id,
+                max_station_td_id,
+                delete_missing=delete_missing,
+                delete_replaced=delete_replaced,
+            )
+        return result
+
+
+def td_station_ranges(
+    td_db: sqlite3.Connection, part_size: int, since: Optional[str] = None
+) -> [(int, int)]:
+    """
+    Split TradeDangerous' StationItem table into station id ranges of roughly part_size listings.
+    A station is never split over two ranges.
+    :param since: Only count the listings that were modified after this TradeDangerous timestamp.
+    """
+    ranges = []
+    start, size = None, 0
+    for station_td_id, count in td_db.execute(
+        "SELECT station_id, count(*) FROM StationItem "
+        + ("WHERE modified > ? " if since else "")
+        + "GROUP BY station_id ORDER BY station_id",
+        [since] if since else [],
+    ):
+        if start is None:
+            start = station_td_id
+        size += count
+        if size >= part_size:
+            ranges.append((start, station_td_id))
+            start, size = None, 0
+    if start is not None:
+        ranges.append((start, station_td_id))
+    return ranges
+
+
+def merge_td_listings_range(
+    td_db_filename: str,
+    min_station_td_id: int,
+    max_station_td_id: int,
+    since: Optional[str] = None,
+) -> MergeResult:
+    """
+    Import one station range of TradeDangerous' StationItem table.
+    This runs in the import worker processes, so it opens its own read-only TradeDangerous connection
+    and uses the Django connection of the worker.
+    :param since: Only import the listings that were modified after this TradeDangerous timestamp.
+    """
+    td_db = open_td_database(td_db_filename)
+    staging = ListingsStaging()
+    try:
+        td_rows = td_db.execute(
+            "SELECT station_id, item_id, demand_price, demand_units, supply_price, supply_units, modified, from_live "
+            "FROM StationItem WHERE station_id >= ? and station_id <= ?"
+            + (" and modified > ?" if since else ""),
+            [min_station_td_id, max_station_td_id] + ([since] if since else []),
+        )
+        # Only a full import knows which listings have disappeared.
+        return staging.merge_chunk(
+            td_rows,
+            min_station_td_id,
+            max_station_td_id,
+            delete_missing=since is None,
+        )
+    finally:
+        staging.drop()
+        td_db.close()
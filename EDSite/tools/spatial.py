@@ -0,0 +1,501 @@
+import bisect
+import collections.abc
+import heapq
+import itertools
+import math
+import operator
+import threading
+import time
+from array import array
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, Union
+
+from django.db.models import F, FloatField, QuerySet
+from django.db.models.functions import Power, Sqrt
+
+from EDSite.helpers import SingletonMeta
+from EDSite.models import System
+
+# Most systems in a leaf of the k-d tree.
+LEAF_SIZE = 32
+# Systems added after the tree was built are searched one by one. This many of them rebuild the tree.
+PENDING_LIMIT = 4096
+# Systems that were inserted by another process are picked up after this many seconds.
+REFRESH_SECONDS = 60
+# The whole index is reloaded after this many seconds, which picks up moved and deleted systems.
+REBUILD_SECONDS = 3600
+# Number of ids that closest() looks up in its first query. Each further query looks up twice as many.
+CLOSEST_BATCH_SIZE = 256
+# When closest() still lacks rows after this many systems, the database orders the rest by distance.
+CLOSEST_INDEX_SYSTEMS = 1024
+
+Point = tuple[float, float, float]
+
+
+def position(origin: Union[System, Point]) -> Point:
+    if isinstance(origin, System):
+        return origin.pos_x, origin.pos_y, origin.pos_z
+    return tuple(origin)
+
+
+def annotate_distance(
+    queryset: QuerySet,
+    origin: Union[System, Point],
+    radius: Optional[float] = None,
+    field: str = "",
+) -> QuerySet:
+    """
+    Annotate queryset with the distance from origin as "distance", so the database can order by it.
+    With a radius, the rows further away are filtered out. The exact distance is only computed for the
+    rows inside the bounding box of the radius, which the indexes on the coordinates and on
+    distance_to_sol narrow down.
+    :param field: The path from the rows to their system, like "system__" for stations.
+    """
+    x, y, z = position(origin)
+    queryset = queryset.annotate(
+        distance=Sqrt(
+            Power(F(f"{field}pos_x") - x, 2)
+            + Power(F(f"{field}pos_y") - y, 2)
+            + Power(F(f"{field}pos_z") - z, 2),
+            output_field=FloatField(),
+        )
+    )
+    if radius is None:
+        return queryset
+    sol = math.hypot(x, y, z)
+    return queryset.filter(
+        **{
+            f"{field}pos_x__range": (x - radius, x + radius),
+            f"{field}pos_y__range": (y - radius, y + radius),
+            f"{field}pos_z__range": (z - radius, z + radius),
+            # Systems within radius of origin are within radius of its distance to Sol as well.
+            f"{field}distance_to_sol__range": (sol - radius, sol + radius),
+            "distance__lte": radius,
+        }
+    )
+
+
+def _gather(values: Sequence, rows: Sequence[int]) -> Sequence:
+    """values[row] for every row, in one call."""
+    if len(rows) == 1:
+        return (values[rows[0]],)
+    return operator.itemgetter(*rows)(values) if rows else ()
+
+
+class SystemCoordinates:
+    """
+    The coordinates of the systems in contiguous arrays, with a map from system id to row.
+    Distances are computed a batch of rows at a time, with the loops running in C.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.xs = array("d")
+        self.ys = array("d")
+        self.zs = array("d")
+        self.rows: {int: int} = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, row: int) -> Point:
+        return self.xs[row], self.ys[row], self.zs[row]
+
+    def insert(self, system_id: int, point: Point) -> Optional[int]:
+        """
+        Add a system, or move it if it exists already.
+        :return: The row of a new system, None when an existing one was moved or left as it was.
+        """
+        row = self.rows.get(system_id)
+        if row is not None:
+            self.xs[row], self.ys[row], self.zs[row] = point
+            return None
+        row = self.rows[system_id] = len(self.ids)
+        self.ids.append(system_id)
+        self.xs.append(point[0])
+        self.ys.append(point[1])
+        self.zs.append(point[2])
+        return row
+
+    def distances(self, origin: Point, rows: Optional[Sequence[int]] = None) -> [float]:
+        """The distances from origin to the systems of rows, or to all systems."""
+        if rows is None:
+            xs, ys, zs = self.xs, self.ys, self.zs
+        else:
+            xs, ys, zs = (
+                _gather(values, rows) for values in (self.xs, self.ys, self.zs)
+            )
+        ox, oy, oz = origin
+        return list(
+            map(
+                math.hypot,
+                map(operator.sub, xs, itertools.repeat(ox)),
+                map(operator.sub, ys, itertools.repeat(oy)),
+                map(operator.sub, zs, itertools.repeat(oz)),
+            )
+        )
+
+
+class KDTree:
+    """
+    Static k-d tree over rows of SystemCoordinates. Every node covers a contiguous range of order and
+    keeps the exact bounding box of its systems. Nodes are split at the median of their widest axis
+    until they hold at most LEAF_SIZE systems.
+    """
+
+    def __init__(self, coordinates: SystemCoordinates, rows: Sequence[int]):
+        self.coordinates = coordinates
+        self.order = array("q", rows)
+        self.lo, self.hi, self.left, self.right = [], [], [], []
+        self.bounds = [array("d") for _ in range(6)]
+        if self.order:
+            self._build()
+
+    def _build(self):
+        columns = (self.coordinates.xs, self.coordinates.ys, self.coordinates.zs)
+        stack = [(self._add_node(0, len(self.order)), 0, len(self.order))]
+        while stack:
+            node, lo, hi = stack.pop()
+            segment = self.order[lo:hi]
+            extents = []
+            for axis, values in enumerate(columns):
+                gathered = _gather(values, segment)
+                low, high = min(gathered), max(gathered)
+                self.bounds[axis * 2][node], self.bounds[axis * 2 + 1][node] = low, high
+                extents.append(high - low)
+            if hi - lo <= LEAF_SIZE:
+                continue
+            values = columns[extents.index(max(extents))]
+            self.order[lo:hi] = array("q", sorted(segment, key=values.__getitem__))
+            middle = (lo + hi) // 2
+            for child_lo, child_hi, children in (
+                (lo, middle, self.left),
+                (middle, hi, self.right),
+            ):
+                child = self._add_node(child_lo, child_hi)
+                children[node] = child
+                stack.append((child, child_lo, child_hi))
+
+    def _add_node(self, lo: int, hi: int) -> int:
+        self.lo.append(lo)
+        self.hi.append(hi)
+        self.left.append(-1)
+        self.right.append(-1)
+        for bound in self.bounds:
+            bound.append(0.0)
+        return len(self.lo) - 1
+
+    def box_distance(self, node: int, origin: Point) -> float:
+        """Distance from origin to the bounding box of node, 0 when origin is inside it."""
+        return math.hypot(
+            *(
+                max(self.bounds[axis * 2][node] - coordinate, 0.0)
+                + max(coordinate - self.bounds[axis * 2 + 1][node], 0.0)
+                for axis, coordinate in enumerate(origin)
+            )
+        )
+
+
+class SystemIndex(metaclass=SingletonMeta):
+    """
+    In-memory index over the coordinates of every system, for nearest and within-radius queries and
+    for batched distances.
+    The index is loaded on first use. Systems with a higher id than the last loaded one are added every
+    REFRESH_SECONDS, and the imports add or invalidate what they change in this process. Added systems
+    are searched one by one until there are PENDING_LIMIT of them, after which the tree is rebuilt.
+
+        for distance, system_id in SystemIndex().nearest(reference_system, 10):
+            ...
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.coordinates = SystemCoordinates()
+        self.tree = KDTree(self.coordinates, ())
+        # Rows that were added after the tree was built.
+        self.pending = array("q")
+        self.max_id = 0
+        self.stale = True
+        self.built = 0.0
+        self.refreshed = 0.0
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def rebuild(self):
+        coordinates, max_id = SystemCoordinates(), 0
+        for system_id, *point in System.objects.values_list(
+            "id", "pos_x", "pos_y", "pos_z"
+        ).iterator():
+            coordinates.insert(system_id, tuple(point))
+            max_id = max(max_id, system_id)
+        tree = KDTree(coordinates, range(len(coordinates)))
+        with self.lock:
+            self.coordinates, self.tree, self.max_id = coordinates, tree, max_id
+            self.pending = array("q")
+            self.stale = False
+            self.built = self.refreshed = time.monotonic()
+
+    def refresh(self):
+        """Load the index if it is stale, or add the systems that were inserted since the last refresh."""
+        now = time.monotonic()
+        with self.lock:
+            if self.stale or now - self.built >= REBUILD_SECONDS:
+                self.rebuild()
+            elif now - self.refreshed >= REFRESH_SECONDS:
+                self.add(
+                    System.objects.filter(id__gt=self.max_id).values_list(
+                        "id", "pos_x", "pos_y", "pos_z"
+                    )
+                )
+                self.refreshed = now
+
+    def add(self, systems: Iterable[Union[System, tuple]]):
+        """Add or move systems, given as System instances or (id, x, y, z) tuples."""
+        with self.lock:
+            if self.stale:
+                return
+            moved = False
+            for system in systems:
+                if isinstance(system, System):
+                    system_id, point = system.id, position(system)
+                else:
+                    system_id, point = system[0], tuple(system[1:])
+                row = self.coordinates.rows.get(system_id)
+                if row is not None:
+                    moved = moved or self.coordinates.position(row) != point
+                row = self.coordinates.insert(system_id, point)
+                if row is not None:
+                    self.pending.append(row)
+                self.max_id = max(self.max_id, system_id)
+            # The tree can not move systems between its nodes, so it is rebuilt from the arrays.
+            if moved or len(self.pending) > PENDING_LIMIT:
+                self.tree = KDTree(self.coordinates, range(len(self.coordinates)))
+                self.pending = array("q")
+
+    def invalidate(self):
+        """Reload the whole index on its next use."""
+        with self.lock:
+            self.stale = True
+
+    def _rows(self, system_ids: Iterable[int]) -> {int: int}:
+        """The rows of system_ids. Systems that are not indexed yet are loaded, unknown ones left out."""
+        self.refresh()
+        rows = self.coordinates.rows
+        system_ids = set(system_ids)
+        missing = [system_id for system_id in system_ids if system_id not in rows]
+        if missing:
+            self.add(
+                System.objects.filter(id__in=missing).values_list(
+                    "id", "pos_x", "pos_y", "pos_z"
+                )
+            )
+            rows = self.coordinates.rows
+        return {
+            system_id: rows[system_id] for system_id in system_ids if system_id in rows
+        }
+
+    def distances(
+        self, origin: Union[System, Point], system_ids: Iterable[int]
+    ) -> {int: float}:
+        """The distances from origin to every system of system_ids, by system id."""
+        rows = self._rows(system_ids)
+        return dict(
+            zip(rows, self.coordinates.distances(position(origin), list(rows.values())))
+        )
+
+    def positions(self, system_ids: Iterable[int]) -> {int: Point}:
+        """The coordinates of every system of system_ids, by system id."""
+        rows = self._rows(system_ids)
+        coordinates = self.coordinates
+        return {system_id: coordinates.position(row) for system_id, row in rows.items()}
+
+    def snapshot(self, system_ids: Iterable[int] = ()) -> SystemCoordinates:
+        """
+        The coordinates of every system, after loading system_ids if they are not indexed yet.
+        Rows are only ever appended to them and a rebuild replaces them, so they can be read
+        without the lock.
+        """
+        self._rows(system_ids)
+        with self.lock:
+            return self.coordinates
+
+    def sort_by_distance(
+        self,
+        origin: Union[System, Point],
+        items: Iterable,
+        key: Callable = operator.attrgetter("system_id"),
+        max_distance: Optional[float] = None,
+    ) -> ([Any], [float]):
+        """
+        Sort items by the distance from origin to their system, optionally leaving out those further
+        than max_distance. Items of systems that do not exist are left out as well.
+        The distance of every system is computed once, and the items are sorted on a list of their
+        distances. The result is two lists rather than pairs, as building a tuple per item costs more
+        than the sort itself.
+        :param key: Gives the system id of an item. Stations and systems use "system_id" and "id".
+        :return: The sorted items and their distances, closest first.
+        """
+        items = list(items)
+        system_ids = list(map(key, items))
+        distances = self.distances(origin, system_ids)
+        item_distances = list(
+            map(distances.get, system_ids, itertools.repeat(math.inf))
+        )
+        order = sorted(range(len(items)), key=item_distances.__getitem__)
+        item_distances = list(map(item_distances.__getitem__, order))
+        if max_distance is None:
+            end = bisect.bisect_left(item_distances, math.inf)
+        else:
+            end = bisect.bisect_right(item_distances, max_distance)
+        return list(map(items.__getitem__, order[:end])), item_distances[:end]
+
+    def iter_nearest(
+        self, origin: Union[System, Point], max_distance: Optional[float] = None
+    ) -> Iterator[tuple]:
+        """
+        Every system ordered by distance to origin, optionally up to max_distance.
+        The tree is searched best first: one heap holds both nodes, by the distance to their bounding
+        box, and systems, by their distance. A system is only handed out once no node can hold a
+        closer one.
+        :return: (distance, system id) tuples.
+        """
+        self.refresh()
+        origin = position(origin)
+        with self.lock:
+            coordinates, tree, pending = self.coordinates, self.tree, self.pending[:]
+        ids, order = coordinates.ids, tree.order
+        limit = math.inf if max_distance is None else max_distance
+        # Nodes sort before systems at the same distance, so ties come out by system id.
+        heap = [
+            (distance, 1, ids[row])
+            for distance, row in zip(coordinates.distances(origin, pending), pending)
+        ]
+        if tree.lo:
+            heap.append((tree.box_distance(0, origin), 0, 0))
+        heapq.heapify(heap)
+        while heap:
+            distance, is_system, value = heapq.heappop(heap)
+            if distance > limit:
+                return
+            if is_system:
+                yield distance, value
+            elif tree.left[value] < 0:
+                rows = order[tree.lo[value] : tree.hi[value]]
+                for row_distance, row in zip(coordinates.distances(origin, rows), rows):
+                    heapq.heappush(heap, (row_distance, 1, ids[row]))
+            else:
+                for child in (tree.left[value], tree.right[value]):
+                    heapq.heappush(heap, (tree.box_distance(child, origin), 0, child))
+
+    def nearest(
+        self,
+        origin: Union[System, Point],
+        k: int,
+        max_distance: Optional[float] = None,
+    ) -> [tuple]:
+        """The k systems closest to origin as (distance, system id) tuples."""
+        return list(itertools.islice(self.iter_nearest(origin, max_distance), k))
+
+    def within(self, origin: Union[System, Point], radius: float) -> [tuple]:
+        """The systems within radius of origin as (distance, system id) tuples, closest first."""
+        return list(self.iter_nearest(origin, radius))
+
+
+def closest_ids(
+    queryset: QuerySet,
+    origin: Union[System, Point],
+    limit: int,
+    field: str = "id",
+    max_distance: Optional[float] = None,
+) -> [tuple]:
+    """
+    The primary keys of the limit rows of queryset that are closest to origin. The rows are matched to
+    systems by field, so a queryset of stations uses "system_id" and one of listings
+    "station__system_id". The index hands out the systems closest first, and they are looked up in
+    growing batches until enough rows passed the filters of queryset. When few rows pass them, the
+    rows beyond the first CLOSEST_INDEX_SYSTEMS systems are ordered by the database instead.
+    :return: (pk, distance) tuples, closest first.
+    """
+    found = []
+    systems = SystemIndex().iter_nearest(origin, max_distance)
+    batch_size = CLOSEST_BATCH_SIZE
+    searched, searched_distance = 0, 0.0
+    while len(found) < limit:
+        if searched >= CLOSEST_INDEX_SYSTEMS:
+            path = f"{field[:-3]}__" if field.endswith("_id") else ""
+            found.extend(
+                annotate_distance(queryset, origin, max_distance, field=path)
+                # Systems at the distance of the last one may not have been searched yet. The rows of
+                # those that were are in found.
+                .filter(distance__gte=searched_distance)
+                .exclude(pk__in=[pk for pk, _ in found])
+                .order_by("distance", "pk")
+                .values_list("pk", "distance")[: limit - len(found)]
+            )
+            break
+        distances = dict(
+            (system_id, distance)
+            for distance, system_id in itertools.islice(systems, batch_size)
+        )
+        if not distances:
+            break
+        searched += len(distances)
+        searched_distance = max(distances.values())
+        rows = queryset.filter(**{f"{field}__in": list(distances)}).values_list(
+            "pk", field
+        )
+        found.extend(
+            sorted(
+                ((pk, distances[system_id]) for pk, system_id in rows),
+                key=operator.itemgetter(1, 0),
+            )
+        )
+        batch_size *= 2
+    return found[:limit]
+
+
+def closest(
+    queryset: QuerySet,
+    origin: Union[System, Point],
+    limit: int,
+    field: str = "id",
+    max_distance: Optional[float] = None,
+) -> [tuple]:
+    """
+    Like closest_ids(), but loads the rows.
+    :return: (row, distance) tuples, closest first.
+    """
+    return DistanceOrderedRows(
+        queryset, closest_ids(queryset, origin, limit, field, max_distance)
+    ).pairs()
+
+
+class DistanceOrderedRows(collections.abc.Sequence):
+    """
+    The rows of queryset in the order of (pk, distance) pairs, with their distance set on them.
+    Rows are only loaded when they are read, so a paginator loads a single page.
+    """
+
+    def __init__(self, queryset: QuerySet, distances: [tuple]):
+        self.queryset = queryset
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.distances)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [row for row, _ in self.pairs(self.distances[index])]
+        return self[index : index + 1 or None][0]
+
+    def pairs(self, distances: Optional[list] = None) -> [tuple]:
+        """Load the rows of distances, or of all pairs, as (row, distance) tuples."""
+        distances = self.distances if distances is None else distances
+        rows = self.queryset.in_bulk([pk for pk, _ in distances])
+        pairs = []
+        for pk, distance in distances:
+            row = rows.get(pk)
+            if row is not None:
+                row.distance = distance
+                pairs.append((row, distance))
+        return pairs
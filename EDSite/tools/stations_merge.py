@@ -0,0 +1,253 @@
+from dataclasses import dataclass
+from typing import Iterable, Sequence
+
+from django.db import connection, transaction
+
+from EDSite.helpers import chunks
+from EDSite.models import LiveListing, Station, System
+from EDSite.tools.bulk import insert_rows
+
+STATION_STAGING_TABLE = "edsite_station_staging"
+
+# Columns of the rows that are fed to StationsStaging.load(). Same order as TradeDangerous' Station.
+STATION_STAGING_COLUMNS = (
+    "tradedangerous_id",
+    "name",
+    "system_tradedangerous_id",
+    "ls_from_star",
+    "black_market",
+    "pad_size",
+    "market",
+    "shipyard",
+    "modified",
+    "outfitting",
+    "rearm",
+    "refuel",
+    "repair",
+    "planetary",
+    "type_id",
+)
+TD_FLEET_TYPE_ID = 24
+TD_ODYSSEY_TYPE_ID = 25
+DELETE_BATCH_SIZE = 10000
+
+# Station columns and the expression that computes them from a staging row s.
+STATION_VALUES = (
+    ("name", "s.name"),
+    ("ls_from_star", "s.ls_from_star"),
+    ("pad_size", "s.pad_size"),
+    ("modified", "s.modified AT TIME ZONE 'UTC'"),
+    ("market", "s.market = 'Y'"),
+    ("black_market", "s.black_market = 'Y'"),
+    ("shipyard", "s.shipyard = 'Y'"),
+    ("outfitting", "s.outfitting = 'Y'"),
+    ("rearm", "s.rearm = 'Y'"),
+    ("refuel", "s.refuel = 'Y'"),
+    ("repair", "s.repair = 'Y'"),
+    ("planetary", "s.planetary = 'Y'"),
+    ("fleet", f"s.type_id = {TD_FLEET_TYPE_ID}"),
+    ("odyssey", f"s.type_id = {TD_ODYSSEY_TYPE_ID}"),
+    ("system_id", "s.system_id"),
+)
+
+
+@dataclass
+class StationMergeResult:
+    staged: int = 0
+    unknown: int = 0
+    renamed: int = 0
+    updated: int = 0
+    created: int = 0
+    deleted: int = 0
+
+    def __str__(self):
+        return (
+            f"staged={self.staged}, unknown={self.unknown}, new={self.created}, up={self.updated}, "
+            f"renamed={self.renamed}, del={self.deleted}"
+        )
+
+
+class StationsStaging:
+    """
+    Synchronises Station with TradeDangerous' Station table with a handful of set-based statements.
+    The TradeDangerous rows are copied into a temporary staging table, after which renamed carriers
+    are relinked, changed stations are updated, new stations are inserted and stale ones deleted.
+    """
+
+    def __init__(self):
+        quote = connection.ops.quote_name
+        self.staging = quote(STATION_STAGING_TABLE)
+        self.station = quote(Station._meta.db_table)
+        self.system = quote(System._meta.db_table)
+        self.live = quote(LiveListing._meta.db_table)
+        self.created = False
+
+    def create(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                CREATE TEMPORARY TABLE IF NOT EXISTS {self.staging} (
+                    tradedangerous_id integer NOT NULL,
+                    name varchar(100) NULL,
+                    system_tradedangerous_id integer NOT NULL,
+                    ls_from_star integer NOT NULL,
+                    black_market varchar(1) NOT NULL,
+                    pad_size varchar(1) NOT NULL,
+                    market varchar(1) NOT NULL,
+                    shipyard varchar(1) NOT NULL,
+                    modified timestamp NULL,
+                    outfitting varchar(1) NOT NULL,
+                    rearm varchar(1) NOT NULL,
+                    refuel varchar(1) NOT NULL,
+                    repair varchar(1) NOT NULL,
+                    planetary varchar(1) NOT NULL,
+                    type_id integer NOT NULL,
+                    system_id bigint NULL
+                )
+                """
+            )
+        self.created = True
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.staging}")
+        self.created = False
+
+    def load(self, rows: Iterable[Sequence]) -> StationMergeResult:
+        """Replace the content of the staging table with rows and resolve the systems."""
+        if not self.created:
+            self.create()
+        result = StationMergeResult()
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.staging}")
+        result.staged = insert_rows(
+            STATION_STAGING_TABLE, STATION_STAGING_COLUMNS, rows
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {self.staging} s SET system_id = sy.id
+                FROM {self.system} sy
+                WHERE sy.tradedangerous_id = s.system_tradedangerous_id
+                """
+            )
+            result.unknown = result.staged - cursor.rowcount
+            if connection.vendor == "postgresql":
+                cursor.execute(f"ANALYZE {self.staging}")
+        return result
+
+    def rename_carriers(self) -> int:
+        """
+        A carrier that shows up with a new TradeDangerous id takes over the older carrier with the same
+        name, together with its listings. Only the newest row of a carrier name is considered.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH renamed AS (
+                    UPDATE {self.station} st SET tradedangerous_id = r.tradedangerous_id
+                    FROM (
+                        SELECT DISTINCT ON (c.tradedangerous_id) c.tradedangerous_id, st.id
+                        FROM (
+                            SELECT DISTINCT ON (name) * FROM {self.staging}
+                            WHERE type_id = {TD_FLEET_TYPE_ID}
+                            ORDER BY name, modified DESC NULLS LAST
+                        ) c
+                        JOIN {self.station} st ON st.fleet AND st.name = c.name
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM {self.station} o WHERE o.tradedangerous_id = c.tradedangerous_id
+                        )
+                          AND (st.modified IS NULL OR st.modified < c.modified AT TIME ZONE 'UTC')
+                        ORDER BY c.tradedangerous_id, st.modified DESC NULLS LAST
+                    ) r
+                    WHERE st.id = r.id
+                    RETURNING st.id, r.tradedangerous_id
+                ), moved AS (
+                    UPDATE {self.live} l SET station_tradedangerous_id = renamed.tradedangerous_id
+                    FROM renamed
+                    WHERE l.station_id = renamed.id
+                )
+                SELECT count(*) FROM renamed
+                """
+            )
+            return cursor.fetchone()[0]
+
+    def update(self) -> int:
+        """Overwrite the stations that changed since they were last synchronised."""
+        updates = ", ".join(f"{column} = {value}" for column, value in STATION_VALUES)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {self.station} st SET {updates}
+                FROM {self.staging} s
+                WHERE st.tradedangerous_id = s.tradedangerous_id
+                  AND s.system_id IS NOT NULL AND s.name IS NOT NULL
+                  AND (st.modified IS NULL OR st.modified < s.modified AT TIME ZONE 'UTC')
+                """
+            )
+            return cursor.rowcount
+
+    def insert(self) -> int:
+        """
+        Insert the staged stations that do not exist yet. Of the carriers that share a name only the
+        newest one is inserted, and none if a carrier with that name already exists.
+        """
+        columns = ", ".join(column for column, _ in STATION_VALUES)
+        values = ", ".join(value for _, value in STATION_VALUES)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {self.station} ({columns}, tradedangerous_id)
+                SELECT {values}, s.tradedangerous_id
+                FROM (
+                    SELECT * FROM {self.staging} WHERE type_id <> {TD_FLEET_TYPE_ID}
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT DISTINCT ON (name) * FROM {self.staging}
+                        WHERE type_id = {TD_FLEET_TYPE_ID}
+                        ORDER BY name, modified DESC NULLS LAST
+                    ) c
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {self.station} o WHERE o.fleet AND o.name = c.name
+                    )
+                ) s
+                WHERE s.system_id IS NOT NULL AND s.name IS NOT NULL
+                  AND NOT EXISTS (
+                    SELECT 1 FROM {self.station} o WHERE o.tradedangerous_id = s.tradedangerous_id
+                  )
+                """
+            )
+            return cursor.rowcount
+
+    def delete_stale(self) -> int:
+        """
+        Delete the stations that TradeDangerous no longer knows. Stations without a TradeDangerous id
+        come from the live listener or a galaxy dump, so those are kept.
+        The deletes cascade through django, one batch of stations at a time.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT st.id FROM {self.station} st
+                WHERE st.tradedangerous_id IS NOT NULL
+                  AND NOT EXISTS (
+                    SELECT 1 FROM {self.staging} s WHERE s.tradedangerous_id = st.tradedangerous_id
+                  )
+                """
+            )
+            stale_ids = [station_id for (station_id,) in cursor.fetchall()]
+        for chunk in chunks(stale_ids, DELETE_BATCH_SIZE):
+            Station.objects.filter(id__in=chunk).delete()
+        return len(stale_ids)
+
+    def sync(self, rows: Iterable[Sequence]) -> StationMergeResult:
+        """Stage the TradeDangerous stations and apply them in a single transaction."""
+        with transaction.atomic():
+            result = self.load(rows)
+            result.renamed = self.rename_carriers()
+            result.updated = self.update()
+            result.created = self.insert()
+            # An empty TradeDangerous database should not wipe all stations.
+            if result.staged:
+                result.deleted = self.delete_stale()
+        return result
@@ -0,0 +1,71 @@
+import sqlite3
+from typing import Optional, Sequence
+
+from tradedangerous import tradedb
+from tradedangerous.tradeenv import TradeEnv
+
+# Bytes of TradeDangerous' database that sqlite may memory map instead of reading through its page cache.
+TD_MMAP_SIZE = 1 << 30
+# Page cache per connection, in KiB (negative values are KiB for sqlite).
+TD_CACHE_SIZE = -64 * 1024
+
+
+def open_td_database(filename: str) -> sqlite3.Connection:
+    """
+    Open TradeDangerous' database read-only. The database is memory mapped and temporary b-trees
+    stay in memory, so large scans do not go through the page cache or touch the disk.
+    """
+    conn = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute(f"PRAGMA mmap_size={TD_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size={TD_CACHE_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class TradeDBSession:
+    """
+    A TradeDangerous database that is loaded once and shared by all stages of an import run.
+    The TradeDB is only loaded when it is first used, and it reuses the read-only connection it is given
+    for its own queries.
+
+        with TradeDBSession() as session:
+            for row in session.execute("SELECT ... FROM Station"):
+                ...
+            session.tdb.items()
+    """
+
+    def __init__(self, tdenv: Optional[TradeEnv] = None):
+        self.tdenv = tdenv
+        self._tdb: Optional[tradedb.TradeDB] = None
+
+    @property
+    def tdb(self) -> tradedb.TradeDB:
+        if self._tdb is None:
+            tdb = tradedb.TradeDB(self.tdenv, load=False)
+            # Rebuilding a stale cache writes to the database, so it happens before going read-only.
+            tdb.reloadCache()
+            tdb.conn = open_td_database(tdb.dbFilename)
+            tdb.conn.create_function("dist2", 6, tradedb.TradeDB.calculateDistance2)
+            tdb.load(maxSystemLinkLy=tdb.tdenv.maxSystemLinkLy)
+            self._tdb = tdb
+        return self._tdb
+
+    @property
+    def filename(self) -> str:
+        return self.tdb.dbFilename
+
+    def execute(self, sql: str, params: Sequence = ()) -> sqlite3.Cursor:
+        """Run a query on the session's connection. Iterate the cursor to stream the rows."""
+        return self.tdb.conn.execute(sql, params)
+
+    def close(self):
+        if self._tdb is not None:
+            self._tdb.close()
+            self._tdb = None
+
+    def __enter__(self) -> "TradeDBSession":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
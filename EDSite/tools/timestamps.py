@@ -0,0 +1,59 @@
+import datetime
+import re
+import time
+from functools import lru_cache
+from typing import Iterable, Optional
+
+TD_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+TIMESTAMP_CACHE_SIZE = 1 << 16
+UTC = datetime.timezone.utc
+# What may follow the seconds: a fraction, then nothing, 'Z' or an offset such as '+02', '+0200' or '+02:00'.
+TIMESTAMP_SUFFIX = re.compile(r"(?:\.\d+)?(?:Z|([+-])(\d\d)(?::?(\d\d))?)?")
+
+
+def _parse(value: str) -> datetime.datetime:
+    """
+    Parse the fixed-width 'YYYY-MM-DD HH:MM:SS' prefix of a timestamp, and convert it to UTC by the
+    offset that follows. This covers the ISO 8601 variants of EDDN and the dumps ('T', fractions,
+    'Z' or '+00'). Fractions of a second are dropped.
+    :raises ValueError: When value is not a timestamp.
+    """
+    moment = datetime.datetime.fromisoformat(value[:19])
+    if len(value) == 19:
+        return moment.replace(tzinfo=UTC)
+    suffix = TIMESTAMP_SUFFIX.fullmatch(value, 19)
+    if suffix is None:
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    sign, hours, minutes = suffix.groups()
+    if sign:
+        offset = datetime.timedelta(hours=int(hours), minutes=int(minutes or 0))
+        moment = moment - offset if sign == "+" else moment + offset
+    return moment.replace(tzinfo=UTC)
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(value: str) -> datetime.datetime:
+    """
+    Parse a single timestamp into an aware UTC datetime. Listings of the same market share their
+    timestamp, so the results are memoised.
+    :raises ValueError: When value is not a timestamp.
+    """
+    return _parse(value)
+
+
+def parse_timestamps(
+    values: Iterable[Optional[str]],
+) -> [Optional[datetime.datetime]]:
+    """
+    Parse a column of timestamps. The values are still parsed one by one, but every distinct value
+    only once, as the listings of a market share their timestamp. Empty values become None.
+    """
+    values = list(values)
+    parsed = {value: _parse(value) if value else None for value in set(values)}
+    return list(map(parsed.__getitem__, values))
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def format_timestamp(epoch: int) -> str:
+    """Format a unix timestamp the way TradeDangerous stores it."""
+    return time.strftime(TD_TIMESTAMP_FORMAT, time.gmtime(epoch))
@@ -0,0 +1,796 @@
+import heapq
+import itertools
+import math
+import multiprocessing
+import operator
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Iterable, Optional, Union
+
+from django import db
+from django.core.cache import cache
+from django.db.models import Q, QuerySet
+
+from EDSite.helpers import SingletonMeta
+from EDSite.models import LiveListing, Station, System
+from EDSite.tools.jump_graph import JumpGraphs
+from EDSite.tools.spatial import Point, SystemIndex
+
+# Markets that were loaded longer ago than this are loaded again. Imports and the live listener
+# invalidate what they write in this process, this catches the writes of other processes.
+MARKET_SECONDS = 300
+# Most markets that are kept in memory. The least recently used ones are dropped first.
+MARKET_CACHE_STATIONS = 20000
+# Markets are loaded with one query per this many stations.
+MARKET_BATCH_SIZE = 2000
+# Largest search radius of the trade routes page, in ly.
+MAX_SEARCH_RADIUS = 60
+# Pairs of stations closer than this are ranked as if they were this far apart by profit per ly.
+MIN_ROUTE_DISTANCE = 1.0
+
+# Neighbourhoods of up to this many stations are scanned station by station for the best legs.
+LEG_SCAN_STATIONS = 256
+# Longest trade loop.
+MAX_LOOP_HOPS = 5
+# Paths that the loop planner keeps after every hop.
+LOOP_BEAM_WIDTH = 256
+# Legs from every station that the loop planner tries.
+LOOP_BRANCHING = 16
+# Processes that look up the best legs of the stations of the loop planner. Web requests plan in
+# their own thread, as forking the server with its listener and scheduler threads is not safe.
+# Management commands and benchmarks, which run without those threads, may pass more workers.
+LOOP_WORKERS = 1
+# Fewer stations than this are looked up in the planning process itself.
+LOOP_PARALLEL_STATIONS = 64
+# Planned loops are cached for this many seconds.
+LOOP_CACHE_SECONDS = 120
+
+ORDER_PROFIT = "profit"
+ORDER_PROFIT_PER_LY = "profit_per_ly"
+
+
+class StationMarket:
+    """
+    The listings of one station as price vectors: parallel arrays of the commodities a station
+    supplies, with their prices and units, and the same for the commodities it demands.
+    """
+
+    __slots__ = (
+        "loaded",
+        "supply_commodities",
+        "supply_prices",
+        "supply_units",
+        "demand_commodities",
+        "demand_prices",
+        "demand_units",
+    )
+
+    def __init__(self):
+        self.loaded = time.monotonic()
+        self.supply_commodities = array("l")
+        self.supply_prices = array("l")
+        self.supply_units = array("l")
+        self.demand_commodities = array("l")
+        self.demand_prices = array("l")
+        self.demand_units = array("l")
+
+    def add(
+        self,
+        commodity_id: int,
+        supply_price: int,
+        supply_units: int,
+        demand_price: int,
+        demand_units: int,
+    ):
+        if supply_units > 0 and supply_price > 0:
+            self.supply_commodities.append(commodity_id)
+            self.supply_prices.append(supply_price)
+            self.supply_units.append(supply_units)
+        if demand_units > 0 and demand_price > 0:
+            self.demand_commodities.append(commodity_id)
+            self.demand_prices.append(demand_price)
+            self.demand_units.append(demand_units)
+
+
+class StationMarkets(metaclass=SingletonMeta):
+    """
+    Cache of the price vectors of station markets, so route searches do not query the listings of
+    every station they look at. Markets are loaded in bulk on first use and expire after
+    MARKET_SECONDS.
+
+        markets = StationMarkets().get([station.id for station in stations])
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.markets: OrderedDict[int, StationMarket] = OrderedDict()
+
+    def __len__(self):
+        return len(self.markets)
+
+    def get(self, station_ids: Iterable[int]) -> {int: StationMarket}:
+        """The markets of station_ids. Stations without listings get an empty market."""
+        found, missing = {}, []
+        expired = time.monotonic() - MARKET_SECONDS
+        with self.lock:
+            for station_id in station_ids:
+                market = self.markets.get(station_id)
+                if market is None or market.loaded < expired:
+                    missing.append(station_id)
+                else:
+                    self.markets.move_to_end(station_id)
+                    found[station_id] = market
+        for start in range(0, len(missing), MARKET_BATCH_SIZE):
+            batch = missing[start : start + MARKET_BATCH_SIZE]
+            loaded = {station_id: StationMarket() for station_id in batch}
+            for station_id, *listing in (
+                LiveListing.objects.filter(station_id__in=batch)
+                .order_by()
+                .values_list(
+                    "station_id",
+                    "commodity_id",
+                    "supply_price",
+                    "supply_units",
+                    "demand_price",
+                    "demand_units",
+                )
+                .iterator()
+            ):
+                loaded[station_id].add(*listing)
+            found.update(loaded)
+            with self.lock:
+                self.markets.update(loaded)
+                while len(self.markets) > MARKET_CACHE_STATIONS:
+                    self.markets.popitem(last=False)
+        return found
+
+    def invalidate(self, station_ids: Optional[Iterable[int]] = None):
+        """Drop the markets of station_ids, or all of them, so they are loaded again on their next use."""
+        with self.lock:
+            if station_ids is None:
+                self.markets.clear()
+            else:
+                for station_id in station_ids:
+                    self.markets.pop(station_id, None)
+
+
+@dataclass
+class TradeRoute:
+    source_id: int
+    destination_id: int
+    commodity_id: int
+    buy_price: int
+    sell_price: int
+    units: int
+    distance: float
+    score: float
+
+    @property
+    def profit(self) -> int:
+        return (self.sell_price - self.buy_price) * self.units
+
+    @property
+    def unit_profit(self) -> int:
+        return self.sell_price - self.buy_price
+
+    @property
+    def profit_per_ly(self) -> float:
+        return self.profit / max(self.distance, MIN_ROUTE_DISTANCE)
+
+
+class TopRoutes:
+    """
+    The limit best routes with at most one route per pair of stations.
+    A min-heap holds the scores of the kept routes. Entries of routes that were replaced by a better
+    route for the same pair stay in the heap, and are skipped when they come up.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.routes: {tuple: TradeRoute} = {}
+        self.heap = []
+
+    def _clean(self):
+        heap, routes = self.heap, self.routes
+        while heap:
+            score, source_id, destination_id = heap[0]
+            route = routes.get((source_id, destination_id))
+            if route is not None and route.score == score:
+                return
+            heapq.heappop(heap)
+
+    @property
+    def threshold(self) -> float:
+        """The score a route must beat to be kept."""
+        if len(self.routes) < self.limit:
+            return 0
+        self._clean()
+        return self.heap[0][0]
+
+    def offer(self, route: TradeRoute):
+        pair = (route.source_id, route.destination_id)
+        kept = self.routes.get(pair)
+        if kept is not None:
+            if route.score <= kept.score:
+                return
+        elif len(self.routes) >= self.limit:
+            if route.score <= self.threshold:
+                return
+            _, source_id, destination_id = heapq.heappop(self.heap)
+            del self.routes[source_id, destination_id]
+        self.routes[pair] = route
+        heapq.heappush(self.heap, (route.score, *pair))
+
+    def sorted(self) -> [TradeRoute]:
+        return sorted(
+            self.routes.values(),
+            key=lambda route: (-route.score, route.source_id, route.destination_id),
+        )
+
+
+def filter_stations(
+    queryset: QuerySet,
+    landing_pad_size: str = "S",
+    include_fleet_carriers=False,
+    include_planetary=False,
+    include_odyssey=True,
+) -> QuerySet:
+    """Stations that a ship with landing_pad_size can dock at, like the filters of the stations page."""
+    if not include_planetary:
+        queryset = queryset.filter(Q(planetary=0))
+    if not include_fleet_carriers:
+        queryset = queryset.filter(Q(fleet=0))
+    if not include_odyssey:
+        queryset = queryset.filter(Q(odyssey=0))
+    if landing_pad_size == "M":
+        queryset = queryset.exclude(Q(pad_size="S"))
+    elif landing_pad_size == "L":
+        queryset = queryset.filter(Q(pad_size="L"))
+    return queryset
+
+
+class RouteSearch:
+    """
+    The markets of the stations within a radius, grouped by commodity for the route searches of
+    find_trade_routes().
+    """
+
+    def __init__(
+        self,
+        origin: Union[System, Point],
+        radius: float,
+        capacity: int,
+        budget: Optional[int],
+        stations: QuerySet,
+        max_distance: Optional[float] = None,
+    ):
+        self.index = SystemIndex()
+        system_ids = [system_id for _, system_id in self.index.within(origin, radius)]
+        # All stations are within radius of the origin, so no two are further apart than twice the
+        # radius.
+        self.max_distance = radius * 2
+        if max_distance is not None:
+            self.max_distance = min(self.max_distance, max_distance)
+        self.station_systems = dict(
+            stations.filter(system_id__in=system_ids)
+            .order_by()
+            .values_list("id", "system_id")
+        )
+        self.system_stations = {}
+        for station_id, system_id in self.station_systems.items():
+            self.system_stations.setdefault(system_id, []).append(station_id)
+        self.positions = self.index.positions(self.system_stations)
+        markets = StationMarkets().get(self.station_systems)
+        self.capacity, self.budget = capacity, budget
+        # Per commodity: (price, units, station id) of the supplies, cheapest first, and of the
+        # demands, best price first.
+        self.supplies, self.demands = defaultdict(list), defaultdict(list)
+        for station_id, market in markets.items():
+            station = itertools.repeat(station_id)
+            for commodity_id, supply in zip(
+                market.supply_commodities,
+                zip(market.supply_prices, market.supply_units, station),
+            ):
+                self.supplies[commodity_id].append(supply)
+            for commodity_id, demand in zip(
+                market.demand_commodities,
+                zip(market.demand_prices, market.demand_units, station),
+            ):
+                self.demands[commodity_id].append(demand)
+        for supplies in self.supplies.values():
+            supplies.sort()
+        for demands in self.demands.values():
+            demands.sort(reverse=True)
+        self.graph = JumpGraphs().covering(self.max_distance)
+        self.neighbour_cache: {int: [tuple]} = {}
+        self.legs: {int: [TradeRoute]} = {}
+
+    def load(self, price: int, units: int) -> int:
+        """The units of a supply that fit the cargo hold and the budget."""
+        units = min(self.capacity, units)
+        if self.budget is not None:
+            units = min(units, self.budget // price)
+        return units
+
+    def distance(self, source_id: int, destination_id: int) -> float:
+        return math.dist(
+            self.positions[self.station_systems[source_id]],
+            self.positions[self.station_systems[destination_id]],
+        )
+
+    @cached_property
+    def station_loads(self) -> {int: [tuple]}:
+        """
+        Per station: (commodity id, units, price) of the loads that some station pays more for, with
+        the most profitable load first.
+        """
+        station_loads = defaultdict(list)
+        for commodity_id, supplies in self.supplies.items():
+            demands = self.demands.get(commodity_id)
+            if not demands:
+                continue
+            best_price = demands[0][0]
+            for buy_price, supply_units, source_id in supplies:
+                if buy_price >= best_price:
+                    break
+                units = self.load(buy_price, supply_units)
+                if units > 0:
+                    station_loads[source_id].append(
+                        (
+                            units * (best_price - buy_price),
+                            commodity_id,
+                            units,
+                            buy_price,
+                        )
+                    )
+        for station_id, loads in station_loads.items():
+            loads.sort(reverse=True)
+            station_loads[station_id] = [load[1:] for load in loads]
+        return station_loads
+
+    @cached_property
+    def best_profits(self) -> {int: int}:
+        """Per station: the most a load from it can make, sold at the best price of all stations."""
+        best_profits = {}
+        for station_id, loads in self.station_loads.items():
+            commodity_id, units, buy_price = loads[0]
+            best_profits[station_id] = units * (
+                self.demands[commodity_id][0][0] - buy_price
+            )
+        return best_profits
+
+    @cached_property
+    def station_demands(self) -> {int: {int: tuple}}:
+        """Per station: (price, units) of every commodity it demands, by commodity id."""
+        station_demands = defaultdict(dict)
+        for commodity_id, demands in self.demands.items():
+            for price, units, station_id in demands:
+                station_demands[station_id][commodity_id] = (price, units)
+        return station_demands
+
+    def nearby_systems(self, system_id: int) -> [tuple]:
+        """
+        The systems within max_distance of system_id, itself included, as (distance, system id)
+        tuples, closest first. When a jump graph of at least max_distance was built, its neighbours
+        of system_id are the candidates and only those with stations are kept.
+        """
+        position = self.positions[system_id]
+        candidates = self.graph.neighbours(system_id) if self.graph else None
+        if candidates is None:
+            return list(self.index.iter_nearest(position, self.max_distance))
+        nearby = [(0.0, system_id)]
+        for _, other_system_id in candidates:
+            other_position = self.positions.get(other_system_id)
+            if other_position is not None:
+                distance = math.dist(position, other_position)
+                if distance <= self.max_distance:
+                    nearby.append((distance, other_system_id))
+        nearby.sort()
+        return nearby
+
+    def neighbours(self, station_id: int) -> [tuple]:
+        """The stations within max_distance of station_id as (distance, station id), closest first."""
+        system_id = self.station_systems[station_id]
+        neighbours = self.neighbour_cache.get(system_id)
+        if neighbours is None:
+            neighbours = self.neighbour_cache[system_id] = [
+                (distance, other_id)
+                for distance, other_system_id in self.nearby_systems(system_id)
+                for other_id in self.system_stations.get(other_system_id, ())
+            ]
+        return neighbours
+
+    def leg(
+        self, source_id: int, destination_id: int, distance: float
+    ) -> Optional[TradeRoute]:
+        """The most profitable load from source_id to destination_id, scored by its profit."""
+        prices = self.station_demands.get(destination_id, {})
+        best = None
+        for commodity_id, units, buy_price in self.station_loads.get(source_id, ()):
+            sell_price, demand_units = prices.get(commodity_id, (0, 0))
+            if sell_price <= buy_price:
+                continue
+            units = min(units, demand_units)
+            profit = units * (sell_price - buy_price)
+            if best is None or profit > best.score:
+                best = TradeRoute(
+                    source_id,
+                    destination_id,
+                    commodity_id,
+                    buy_price,
+                    sell_price,
+                    units,
+                    distance,
+                    profit,
+                )
+        return best
+
+    def best_legs(self, source_id: int, limit: int) -> [TradeRoute]:
+        """
+        The limit most profitable legs from source_id to the stations within max_distance, best first.
+        A small neighbourhood is scanned station by station. In a large one the demands of every
+        load are walked from the best price down, like by_profit() does.
+        """
+        legs = self.legs.get(source_id)
+        if legs is not None:
+            return legs
+        top = TopRoutes(limit)
+        neighbours = self.neighbours(source_id)
+        if len(neighbours) <= LEG_SCAN_STATIONS:
+            for distance, destination_id in neighbours:
+                if destination_id != source_id:
+                    leg = self.leg(source_id, destination_id, distance)
+                    if leg is not None:
+                        top.offer(leg)
+        else:
+            threshold = 0
+            source = self.positions[self.station_systems[source_id]]
+            for commodity_id, units, buy_price in self.station_loads.get(source_id, ()):
+                for sell_price, demand_units, destination_id in self.demands[
+                    commodity_id
+                ]:
+                    if units * (sell_price - buy_price) <= threshold:
+                        break
+                    profit = min(units, demand_units) * (sell_price - buy_price)
+                    if profit <= threshold or destination_id == source_id:
+                        continue
+                    distance = math.dist(
+                        source, self.positions[self.station_systems[destination_id]]
+                    )
+                    if distance > self.max_distance:
+                        continue
+                    top.offer(
+                        TradeRoute(
+                            source_id,
+                            destination_id,
+                            commodity_id,
+                            buy_price,
+                            sell_price,
+                            min(units, demand_units),
+                            distance,
+                            profit,
+                        )
+                    )
+                    threshold = top.threshold
+        legs = self.legs[source_id] = top.sorted()
+        return legs
+
+    def by_profit(self, top: TopRoutes):
+        """
+        The supplies of a commodity are walked from the cheapest up. For every supply the demands are
+        walked from the best price down, until a full load at that price can not beat the worst route
+        in top anymore.
+        """
+        threshold = 0
+        for commodity_id, supplies in self.supplies.items():
+            demands = self.demands.get(commodity_id)
+            if not demands:
+                continue
+            best_price = demands[0][0]
+            for buy_price, supply_units, source_id in supplies:
+                if self.capacity * (best_price - buy_price) <= threshold:
+                    break
+                units = self.load(buy_price, supply_units)
+                if units <= 0 or units * (best_price - buy_price) <= threshold:
+                    continue
+                for sell_price, demand_units, destination_id in demands:
+                    if units * (sell_price - buy_price) <= threshold:
+                        break
+                    if destination_id == source_id:
+                        continue
+                    profit = min(units, demand_units) * (sell_price - buy_price)
+                    if profit <= threshold:
+                        continue
+                    distance = self.distance(source_id, destination_id)
+                    if distance > self.max_distance:
+                        continue
+                    top.offer(
+                        TradeRoute(
+                            source_id,
+                            destination_id,
+                            commodity_id,
+                            buy_price,
+                            sell_price,
+                            min(units, demand_units),
+                            distance,
+                            profit,
+                        )
+                    )
+                    threshold = top.threshold
+
+    def by_profit_per_ly(self, top: TopRoutes):
+        """
+        Sources are searched from the one with the most profitable load down. The destinations of a
+        source are walked closest first through the spatial index, until its most profitable load
+        over that distance can not beat the worst route in top anymore.
+        """
+        threshold = 0
+        for best_profit, source_id in sorted(
+            ((profit, source_id) for source_id, profit in self.best_profits.items()),
+            reverse=True,
+        ):
+            if best_profit / MIN_ROUTE_DISTANCE <= threshold:
+                break
+            source = self.positions[self.station_systems[source_id]]
+            # Further than best_profit / threshold no destination can make it into top.
+            max_distance = self.max_distance
+            if threshold:
+                max_distance = min(max_distance, best_profit / threshold)
+            for distance, system_id in self.index.iter_nearest(source, max_distance):
+                if best_profit / max(distance, MIN_ROUTE_DISTANCE) <= threshold:
+                    break
+                for destination_id in self.system_stations.get(system_id, ()):
+                    if destination_id == source_id:
+                        continue
+                    route = self.leg(source_id, destination_id, distance)
+                    if route is None:
+                        continue
+                    route.score = route.profit / max(distance, MIN_ROUTE_DISTANCE)
+                    if route.score > threshold:
+                        top.offer(route)
+                        threshold = top.threshold
+
+
+def find_trade_routes(
+    origin: Union[System, Point],
+    radius: float,
+    capacity: int,
+    budget: Optional[int] = None,
+    limit: int = 20,
+    order: str = ORDER_PROFIT,
+    stations: Optional[QuerySet] = None,
+    max_distance: Optional[float] = None,
+) -> [TradeRoute]:
+    """
+    The best single hop routes between the stations within radius of origin: for every pair of
+    stations the commodity with the highest profit for a load of capacity units, paid out of budget.
+    The stations come from the spatial index and their markets from StationMarkets, so a search
+    runs a query for the stations and none for cached markets. Both orders prune with an upper
+    bound on the score, so only a small part of the pairs is looked at.
+    :param order: ORDER_PROFIT or ORDER_PROFIT_PER_LY.
+    :param stations: The stations to consider, like from filter_stations(). All stations by default.
+    :param max_distance: The longest route in ly. Routes are only limited by radius by default.
+    """
+    if order not in (ORDER_PROFIT, ORDER_PROFIT_PER_LY):
+        raise ValueError(f"Unknown order {order!r}.")
+    search = RouteSearch(
+        origin,
+        radius,
+        capacity,
+        budget,
+        Station.objects.all() if stations is None else stations,
+        max_distance,
+    )
+    top = TopRoutes(limit)
+    if order == ORDER_PROFIT:
+        search.by_profit(top)
+    else:
+        search.by_profit_per_ly(top)
+    return top.sorted()
+
+
+@dataclass
+class TradeLoop:
+    """Routes that lead from station to station and back to the first one."""
+
+    routes: [TradeRoute]
+
+    @property
+    def profit(self) -> int:
+        return sum(route.profit for route in self.routes)
+
+    @property
+    def distance(self) -> float:
+        return sum(route.distance for route in self.routes)
+
+    @property
+    def profit_per_ly(self) -> float:
+        return self.profit / max(self.distance, MIN_ROUTE_DISTANCE)
+
+
+# The search of the current loop planner in a worker process.
+_worker_search: Optional[RouteSearch] = None
+
+
+def _init_loop_worker(search: RouteSearch):
+    global _worker_search
+    # Forked workers inherit the search instead of unpickling it.
+    _worker_search = search
+    # The workers must not use the connection of the planning process, which may be in the middle of
+    # a transaction. It is dropped without closing it, so it stays open for the planning process.
+    for connection in db.connections.all():
+        connection.connection = None
+
+
+def _best_legs(station_ids: [int], limit: int) -> {int: [TradeRoute]}:
+    return {
+        station_id: _worker_search.best_legs(station_id, limit)
+        for station_id in station_ids
+    }
+
+
+class LoopPlanner:
+    """
+    Beam search for trade loops over the markets of a RouteSearch. The beam starts with the most
+    profitable legs of the search, and every round extends each path with the best legs from its last
+    station, keeping the beam_width most profitable paths. The best legs of many stations are looked
+    up by a pool of forked worker processes, which share the markets of the search.
+    """
+
+    def __init__(self, search: RouteSearch, beam_width: int, workers: int):
+        self.search = search
+        self.beam_width = beam_width
+        self.workers = workers
+        self.pool: Optional[ProcessPoolExecutor] = None
+
+    def best_legs(self, station_ids: {int}) -> {int: [TradeRoute]}:
+        search = self.search
+        missing = [
+            station_id for station_id in station_ids if station_id not in search.legs
+        ]
+        if self.workers > 1 and len(missing) >= LOOP_PARALLEL_STATIONS:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=_init_loop_worker,
+                    initargs=(search,),
+                )
+            chunk_size = math.ceil(len(missing) / self.workers)
+            for legs in self.pool.map(
+                _best_legs,
+                [
+                    missing[start : start + chunk_size]
+                    for start in range(0, len(missing), chunk_size)
+                ],
+                itertools.repeat(LOOP_BRANCHING),
+            ):
+                search.legs.update(legs)
+        return {
+            station_id: search.best_legs(station_id, LOOP_BRANCHING)
+            for station_id in station_ids
+        }
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def plan(self, hops: int, limit: int) -> [TradeLoop]:
+        search = self.search
+        top = TopRoutes(self.beam_width)
+        search.by_profit(top)
+        # Paths as (profit, station ids, routes).
+        beam = [
+            (route.score, (route.source_id, route.destination_id), [route])
+            for route in top.sorted()
+        ]
+        for stations in range(2, hops):
+            legs = self.best_legs({path[-1] for _, path, _ in beam})
+            last = stations == hops - 1
+            paths = []
+            for profit, path, routes in beam:
+                for route in legs[path[-1]]:
+                    if route.destination_id in path:
+                        continue
+                    # The last station must be in range of the first one to close the loop.
+                    if (
+                        last
+                        and search.distance(route.destination_id, path[0])
+                        > search.max_distance
+                    ):
+                        continue
+                    paths.append(
+                        (
+                            profit + route.score,
+                            path + (route.destination_id,),
+                            routes + [route],
+                        )
+                    )
+            beam = heapq.nlargest(self.beam_width, paths, key=operator.itemgetter(0))
+        loops = {}
+        for profit, path, routes in beam:
+            distance = search.distance(path[-1], path[0])
+            if distance > search.max_distance:
+                continue
+            route = search.leg(path[-1], path[0], distance)
+            if route is None:
+                # The ship flies back empty.
+                route = TradeRoute(path[-1], path[0], None, 0, 0, 0, distance, 0)
+            loop = TradeLoop(routes + [route])
+            # The same loop entered at another station is the same loop.
+            start = path.index(min(path))
+            key = path[start:] + path[:start]
+            if key not in loops or loop.profit > loops[key].profit:
+                loops[key] = loop
+        return sorted(
+            loops.values(),
+            key=lambda loop: (-loop.profit, [route.source_id for route in loop.routes]),
+        )[:limit]
+
+
+def find_trade_loops(
+    origin: Union[System, Point],
+    radius: float,
+    hops: int,
+    capacity: int,
+    budget: Optional[int] = None,
+    max_distance: Optional[float] = None,
+    limit: int = 20,
+    stations: Optional[QuerySet] = None,
+    beam_width: int = LOOP_BEAM_WIDTH,
+    workers: int = LOOP_WORKERS,
+) -> [TradeLoop]:
+    """
+    The most profitable loops of hops routes between the stations within radius of origin, with no
+    route longer than max_distance. Every route carries the most profitable load for its two
+    stations, and the budget is not increased by the profit of the routes before it.
+    The search is a beam search, so it finds very good loops rather than guaranteeing the best one.
+    :param stations: The stations to consider, like from filter_stations(). All stations by default.
+    :param workers: Processes that look up the best legs of the stations in the beam.
+    """
+    if not 2 <= hops <= MAX_LOOP_HOPS:
+        raise ValueError(f"A loop has 2 to {MAX_LOOP_HOPS} hops, not {hops}.")
+    search = RouteSearch(
+        origin,
+        radius,
+        capacity,
+        budget,
+        Station.objects.all() if stations is None else stations,
+        max_distance,
+    )
+    planner = LoopPlanner(search, beam_width, workers)
+    try:
+        return planner.plan(hops, limit)
+    finally:
+        planner.close()
+
+
+def cached_trade_loops(
+    system: System, station_filters: dict, **parameters
+) -> [TradeLoop]:
+    """
+    find_trade_loops() from system, cached for LOOP_CACHE_SECONDS by the system and the parameters.
+    :param station_filters: The keyword arguments of filter_stations().
+    """
+    key = "trade_loops_{}_{}".format(
+        system.id,
+        "_".join(
+            f"{name}={value}"
+            for name, value in sorted((station_filters | parameters).items())
+        ),
+    )
+    loops = cache.get(key)
+    if loops is None:
+        loops = find_trade_loops(
+            system,
+            stations=filter_stations(Station.objects.all(), **station_filters),
+            **parameters,
+        )
+        cache.set(key, loops, timeout=LOOP_CACHE_SECONDS)
+    return loops
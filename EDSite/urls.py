@@ -29,11 +29,14 @@ urlpatterns = [
         views.debug_update_database,
         name="debug_update_database",
     ),
+    path("debug_jobs", views.debug_jobs, name="debug_jobs"),
+    path("debug_jobs/<int:job_id>", views.debug_job, name="debug_job"),
     path("signup", views.signup_view, name="signup"),
     path("login", views.login_view, name="login"),
     path("profile", views.profile_view, name="profile"),
     path("logout", views.logout_view, name="logout"),
     path("trade/trade-routes", views.trade_routes, name="trade-routes"),
+    path("trade/carrier-planner", views.carrier_planner, name="carrier-planner"),
     path("trade/carrier-missions", views.carrier_missions, name="carrier-missions"),
     path(
         "trade/carrier-missions/<str:tab>",
@@ -1,6 +1,5 @@
 import datetime
 import sys
-import threading
 import time
 from pprint import pprint
 
@@ -16,14 +15,43 @@ from django.shortcuts import render, redirect
 from django.views.decorators.csrf import csrf_exempt
 
 # import EDSite.ed_data
-from EDSite.tools.ed_data import EDData
+from EDSite.tools.carrier_routes import (
+    COST_FUEL,
+    COST_JUMPS,
+    MAX_CARRIER_JUMP,
+    plan_carrier_route,
+)
+from EDSite.tools.ed_data import EDData, database_update_job
+from EDSite.tools.jobs import JobScheduler
+from EDSite.tools.listing_index import (
+    DEMAND,
+    SUPPLY,
+    ListingIndex,
+    RankedRows,
+    RankWeights,
+)
+from EDSite.tools.spatial import (
+    DistanceOrderedRows,
+    SystemIndex,
+    annotate_distance,
+    closest,
+)
+from EDSite.tools.trade_routes import (
+    MAX_LOOP_HOPS,
+    MAX_SEARCH_RADIUS,
+    cached_trade_loops,
+    filter_stations,
+    find_trade_routes,
+)
 from EDSite.forms import (
     CommodityForm,
     SignupForm,
     LoginForm,
     CarrierMissionForm,
+    CarrierPlannerForm,
     SystemsForm,
     StationsForm,
+    TradeRoutesForm,
 )
 from EDSite.helpers import make_timezone_aware, list_to_columns
 from EDSite.models import (
@@ -97,20 +125,17 @@ def systems(request):
                 num_stations=Count("stations")
             ).filter(num_stations__gt=0)
 
-    filtered_systems = filtered_systems[:40]
     if ref_system:
         print("Reference: ", ref_system)
+        nearest = closest(filtered_systems, ref_system, 40)
+        filtered_systems = [other_system for other_system, _ in nearest]
         distances = {
-            other_system.id: int(other_system.distance_to(ref_system))
-            for other_system in filtered_systems
+            other_system.id: int(distance) for other_system, distance in nearest
         }
-        filtered_systems = sorted(
-            list(filtered_systems),
-            key=lambda filtered_system: distances[filtered_system.id],
-            reverse=False,
-        )
         context["reference_distances"] = distances
         context["reference_system"] = ref_system
+    else:
+        filtered_systems = filtered_systems[:40]
 
     context["systems"] = filtered_systems
     context["form"] = form
@@ -177,26 +202,26 @@ def stations(request):
         elif landing_pad_size == "L":
             filtered_stations = filtered_stations.filter(Q(pad_size="L"))
 
-    filtered_stations = filtered_stations[:40]
     if ref_system:
         filtered_stations = filtered_stations.select_related("system")
+        if isinstance(system_distance, int):
+            # Radius searches run in the database.
+            nearest = [
+                (other_station, other_station.distance)
+                for other_station in annotate_distance(
+                    filtered_stations, ref_system, system_distance, field="system__"
+                ).order_by("distance", "id")[:40]
+            ]
+        else:
+            nearest = closest(filtered_stations, ref_system, 40, field="system_id")
+        filtered_stations = [other_station for other_station, _ in nearest]
         distances = {
-            other_station.id: int(other_station.system.distance_to(ref_system))
-            for other_station in filtered_stations
+            other_station.id: int(distance) for other_station, distance in nearest
         }
-        filtered_stations = sorted(
-            list(filtered_stations),
-            key=lambda filtered_station: distances[filtered_station.id],
-            reverse=False,
-        )
-        if system_distance:
-            filtered_stations = filter(
-                lambda filtered_station: distances[filtered_station.id]
-                <= int(system_distance),
-                list(filtered_stations),
-            )
         context["reference_distances"] = distances
         context["reference_system"] = ref_system
+    else:
+        filtered_stations = filtered_stations[:40]
 
     context["stations"] = filtered_stations
     context["form"] = form
@@ -239,10 +264,13 @@ def commodity(request, commodity_id):
     context = {}
     ref_system = None
     ordering = "-demand_price"
+    # The listings in the order of the index, when they are ordered by distance or score.
+    ordered_rows = None
     if request.method == "GET":
         form = CommodityForm()
         form.fields["buy_or_sell"].initial = "sell"
         form.fields["landing_pad_size"].initial = "S"
+        form.fields["order_by"].initial = "price"
         filtered_listings = LiveListing.objects.filter(commodity_id=commodity_id)
     else:  # POST
         form = CommodityForm(request.POST)
@@ -251,10 +279,15 @@ def commodity(request, commodity_id):
             include_fleet_carriers = form.data.get("include_fleet_carriers") == "yes"
             include_planetary = form.data.get("include_planetary") == "yes"
             landing_pad_size = form.data.get("landing_pad_size")
-            minimum_units = (
-                form.data.get("minimum_units") if form.data.get("minimum_units") else 0
-            )
+            minimum_units = form.data.get("minimum_units", "")
+            minimum_units = int(minimum_units) if minimum_units.isdigit() else 0
             buy_or_sell = form.data.get("buy_or_sell")
+            order_by = form.data.get("order_by")
+            max_distance = form.data.get("max_distance")
+            try:
+                max_distance = float(max_distance) if max_distance else None
+            except ValueError:
+                max_distance = None
             ref_system_name_or_id = form.data.get("reference_system")
 
             if ref_system_name_or_id and ref_system_name_or_id.isdigit():
@@ -290,24 +323,88 @@ def commodity(request, commodity_id):
             elif landing_pad_size == "L":
                 filtered_listings = filtered_listings.filter(Q(station__pad_size="L"))
             ordering = "-demand_price" if buy_or_sell == "sell" else "supply_price"
+            if ref_system and order_by == "score":
+                weights = {}
+                for name in ("price", "units", "age", "distance"):
+                    weight = form.data.get(f"{name}_weight")
+                    try:
+                        weights[name] = float(weight)
+                    except (TypeError, ValueError):
+                        pass
+                try:
+                    weights = RankWeights(**weights)
+                except ValueError:
+                    weights = RankWeights()
+                ordered_rows = RankedRows(
+                    LiveListing.objects.select_related("station__system"),
+                    ListingIndex().rank(
+                        ref_system,
+                        commodity_id,
+                        DEMAND if buy_or_sell == "sell" else SUPPLY,
+                        limit=40,
+                        weights=weights,
+                        min_units=minimum_units + 1,
+                        pad_size=landing_pad_size or "S",
+                        max_distance=max_distance,
+                        include_planetary=include_planetary,
+                        include_fleet_carriers=include_fleet_carriers,
+                        include_odyssey=include_odyssey,
+                    ),
+                )
+            elif ref_system and order_by == "distance":
+                nearest = ListingIndex().nearest(
+                    ref_system,
+                    commodity_id,
+                    DEMAND if buy_or_sell == "sell" else SUPPLY,
+                    limit=40,
+                    min_units=minimum_units + 1,
+                    pad_size=landing_pad_size or "S",
+                    max_distance=max_distance,
+                    include_planetary=include_planetary,
+                    include_fleet_carriers=include_fleet_carriers,
+                    include_odyssey=include_odyssey,
+                )
+                ordered_rows = DistanceOrderedRows(
+                    LiveListing.objects.select_related("station__system"), nearest
+                )
+            elif ref_system and max_distance is not None:
+                filtered_listings = annotate_distance(
+                    filtered_listings,
+                    ref_system,
+                    max_distance,
+                    field="station__system__",
+                )
         else:
             print("Commodity mission form was not valid:", form.errors)
 
-    filtered_listings = filtered_listings.order_by(
-        ordering
-    )  # TODO: Performance. This makes it slow.
-    filtered_listings = filtered_listings[:40]
-    if ref_system:
-        filtered_listings = filtered_listings.select_related("station__system")
-        distances = {
-            listing.id: int(listing.station.system.distance_to(ref_system))
-            for listing in filtered_listings
+    if ordered_rows is not None:
+        pairs = ordered_rows.pairs()
+        filtered_listings = [listing for listing, _ in pairs]
+        context["reference_distances"] = {
+            listing.id: int(distance) for listing, distance in pairs
         }
-        # filtered_listings = sorted(list(filtered_listings), key=lambda filtered_system: distances[filtered_system.id], reverse=False)
-        context["reference_distances"] = distances
+        if isinstance(ordered_rows, RankedRows):
+            context["scores"] = {
+                listing.id: round(listing.score, 3) for listing in filtered_listings
+            }
         context["reference_system"] = ref_system
     else:
+        filtered_listings = filtered_listings.order_by(
+            ordering
+        )  # TODO: Performance. This makes it slow.
+        filtered_listings = filtered_listings[:40]
         filtered_listings = filtered_listings.select_related("station__system")
+        if ref_system:
+            system_distances = SystemIndex().distances(
+                ref_system, [listing.station.system_id for listing in filtered_listings]
+            )
+            distances = {
+                listing.id: int(system_distances[listing.station.system_id])
+                for listing in filtered_listings
+            }
+            # filtered_listings = sorted(list(filtered_listings), key=lambda filtered_system: distances[filtered_system.id], reverse=False)
+            context["reference_distances"] = distances
+            context["reference_system"] = ref_system
 
     context["commodity"] = commodity
     context["listings"] = list(filtered_listings)
@@ -325,7 +422,57 @@ def rares(request):
 
 
 def carrier_planner(request):
-    return redirect("index")
+    context = {}
+    route = None
+    if request.method == "GET":
+        form = CarrierPlannerForm()
+    else:
+        form = CarrierPlannerForm(request.POST)
+        jump_range = form.data.get("jump_range")
+        cargo = form.data.get("cargo")
+        jump_range = (
+            min(int(jump_range), MAX_CARRIER_JUMP)
+            if jump_range and jump_range.isdigit() and int(jump_range) > 0
+            else MAX_CARRIER_JUMP
+        )
+        cargo = int(cargo) if cargo and cargo.isdigit() else 0
+        cost = COST_FUEL if form.data.get("minimise") == COST_FUEL else COST_JUMPS
+
+        systems = []
+        for field in ("start_system", "destination_system"):
+            name_or_id = form.data.get(field)
+            system = None
+            if name_or_id and name_or_id.isdigit():
+                system = System.objects.filter(pk=int(name_or_id)).first()
+            elif name_or_id:
+                system = (
+                    System.objects.filter(name__icontains=name_or_id)
+                    .order_by("id")
+                    .first()
+                )
+            systems.append(system)
+        start_system, destination_system = systems
+
+        if start_system and destination_system:
+            t0 = time.perf_counter()
+            route = plan_carrier_route(
+                start_system, destination_system, jump_range, cargo, cost
+            )
+            context["search_seconds"] = time.perf_counter() - t0
+            if route:
+                jump_systems = System.objects.in_bulk(
+                    [jump.system_id for jump in route.jumps]
+                )
+                for jump in route.jumps:
+                    jump.system = jump_systems[jump.system_id]
+        context["start_system"] = start_system
+        context["destination_system"] = destination_system
+
+    context["route"] = route
+    context["form"] = form
+    return render(
+        request, "EDSite/trade/carrier_planner.html", base_context(request) | context
+    )
 
 
 def carrier_missions(request, tab=None):
@@ -335,9 +482,15 @@ def carrier_missions(request, tab=None):
     if tab == "all":
         missions: [CarrierMission] = CarrierMission.objects.all()
         context["all_missions"] = list_to_columns(missions, 3)
+        system_distances = SystemIndex().distances(
+            CURRENT_SYSTEM,
+            missions.values_list("station__system_id", flat=True),
+        )
         context["mission_distances"] = {
-            mission.id: int(mission.station.system.distance_to(CURRENT_SYSTEM))
-            for mission in missions
+            mission_id: int(system_distances[system_id])
+            for mission_id, system_id in missions.values_list(
+                "id", "station__system_id"
+            )
         }
 
     elif tab == "my":
@@ -408,44 +561,134 @@ def carrier_missions(request, tab=None):
 
 
 def trade_routes(request):
-    return redirect("index")
+    context = {}
+    routes = []
+    loops = []
+    if request.method == "GET":
+        form = TradeRoutesForm()
+        form.fields["landing_pad_size"].initial = "S"
+    else:
+        form = TradeRoutesForm(request.POST)
+        station_filters = {
+            "landing_pad_size": form.data.get("landing_pad_size"),
+            "include_fleet_carriers": form.data.get("include_fleet_carriers") == "yes",
+            "include_planetary": form.data.get("include_planetary") == "yes",
+            "include_odyssey": form.data.get("include_odyssey") == "yes",
+        }
+        search_radius = form.data.get("search_radius")
+        cargo_capacity = form.data.get("cargo_capacity")
+        budget = form.data.get("budget")
+        max_hop_distance = form.data.get("max_hop_distance")
+        hops = form.data.get("hops")
+        order_by = (
+            "profit_per_ly"
+            if form.data.get("order_by") == "profit_per_ly"
+            else "profit"
+        )
+        search_radius = (
+            min(int(search_radius), MAX_SEARCH_RADIUS)
+            if search_radius and search_radius.isdigit()
+            else 30
+        )
+        cargo_capacity = (
+            int(cargo_capacity) if cargo_capacity and cargo_capacity.isdigit() else 100
+        )
+        budget = int(budget) if budget and budget.isdigit() else None
+        max_hop_distance = (
+            int(max_hop_distance)
+            if max_hop_distance and max_hop_distance.isdigit()
+            else None
+        )
+        hops = min(int(hops), MAX_LOOP_HOPS) if hops and hops.isdigit() else 1
+
+        ref_system_name_or_id = form.data.get("reference_system")
+        ref_system = None
+        if ref_system_name_or_id and ref_system_name_or_id.isdigit():
+            ref_system = System.objects.filter(pk=int(ref_system_name_or_id)).first()
+        elif ref_system_name_or_id:
+            ref_system = (
+                System.objects.filter(name__icontains=ref_system_name_or_id)
+                .order_by("id")
+                .first()
+            )
+
+        if ref_system:
+            t0 = time.perf_counter()
+            if hops > 1:
+                loops = cached_trade_loops(
+                    ref_system,
+                    station_filters,
+                    radius=search_radius,
+                    hops=hops,
+                    capacity=cargo_capacity,
+                    budget=budget,
+                    max_distance=max_hop_distance,
+                )
+                routes = [route for loop in loops for route in loop.routes]
+            else:
+                routes = find_trade_routes(
+                    ref_system,
+                    search_radius,
+                    cargo_capacity,
+                    budget,
+                    limit=40,
+                    order=order_by,
+                    stations=filter_stations(Station.objects.all(), **station_filters),
+                    max_distance=max_hop_distance,
+                )
+            context["search_seconds"] = time.perf_counter() - t0
+            stations = Station.objects.select_related("system").in_bulk(
+                {route.source_id for route in routes}
+                | {route.destination_id for route in routes}
+            )
+            commodities = Commodity.objects.in_bulk(
+                {route.commodity_id for route in routes if route.commodity_id}
+            )
+            for route in routes:
+                route.source = stations[route.source_id]
+                route.destination = stations[route.destination_id]
+                route.commodity = commodities.get(route.commodity_id)
+            context["reference_system"] = ref_system
+
+    context["routes"] = [] if loops else routes
+    context["loops"] = loops
+    context["form"] = form
+    return render(
+        request, "EDSite/trade/trade_routes.html", base_context(request) | context
+    )
 
 
 @csrf_exempt
 def debug_reload(request):
     print("Going to update data.")
-
-    def f():
-        EDData().update_tradedangerous_database()
-
-    threading.Thread(target=f).start()
-    # EDData().update_tradedangerous_database()
-    return JsonResponse({"status": EDData().td_database_status.__str__()})
+    job = JobScheduler().submit(
+        "update_tradedangerous",
+        lambda job: EDData().update_tradedangerous_database(),
+    )
+    return JsonResponse(job.to_dict())
 
 
 @csrf_exempt
 def debug_update_database(request, mode="False"):
-    update_all = mode == "all"
-    quick = mode == "quick"
-    listings = mode == "listings"
-    cache = mode == "cache"
-
     print(f"Updating local database ({mode})...")
+    job = JobScheduler().submit(f"update_database_{mode}", database_update_job(mode))
+    return JsonResponse(job.to_dict())
 
-    def f():
-        EDData().update_local_database(
-            data=update_all,
-            update_stations=update_all or quick,
-            update_systems=update_all or quick,
-            update_commodities=update_all or quick,
-            update_listings=update_all or listings,
-            update_cache=update_all or listings or cache,
-            full_listings_update=True,
-        )
 
-    threading.Thread(target=f).start()
+def debug_jobs(request):
+    return JsonResponse({"jobs": [job.to_dict() for job in JobScheduler().list()]})
+
 
-    return JsonResponse({"status": "No status"})
+@csrf_exempt
+def debug_job(request, job_id: int):
+    """The status of a job. POST cancels it."""
+    scheduler = JobScheduler()
+    job = (
+        scheduler.cancel(job_id) if request.method == "POST" else scheduler.get(job_id)
+    )
+    if job is None:
+        return JsonResponse({"error": f"Job {job_id} not found."}, status=404)
+    return JsonResponse(job.to_dict())
 
 
 def signup_view(request):
@@ -3,9 +3,97 @@ from pprint import pprint
 from django.db.models import Q
 from django.http import HttpResponse
 from rest_framework import viewsets, permissions, generics
+from rest_framework.exceptions import NotFound, ValidationError
 
 from EDSite.models import Commodity, LiveListing, System, Station
 from EDSite import serializers
+from EDSite.tools.listing_index import (
+    DEMAND,
+    PAD_SIZES,
+    SUPPLY,
+    ListingIndex,
+    RankedRows,
+    RankWeights,
+)
+from EDSite.tools.spatial import DistanceOrderedRows, annotate_distance, closest_ids
+
+# Most results a query with near and order=distance but without a radius returns.
+NEAR_LIMIT = 500
+
+
+def find_reference_system(name_or_id: str) -> System:
+    if name_or_id.isdigit():
+        system = System.objects.filter(pk=int(name_or_id)).first()
+    else:
+        system = System.objects.filter(name__iexact=name_or_id).first()
+    if system is None:
+        raise NotFound(f"Unknown reference system {name_or_id!r}.")
+    return system
+
+
+def float_param(request, name: str):
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValidationError({name: f"Expected a number, got {value!r}."})
+
+
+def int_param(request, name: str):
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError({name: f"Expected an integer, got {value!r}."})
+
+
+class DistanceQueryMixin:
+    """
+    Geo parameters for the lists of viewsets whose rows belong to a system:
+    near=<system id or name> adds the distance to every result, radius=<ly> keeps the results within
+    radius of near, and order=distance returns the closest first.
+    With a radius, everything runs in the database. Without one, order=distance takes the closest
+    NEAR_LIMIT rows from the SystemIndex.
+    """
+
+    # The path from the rows to their system, like "system__" for stations.
+    system_path = ""
+    # The values of order that the viewset accepts.
+    orders = ("distance",)
+
+    def filter_distance(self, qs):
+        params = self.request.query_params
+        near = params.get("near")
+        if not near or self.action != "list":
+            return qs
+        reference = find_reference_system(near)
+        radius = float_param(self.request, "radius")
+        order = params.get("order")
+        if order not in (None, "", *self.orders):
+            raise ValidationError({"order": f"Unknown order {order!r}."})
+        if order == "distance":
+            distances = self.nearest_ids(qs, reference, radius)
+            if distances is not None:
+                # Only the page that is shown gets loaded.
+                return DistanceOrderedRows(qs, distances)
+        qs = annotate_distance(qs, reference, radius, field=self.system_path)
+        if order == "distance":
+            qs = qs.order_by("distance", "id")
+        return qs
+
+    def nearest_ids(self, qs, reference: System, radius):
+        """
+        The (pk, distance) pairs of the rows of qs closest to reference, or None to order them in
+        the database.
+        """
+        if radius is not None:
+            return None
+        system_id_field = f"{self.system_path[:-2]}_id" if self.system_path else "id"
+        return closest_ids(qs, reference, NEAR_LIMIT, field=system_id_field)
 
 
 class CommoditiesViewSet(viewsets.ModelViewSet):
@@ -20,9 +108,11 @@ class CommoditiesViewSet(viewsets.ModelViewSet):
         return qs.all()
 
 
-class ListingsViewSet(viewsets.ModelViewSet):
+class ListingsViewSet(DistanceQueryMixin, viewsets.ModelViewSet):
     serializer_class = serializers.ListingsSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    system_path = "station__system__"
+    orders = ("distance", "score")
 
     def get_queryset(self):
         qs = LiveListing.objects
@@ -31,6 +121,9 @@ class ListingsViewSet(viewsets.ModelViewSet):
         system_id = self.request.query_params.get("system__station")
         type = self.request.query_params.get("type")  # Supply or demand.
         units = self.request.query_params.get("units")
+        pad_size = self.request.query_params.get("pad_size")
+        if pad_size and pad_size not in PAD_SIZES:
+            raise ValidationError({"pad_size": f"Unknown pad size {pad_size!r}."})
         if station_id:
             qs = qs.filter(Q(station_id=station_id))
         if commodity_id:
@@ -50,10 +143,85 @@ class ListingsViewSet(viewsets.ModelViewSet):
                 else:
                     qs = qs.filter(Q(demand_units__gt=0))
                 qs = qs.order_by("-demand_price")
-        return qs.all()  # .prefetch_related('commodity', 'station')
+        if pad_size == "M":
+            qs = qs.exclude(Q(station__pad_size="S"))
+        elif pad_size == "L":
+            qs = qs.filter(Q(station__pad_size="L"))
+        if self.request.query_params.get("near"):
+            qs = qs.select_related("commodity", "station__system")
+        return self.filter_distance(qs.all())
 
+    def filter_distance(self, qs):
+        """
+        order=score ranks the listings by a blend of price, units, data age and distance from near,
+        weighted by price_weight, units_weight, age_weight and distance_weight.
+        """
+        params = self.request.query_params
+        if params.get("order") != "score" or self.action != "list":
+            return super().filter_distance(qs)
+        type = params.get("type")
+        if (
+            not params.get("near")
+            or not params.get("commodity")
+            or type not in (SUPPLY, DEMAND)
+        ):
+            raise ValidationError(
+                {
+                    "order": "order=score needs near, commodity and type=supply or demand."
+                }
+            )
+        if params.get("station") or params.get("system__station"):
+            raise ValidationError(
+                {"order": "order=score does not combine with station or system."}
+            )
+        weights = {
+            name: float_param(self.request, f"{name}_weight")
+            for name in ("price", "units", "age", "distance")
+        }
+        try:
+            weights = RankWeights(
+                **{name: value for name, value in weights.items() if value is not None}
+            )
+        except ValueError as e:
+            raise ValidationError({"order": str(e)})
+        radius = float_param(self.request, "radius")
+        return RankedRows(
+            qs,
+            ListingIndex().rank(
+                find_reference_system(params["near"]),
+                int_param(self.request, "commodity"),
+                type,
+                limit=NEAR_LIMIT,
+                weights=weights,
+                min_units=int_param(self.request, "units") or 1,
+                pad_size=params.get("pad_size") or "S",
+                max_distance=radius,
+            ),
+        )
 
-class SystemsViewSet(viewsets.ModelViewSet):
+    def nearest_ids(self, qs, reference: System, radius):
+        # The closest stations that sell or buy a commodity come from the ListingIndex.
+        params = self.request.query_params
+        type = params.get("type")
+        if (
+            type not in (SUPPLY, DEMAND)
+            or not params.get("commodity")
+            or params.get("station")
+            or params.get("system__station")
+        ):
+            return super().nearest_ids(qs, reference, radius)
+        return ListingIndex().nearest(
+            reference,
+            int_param(self.request, "commodity"),
+            type,
+            limit=NEAR_LIMIT if radius is None else None,
+            min_units=int_param(self.request, "units") or 1,
+            pad_size=params.get("pad_size") or "S",
+            max_distance=radius,
+        )
+
+
+class SystemsViewSet(DistanceQueryMixin, viewsets.ModelViewSet):
     serializer_class = serializers.SystemSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
@@ -62,16 +230,17 @@ class SystemsViewSet(viewsets.ModelViewSet):
         name_like = self.request.query_params.get("name_like")
         if name_like:
             qs = qs.filter(Q(name__icontains=name_like))
-        return qs.all()
+        return self.filter_distance(qs.all())
 
 
-class StationsViewSet(viewsets.ModelViewSet):
+class StationsViewSet(DistanceQueryMixin, viewsets.ModelViewSet):
     serializer_class = serializers.StationSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    system_path = "system__"
 
     def get_queryset(self):
         qs = Station.objects
         name_like = self.request.query_params.get("name_like")
         if name_like:
             qs = qs.filter(Q(name__icontains=name_like))
-        return qs.all()
+        return self.filter_distance(qs.select_related("system"))
@@ -31,6 +31,28 @@ except ModuleNotFoundError:
 
 HISTORIC_DIFFERENCE_DELTA = 5
 HISTORIC_CACHE_TIMEOUT_HOURS = 12
+# Incremental listings imports are replaced by a full import when the last one is older than this.
+LISTINGS_RECONCILIATION_HOURS = 24
+# An interrupted database update is resumed from its checkpoints when it is restarted within this time.
+IMPORT_RESUME_HOURS = 12
+# Cron expressions (UTC) for periodic database updates by the job scheduler. Unset means no periodic update.
+FULL_UPDATE_SCHEDULE = os.getenv("FULL_UPDATE_SCHEDULE")
+LISTINGS_UPDATE_SCHEDULE = os.getenv("LISTINGS_UPDATE_SCHEDULE")
+# EDDN messages are spooled here until they are processed. Outside of the source tree by default, so
+# point it at a persistent volume when the web process runs in a container.
+EDDN_SPOOL_DIR = Path(
+    os.getenv("EDDN_SPOOL_DIR")
+    or Path(os.getenv("XDG_STATE_HOME") or Path.home() / ".local" / "state")
+    / "edsite"
+    / "eddn_spool"
+)
+# Precomputed lists of the systems within jump range of every system, one file per range.
+JUMP_GRAPH_DIR = Path(os.getenv("JUMP_GRAPH_DIR") or BASE_DIR / "data" / "jump_graphs")
+# Jump ranges in ly that the build_jump_graphs command builds neighbour lists for.
+JUMP_GRAPH_RANGES = [
+    float(jump_range)
+    for jump_range in (os.getenv("JUMP_GRAPH_RANGES") or "20,40,60").split(",")
+]
 
 POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
@@ -48,6 +70,12 @@ DEBUG_MODE = os.getenv("DEBUG_MODE") == "True"
 
 EDSM_API_KEY = os.getenv("EDSM_API_KEY")
 
+# Number of processes used to import TradeDangerous listings.
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS") or os.cpu_count() or 1)
+# "tradedangerous" (the default) reads the listings back from TD's database. "csv" is opt-in: it streams
+# eddblink's listings files from TD_SERVER into the database and deletes the listings they replace.
+LISTINGS_SOURCE = os.getenv("LISTINGS_SOURCE") or "tradedangerous"
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.0/howto/deployment/checklist/